@@ -0,0 +1,417 @@
+"""
+Acceptors.py - Multi-process serving: acceptor processes sharing one port
+
+A single event loop decodes, dispatches and encodes every query on one core,
+however fast the search itself is. With more than one acceptor in the settings,
+start_server runs a Coordinator instead, which starts that many acceptor
+processes. Each of them binds the server address and port with SO_REUSEPORT,
+so the kernel spreads the incoming connections over them, and serves the usual
+/search, /feedback and /metrics paths (see Server) on an event loop of its own.
+
+Acceptors search a memory-mapped, search-only index of the served model (see
+Snapshot) on a search thread (see Workers.ThreadSearcher), so they all share one
+copy of the index in memory. The coordinator keeps everything that changes the model: it
+exports a snapshot of every new version and pushes it to the acceptors, which
+load and warm it up before switching over, it receives the feedback the
+acceptors forward, and it runs the scheduled learning, maintenance, retraining
+and checkpoints. It restarts the acceptors that exit, and when stopped has them
+drain their connections (see Server.drain) before it exits.
+
+Query logs are kept per acceptor: acceptor N writes
+logs/queries_acceptorN_YYYYMMDD.jsonl. Metrics are gathered by the coordinator:
+every acceptor sends it its own every METRICS_INTERVAL seconds, and it renders
+them with its own under a process label ("coordinator", "acceptorN") into
+METRICS_FILE, which every acceptor serves on /metrics, whichever one the
+request lands on.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+from asyncio import Event, create_task, get_running_loop, sleep, to_thread
+from functools import partial
+from queue import Empty
+from threading import Thread
+from time import monotonic, perf_counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import websockets as ws
+from LogManager import *
+from Metrics import collect, render, reset
+from Cache import ResultCache, get_model_holder, set_model_holder
+from DataTypes import FeedBack
+from Model import SearchModel
+from QueryLog import QueryLog
+from Workers import ThreadSearcher, export_snapshot
+import Server
+
+# Directory holding the snapshots pushed to the acceptors
+SNAPSHOT_DIR = "snapshots"
+# Seconds between checks that every acceptor is still running
+MONITOR_INTERVAL = 1.0
+# Seconds an acceptor is given beyond the drain timeout to exit before it is killed
+EXIT_GRACE = 5.0
+# Seconds between the metrics every acceptor sends the coordinator
+METRICS_INTERVAL = 5.0
+# Metrics of every process, written by the coordinator and served by the acceptors
+METRICS_FILE = "metrics.prom"
+
+class AcceptorHolder:
+    """
+    Holder of the model served by an acceptor, with the interface of ModelHolder that Server uses.
+
+    The model is a read-only snapshot, replaced when the coordinator pushes a new
+    version, and feedback is forwarded to the coordinator instead of being journaled.
+    """
+    def __init__(self, model: SearchModel, version: int, events: multiprocessing.Queue):
+        """
+        Args:
+            model (SearchModel): The snapshot to serve
+            version (int): Model version of the snapshot
+            events (multiprocessing.Queue): Queue the coordinator reads feedback from
+        """
+        self.__current: tuple[SearchModel, int] = (model, version)
+        self.__events = events
+        self.__listeners: list[Callable[[SearchModel, int], None]] = []
+
+    def add_listener(self, listener: Callable[[SearchModel, int], None]) -> None:
+        """Registers a function called with (model, version) whenever another version is served, once however often it is added."""
+        if listener not in self.__listeners:
+            self.__listeners.append(listener)
+
+    @property
+    def current(self) -> tuple[SearchModel, int]:
+        """The served (model, version) pair."""
+        return self.__current
+
+    @property
+    def model(self) -> SearchModel:
+        """The served model."""
+        return self.__current[0]
+
+    @property
+    def version(self) -> int:
+        """Version of the served model, as numbered by the coordinator."""
+        return self.__current[1]
+
+    def serve(self, model: SearchModel, version: int) -> None:
+        """Atomically replaces the served model with a version pushed by the coordinator."""
+        self.__current = (model, version)
+        for listener in self.__listeners:
+            listener(*self.__current)
+
+    def receive_feedback(self, events: list[FeedBack]) -> None:
+        """Forwards feedback events to the coordinator, which journals and learns them."""
+        self.__events.put(("feedback", events))
+
+    @property
+    def pending_feedback(self) -> int:
+        """Always 0, the coordinator keeps the pending feedback."""
+        return 0
+
+    @property
+    def unsaved_changes(self) -> int:
+        """Always 0, the coordinator keeps the journal."""
+        return 0
+
+def follow_coordinator(control: multiprocessing.Queue, holder: AcceptorHolder, loop: asyncio.AbstractEventLoop) -> None:
+    """
+    Body of the thread of an acceptor loading the versions pushed by the coordinator.
+
+    Each version is loaded and warmed up on this thread, then served from the event
+    loop; versions superseded while one was loading are skipped.
+
+    Args:
+        control (multiprocessing.Queue): (snapshot directory, version) pairs, None to stop
+        holder (AcceptorHolder): Holder of the served model
+        loop (asyncio.AbstractEventLoop): Event loop of the acceptor
+    """
+    while True:
+        message = control.get()
+        try:
+            while message is not None:
+                message = control.get_nowait()
+        except Empty:
+            pass
+        if message is None:
+            return
+        directory, version = message
+        try:
+            model = SearchModel.load(directory, verify=False)
+            seconds = model.warmup()
+        except Exception as e:
+            error(f"Loading model version {version} failed: {str(e)}")
+            continue
+        loop.call_soon_threadsafe(holder.serve, model, version)
+        info(f"Serving model version {version}, warmed up in {seconds:.3f}s")
+
+async def report_metrics(index: int, events: multiprocessing.Queue):
+    """
+    Sends the metrics of an acceptor to the coordinator every METRICS_INTERVAL seconds.
+
+    Args:
+        index (int): Number of the acceptor
+        events (multiprocessing.Queue): Queue of the messages to the coordinator
+    """
+    while True:
+        events.put(("metrics", index, collect()))
+        await sleep(METRICS_INTERVAL)
+
+def read_metrics(index: int) -> str:
+    """Returns the metrics of every process the coordinator last wrote, only those of this acceptor until it did."""
+    try:
+        with open(METRICS_FILE, encoding="utf-8") as file:
+            return file.read()
+    except FileNotFoundError:
+        return render({f"acceptor{index}": collect()})
+
+async def serve_acceptor(index: int, config: Dict[str, Any], directory: str, version: int,
+                         control: multiprocessing.Queue, events: multiprocessing.Queue, drain_timeout: float):
+    """
+    Serves connections on the shared port until SIGTERM or SIGINT, then drains them.
+
+    Args:
+        index (int): Number of the acceptor
+        config (Dict[str, Any]): Server configuration, see Server.server_config
+        directory (str): Snapshot directory of the version to serve first
+        version (int): Model version of the snapshot
+        control (multiprocessing.Queue): Versions pushed by the coordinator, see follow_coordinator
+        events (multiprocessing.Queue): Queue of the messages to the coordinator
+        drain_timeout (float): Seconds the searches in flight are given to finish once stopped
+    """
+    # Inherited from the coordinator
+    Server.startup_timings.clear()
+    reset()
+    Server.metrics_page = partial(read_metrics, index)
+    start = perf_counter()
+    model = SearchModel.load(directory, verify=False)
+    Server.startup_timings["snapshot"] = perf_counter() - start
+    Server.startup_timings["warmup"] = model.warmup()
+    holder = AcceptorHolder(model, version, events)
+    set_model_holder(holder)
+    Server.search_pool = ThreadSearcher()
+    Server.result_cache = ResultCache(config["result_cache_mb"] * 1024 * 1024, config["result_cache_ttl"])
+    Server.query_log = QueryLog(f"queries_acceptor{index}")
+    holder.add_listener(Server.clear_result_cache)
+    stop = Event()
+    Server.stop_on_signals(stop)
+    Thread(target=follow_coordinator, args=(control, holder, get_running_loop()), name="Coordinator", daemon=True).start()
+
+    start = perf_counter()
+    server = await ws.serve(
+        handler=Server.handle_server,
+        process_request=Server.serve_metrics,
+        host=config["address"],
+        port=int(config["port"]),
+        reuse_port=True
+    )
+    Server.startup_timings["listen"] = perf_counter() - start
+    events.put(("ready", index, dict(Server.startup_timings)))
+    reporter = create_task(report_metrics(index, events))
+    try:
+        await stop.wait()
+        await Server.drain(server, drain_timeout)
+    finally:
+        reporter.cancel()
+        Server.search_pool.shutdown()
+        Server.query_log.flush()
+        flush()
+
+def run_acceptor(index: int, config: Dict[str, Any], directory: str, version: int,
+                 control: multiprocessing.Queue, events: multiprocessing.Queue, drain_timeout: float) -> None:
+    """Body of an acceptor process, see serve_acceptor for the arguments."""
+    # A forked acceptor inherits the signal handling of the coordinator's event loop
+    signal.set_wakeup_fd(-1)
+    for signum in Server.STOP_SIGNALS:
+        signal.signal(signum, signal.SIG_DFL)
+    set_prefix(f"cte_search_acceptor{index}")
+    asyncio.run(serve_acceptor(index, config, directory, version, control, events, drain_timeout))
+
+class Coordinator:
+    """Starts the acceptor processes, keeps them running and pushes them the new model versions."""
+    def __init__(self, config: Dict[str, Any], drain_timeout: float = Server.DRAIN_TIMEOUT):
+        """
+        Args:
+            config (Dict[str, Any]): Server configuration, see Server.server_config
+            drain_timeout (float): Seconds the acceptors give the searches in flight once stopped
+        """
+        self.__config = config
+        self.__drain_timeout = drain_timeout
+        acceptors = config["acceptors"]
+        self.__acceptors: List[Optional[multiprocessing.Process]] = [None] * acceptors
+        self.__controls: List[Optional[multiprocessing.Queue]] = [None] * acceptors
+        self.__events: multiprocessing.Queue = multiprocessing.Queue()
+        # Acceptors serving since they were last started
+        self.__ready: set[int] = set()
+        # Directory and version of the last exported snapshot
+        self.__snapshot: Optional[Tuple[str, int]] = None
+        # Set when a version newer than the exported one is published
+        self.__changed = Event()
+        # Last metrics sent by each acceptor, see report_metrics
+        self.__metrics: Dict[int, Dict[str, Any]] = {}
+
+    @property
+    def acceptors(self) -> int:
+        """Number of acceptor processes."""
+        return len(self.__acceptors)
+
+    async def run(self, stop: Optional[Event] = None):
+        """
+        Serves through the acceptors until stopped, then has them drain and exit.
+
+        Args:
+            stop (Optional[Event]): Set to stop; without it the acceptors run until the task is cancelled
+
+        Raises:
+            ValueError: If the platform has no SO_REUSEPORT
+            RuntimeError: If an acceptor exits before it is ready, as when the port is taken
+        """
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError("Running several acceptors needs SO_REUSEPORT, which this platform lacks")
+        holder = get_model_holder()
+        await Server.apply_ranker(self.__config["ranker"])
+        # Metrics of a previous run are not served again
+        if os.path.exists(METRICS_FILE):
+            os.remove(METRICS_FILE)
+        start = perf_counter()
+        await self.__export(*holder.current)
+        Server.startup_timings["snapshot"] = perf_counter() - start
+        holder.add_listener(lambda model, version: self.__changed.set())
+
+        reader = Thread(target=self.__read_events, args=(get_running_loop(),), name="Acceptors", daemon=True)
+        reader.start()
+        background = []
+        try:
+            start = perf_counter()
+            for index in range(self.acceptors):
+                self.__start(index)
+            await self.__wait_ready(stop)
+            Server.startup_timings["acceptors"] = perf_counter() - start
+            addr, port = self.__config["address"], self.__config["port"]
+            breakdown = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in Server.startup_timings.items())
+            info(f"{self.acceptors} acceptors ready on ws://{addr}:{port} in "
+                 f"{sum(Server.startup_timings.values()):.3f}s ({breakdown})")
+            background = [create_task(self.__monitor()), create_task(self.__push_versions()),
+                          create_task(Server.maintain_model()), create_task(Server.retrain_model()),
+                          create_task(Server.learn_feedback()), create_task(Server.checkpoint_cache())]
+            await (stop or Event()).wait()
+        finally:
+            for task in background:
+                task.cancel()
+            await self.__stop_acceptors()
+            self.__events.put(None)
+            info("Acceptors stopped")
+
+    async def __wait_ready(self, stop: Optional[Event]) -> None:
+        """Wait until every acceptor reported ready, or stop is set."""
+        while len(self.__ready) < self.acceptors and not (stop is not None and stop.is_set()):
+            failed = [(index, process) for index, process in enumerate(self.__acceptors) if not process.is_alive()]
+            if failed:
+                index, process = failed[0]
+                raise RuntimeError(f"Acceptor {index} exited with code {process.exitcode} before it was ready")
+            await sleep(0.05)
+
+    def __start(self, index: int) -> None:
+        """Start an acceptor process serving the last exported snapshot."""
+        directory, version = self.__snapshot
+        control = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=run_acceptor,
+            name=f"Acceptor-{index}",
+            args=(index, self.__config, directory, version, control, self.__events, self.__drain_timeout),
+            daemon=True
+        )
+        process.start()
+        self.__acceptors[index] = process
+        self.__controls[index] = control
+        self.__ready.discard(index)
+        debug(f"Started acceptor {index} (pid {process.pid}) on model version {version}")
+
+    def __on_ready(self, index: int, timings: Dict[str, float]) -> None:
+        self.__ready.add(index)
+        debug(f"Acceptor {index} ready ({', '.join(f'{phase} {seconds:.3f}s' for phase, seconds in timings.items())})")
+
+    def __on_metrics(self, index: int, metrics: Dict[str, Any]) -> None:
+        """Keep the metrics an acceptor sent and rewrite METRICS_FILE with those of every process."""
+        self.__metrics[index] = metrics
+        processes = {"coordinator": collect()}
+        processes.update((f"acceptor{i}", self.__metrics[i]) for i in sorted(self.__metrics))
+        temporary = f"{METRICS_FILE}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write(render(processes))
+        os.replace(temporary, METRICS_FILE)
+
+    def __read_events(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Body of the thread handing the messages of the acceptors to the event loop."""
+        holder = get_model_holder()
+        while True:
+            message = self.__events.get()
+            if message is None:
+                return
+            kind, *args = message
+            try:
+                if kind == "feedback":
+                    loop.call_soon_threadsafe(holder.receive_feedback, *args)
+                elif kind == "ready":
+                    loop.call_soon_threadsafe(self.__on_ready, *args)
+                elif kind == "metrics":
+                    loop.call_soon_threadsafe(self.__on_metrics, *args)
+            except RuntimeError:
+                return  # The event loop is closed
+
+    async def __monitor(self) -> None:
+        """Restart the acceptors that exited, checking every MONITOR_INTERVAL seconds."""
+        while True:
+            await sleep(MONITOR_INTERVAL)
+            for index, process in enumerate(self.__acceptors):
+                if not process.is_alive():
+                    error(f"Acceptor {index} (pid {process.pid}) exited with code {process.exitcode}, restarting it")
+                    process.close()
+                    self.__start(index)
+
+    async def __push_versions(self) -> None:
+        """Export every new version of the served model and push it to the acceptors."""
+        holder = get_model_holder()
+        while True:
+            await self.__changed.wait()
+            self.__changed.clear()
+            model, version = holder.current
+            if version == self.__snapshot[1]:
+                continue
+            try:
+                await self.__export(model, version)
+            except Exception as e:
+                error(f"Exporting model version {version} failed: {str(e)}")
+                continue
+            for control in self.__controls:
+                control.put(self.__snapshot)
+            info(f"Pushed model version {version} to the acceptors")
+
+    async def __export(self, model: SearchModel, version: int) -> None:
+        """Export a model version off the event loop, see Workers.export_snapshot."""
+        previous = None if self.__snapshot is None else self.__snapshot[1]
+        directory = await to_thread(export_snapshot, model, SNAPSHOT_DIR, version, previous)
+        self.__snapshot = (directory, version)
+
+    async def __stop_acceptors(self) -> None:
+        """Have every acceptor drain its connections and exit, killing those still running after the drain timeout."""
+        for process, control in zip(self.__acceptors, self.__controls):
+            if process is None:
+                continue
+            control.put(None)
+            if process.is_alive():
+                process.terminate()
+        await to_thread(self.__join, self.__drain_timeout + EXIT_GRACE)
+
+    def __join(self, timeout: float) -> None:
+        """Wait for the acceptors to exit, killing those still running after timeout seconds."""
+        deadline = monotonic() + timeout
+        for index, process in enumerate(self.__acceptors):
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - monotonic()))
+            if process.is_alive():
+                warning(f"Acceptor {index} (pid {process.pid}) did not exit in time, killing it")
+                process.kill()
+                process.join()
@@ -0,0 +1,151 @@
+"""
+Build.py - Parallel construction of the TF-IDF matrix
+
+Fitting the vectorizer is dominated by tokenizing and counting the terms of
+every page, which TfidfVectorizer does on a single core. ``parallel_fit_transform``
+splits the pages into contiguous shards that worker processes tokenize and count
+on their own, each with its local vocabulary. The parent then merges the shard
+vocabularies, renumbers the counts and lets the vectorizer's own TF-IDF
+transformer compute the IDF weights and normalize the rows.
+
+The merge reproduces the order in which TfidfVectorizer numbers and sorts terms,
+so the fitted vectorizer and the matrix are bit-for-bit identical to those of
+``TfidfVectorizer.fit_transform`` on the same pages.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Sequence, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfTransformer, TfidfVectorizer
+
+# Shards per worker process, so a slow shard does not hold the others up
+SHARDS_PER_WORKER = 4
+
+def count_terms(vectorizer: TfidfVectorizer, documents: List[str]) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+    """Count the terms of a shard of documents, as TfidfVectorizer does.
+
+    Args:
+        vectorizer: The (unfitted) vectorizer whose analyzer splits the documents into terms.
+        documents: Contents of the shard's pages.
+
+    Returns:
+        Tuple of (terms, indices, counts, indptr): the shard vocabulary in order of
+        first appearance, and the CSR term counts of the documents with term ids
+        into that vocabulary.
+    """
+    analyze = vectorizer.build_analyzer()
+    vocabulary = {}
+    indices = []
+    counts = []
+    indptr = [0]
+    for document in documents:
+        counter = {}
+        for term in analyze(document):
+            term_id = vocabulary.setdefault(term, len(vocabulary))
+            counter[term_id] = counter.get(term_id, 0) + 1
+        indices.extend(counter.keys())
+        counts.extend(counter.values())
+        indptr.append(len(indices))
+    return list(vocabulary), np.array(indices, dtype=np.int64), np.array(counts, dtype=np.intc), np.array(indptr, dtype=np.int64)
+
+def parallel_fit_transform(vectorizer: TfidfVectorizer, documents: Sequence[str], workers: int = 0) -> csr_matrix:
+    """Fit a TfidfVectorizer and return the TF-IDF matrix, counting terms in worker processes.
+
+    Equivalent to ``vectorizer.fit_transform(documents)`` for a vectorizer without
+    a fixed vocabulary, max_features, binary counts or document frequency limits,
+    like the one of SearchModel.
+
+    Args:
+        vectorizer: The vectorizer to fit.
+        documents: Contents of the pages.
+        workers: Number of worker processes, 0 for one per CPU core.
+
+    Returns:
+        The L2-normalized TF-IDF matrix, one row per document.
+
+    Raises:
+        ValueError: If the documents hold no term at all.
+    """
+    workers = workers if workers > 0 else os.cpu_count() or 1
+    documents = list(documents)
+    num_shards = min(workers * SHARDS_PER_WORKER, max(len(documents), 1))
+    bounds = np.linspace(0, len(documents), num_shards + 1).astype(int)
+    shards = [documents[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(count_terms, [vectorizer] * len(shards), shards))
+
+    # Number the terms in order of first appearance over the whole corpus, like a single pass would
+    vocabulary = {}
+    for terms, _, _, _ in results:
+        for term in terms:
+            vocabulary.setdefault(term, len(vocabulary))
+    if len(vocabulary) == 0:
+        raise ValueError("empty vocabulary; perhaps the documents only contain stop words")
+
+    nnz = sum(len(indices) for _, indices, _, _ in results)
+    index_dtype = np.int64 if nnz > np.iinfo(np.int32).max else np.int32
+    indices = np.concatenate([np.array([vocabulary[term] for term in terms], dtype=index_dtype)[shard_indices]
+                              for terms, shard_indices, _, _ in results])
+    counts = np.concatenate([shard_counts for _, _, shard_counts, _ in results])
+    offsets = np.cumsum([0] + [len(shard_indices) for _, shard_indices, _, _ in results])
+    indptr = np.concatenate([[0]] + [shard_indptr[1:] + offset for (_, _, _, shard_indptr), offset in zip(results, offsets)])
+    counts_matrix = csr_matrix((counts, indices, indptr.astype(index_dtype)),
+                               shape=(len(documents), len(vocabulary)), dtype=vectorizer.dtype)
+    counts_matrix.sort_indices()
+
+    # Terms are then renumbered alphabetically, keeping each row's entries in the same order
+    renumbering = np.empty(len(vocabulary), dtype=index_dtype)
+    for term_id, (term, first_seen) in enumerate(sorted(vocabulary.items())):
+        vocabulary[term] = term_id
+        renumbering[first_seen] = term_id
+    counts_matrix.indices = renumbering.take(counts_matrix.indices)
+    counts_matrix.has_sorted_indices = False
+
+    vectorizer.fixed_vocabulary_ = False
+    vectorizer.vocabulary_ = vocabulary
+    vectorizer._tfidf = TfidfTransformer(norm=vectorizer.norm, use_idf=vectorizer.use_idf,
+                                         smooth_idf=vectorizer.smooth_idf, sublinear_tf=vectorizer.sublinear_tf)
+    vectorizer._tfidf.fit(counts_matrix)
+    return vectorizer._tfidf.transform(counts_matrix, copy=False)
+
+def transform_counting_unknown(vectorizer: TfidfVectorizer, documents: Sequence[str]) -> Tuple[csr_matrix, int]:
+    """Vectorize documents against a fitted vocabulary, counting the terms it does not know.
+
+    Equivalent to ``vectorizer.transform(documents)`` for a vectorizer like the one
+    of SearchModel (see parallel_fit_transform), but each document is tokenized once
+    for both the matrix and the count of unknown terms.
+
+    Args:
+        vectorizer: The fitted vectorizer.
+        documents: Contents of the pages.
+
+    Returns:
+        Tuple of (matrix, unknown): the L2-normalized TF-IDF rows of the documents, and
+        the number of distinct terms of each document missing from the vocabulary,
+        summed over the documents.
+    """
+    analyze = vectorizer.build_analyzer()
+    vocabulary = vectorizer.vocabulary_
+    indices = []
+    counts = []
+    indptr = [0]
+    unknown = 0
+    for document in documents:
+        counter = {}
+        unseen = set()
+        for term in analyze(document):
+            term_id = vocabulary.get(term)
+            if term_id is None:
+                unseen.add(term)
+            else:
+                counter[term_id] = counter.get(term_id, 0) + 1
+        unknown += len(unseen)
+        indices.extend(counter.keys())
+        counts.extend(counter.values())
+        indptr.append(len(indices))
+    counts_matrix = csr_matrix((np.array(counts, dtype=np.intc), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int32)),
+                               shape=(len(indptr) - 1, len(vocabulary)), dtype=vectorizer.dtype)
+    counts_matrix.sort_indices()
+    return vectorizer._tfidf.transform(counts_matrix, copy=False), unknown
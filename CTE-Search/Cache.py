@@ -1,13 +1,49 @@
 import joblib
 import atexit
+import asyncio
+import json
+import os
+import sys
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Optional
 from LogManager import *  # Assuming this is needed for logging
 from Model import SearchModel
-from DataTypes import Setting
+from DataTypes import FeedBack, Setting, SearchQuery
+from Journal import Journal
+from Snapshot import IndexReader, restore_directory
 """
 Manages data caching, ensuring we don't retrain the model on every reload.
+
+The model is stored in its own index directory (see SearchModel.save), the
+settings in a JSON file, and any other cached value in cache.bin. These are
+only rewritten by a checkpoint; in between, every change is appended to a
+journal (see Journal) which is replayed on the next load.
 """
 
+# Where the model, the settings, the other cached values and the journal are stored
+INDEX_DIR = "index"
+SETTINGS_FILE = "settings.json"
+CACHE_FILE = "cache.bin"
+JOURNAL_FILE = "journal.log"
+
+def switch_ranker(model: SearchModel, ranker: str) -> None:
+    """Replaces the ranker of a model and trains the new one."""
+    model.ranker = ranker
+    model.retrain()
+
+# Journaled model changes by operation name, each applying its JSON data to a model.
+# Feedback, learn and settings changes are handled by CacheHandle itself.
+OPERATIONS: dict[str, Callable[[SearchModel, Any], Any]] = {
+    "add_page": lambda model, page: model.append_page_data(page),
+    "remove_page": lambda model, title: model.remove_pages(title),
+    "retrain": lambda model, _: model.retrain(),
+    "maintain": lambda model, _: model.maintain(),
+    "ranker": switch_ranker
+}
+
 cache = None  # Singleton instance
+holder = None  # ModelHolder serving the current model
 
 class CacheHandle:
     def __new__(cls):
@@ -24,28 +60,46 @@ class CacheHandle:
                     Setting("address", "string"),
                     Setting("port", "int"),
                     Setting("cert", "path"),
-                    Setting("key", "path")
+                    Setting("key", "path"),
+                    Setting("workers", "int"),
+                    Setting("result_cache_mb", "int"),
+                    Setting("result_cache_ttl", "float"),
+                    Setting("ranker", "string"),
+                    Setting("acceptors", "int")
                 ]
     @classmethod
     def load(cls) -> 'CacheHandle':
         """Loads the cache from disk."""
         global cache 
         if cache is None:
-            try:
-                info("Attempting to load cache from disk")
-                cache_data = joblib.load("cache.bin")
-                instance = super().__new__(cls)
-                for key, value in cache_data.items():
+            info("Attempting to load cache from disk")
+            instance = super().__new__(cls)
+            # A cache.bin written before the index format may still hold the model and the settings
+            if os.path.exists(CACHE_FILE):
+                for key, value in joblib.load(CACHE_FILE).items():
                     setattr(instance, key, value)
-                if "settings" not in instance or len(instance.settings) == 0:
-                    instance.settings = cls.create_settings()
-                cache = instance
-                info("cache LOADED")
-            except FileNotFoundError:
-                instance = super().__new__(cls)
+            if os.path.exists(SETTINGS_FILE):
+                with open(SETTINGS_FILE, encoding="utf-8") as file:
+                    instance.settings = [Setting.from_json(data) for data in json.load(file)]
+            checkpoint = {}
+            restore_directory(INDEX_DIR)
+            if os.path.exists(INDEX_DIR):
+                instance.model = SearchModel.load(INDEX_DIR)
+                checkpoint = IndexReader(INDEX_DIR, verify=False).metadata.get("checkpoint", {})
+            if "settings" not in instance or len(instance.settings) == 0:
                 instance.settings = cls.create_settings()
-                cache = instance
-                CacheHandle.unload()
+            else:
+                # Settings introduced after this cache was saved get their defaults
+                known = {setting.name for setting in instance.settings}
+                instance.settings += [s for s in cls.create_settings() if s.name not in known]
+            # What the last checkpoint saved, so an unchanged model is not written again
+            instance.__saved_model = instance.get("model") if os.path.exists(INDEX_DIR) else None
+            instance.__checkpoint = checkpoint.get("journal", 0)
+            instance.__pending_feedback = checkpoint.get("pending_feedback", [])
+            instance.__journal = Journal(JOURNAL_FILE, instance.__checkpoint)
+            instance.__replay()
+            cache = instance
+            info("cache LOADED")
         return cache
 
     @staticmethod
@@ -53,13 +107,112 @@ class CacheHandle:
         """Saves the cache to disk."""
         global cache 
         if cache is not None:
+            cache.checkpoint()
+
+    def __replay(self) -> None:
+        """Re-applies the changes journaled since the last checkpoint, in order."""
+        replayed = 0
+        for seq, op, data in self.__journal.replay(self.__checkpoint):
             try:
-                info("Saving cache to disk")
-                cache_data = {k: v for k, v in cache.__dict__.items()}
-                joblib.dump(cache_data, "cache.bin")
-                info("cache successfully saved")
+                self.__apply(op, data)
             except Exception as e:
-                error(f"Error saving cache: {str(e)}")
+                warning(f"Journaled change {seq} ({op}) failed again on replay: {str(e)}")
+            replayed += 1
+        if replayed > 0:
+            info(f"Replayed {replayed} journaled changes")
+
+    def __apply(self, op: str, data: Any) -> None:
+        """Applies a journaled change in place, as ModelHolder did when it was made."""
+        if op == "settings":
+            self.settings = [Setting.from_json(setting) for setting in data]
+        elif op == "feedback":
+            self.__pending_feedback.extend(data)
+        else:
+            if "model" not in self:
+                self.model = SearchModel([])
+            if op == "learn":
+                batch = self.__pending_feedback[:data]
+                del self.__pending_feedback[:data]
+                self.model.learn(batch)
+            else:
+                OPERATIONS[op](self.model, data)
+
+    def record(self, op: str, data: Any = None) -> int:
+        """
+        Journals a change before it is applied.
+
+        Args:
+            op (str): "settings", "feedback", "learn" or a name in OPERATIONS
+            data (Any): JSON-serializable arguments of the change
+
+        Returns:
+            int: Sequence number of the change
+        """
+        return self.__journal.append(op, data)
+
+    @property
+    def journal_position(self) -> int:
+        """Sequence number of the last journaled change."""
+        return self.__journal.position
+
+    @property
+    def unsaved_changes(self) -> int:
+        """Number of changes journaled since the last checkpoint."""
+        return self.__journal.position - self.__checkpoint
+
+    @property
+    def pending_feedback(self) -> list[FeedBack]:
+        """Feedback received but not learned by the model yet, oldest first."""
+        return self.__pending_feedback
+
+    def set_settings(self, settings: list[Setting]) -> None:
+        """Journals and replaces the settings."""
+        self.record("settings", [setting.to_json() for setting in settings])
+        self.settings = settings
+
+    def checkpoint(self, model: Optional[SearchModel] = None, position: Optional[int] = None,
+                   pending_feedback: Optional[list[FeedBack]] = None) -> None:
+        """
+        Saves the model, settings and other cached values in full and truncates the journal.
+
+        The arguments must be a consistent view of the state, as ModelHolder.checkpoint takes;
+        by default the cached model and the current journal position are saved.
+
+        Args:
+            model (Optional[SearchModel]): Model including every change up to the position
+            position (Optional[int]): Sequence number of the last change included
+            pending_feedback (Optional[list[FeedBack]]): Feedback journaled up to the position but not learned yet
+        """
+        model = self.get("model") if model is None else model
+        position = self.__journal.position if position is None else position
+        pending_feedback = list(self.__pending_feedback) if pending_feedback is None else pending_feedback
+        try:
+            info("Saving cache to disk")
+            cache_data = {k: v for k, v in self.__dict__.items()
+                          if k not in ("model", "settings") and not k.startswith("_CacheHandle__")}
+            self.__write_file(SETTINGS_FILE, lambda path: self.__dump_settings(path))
+            self.__write_file(CACHE_FILE, lambda path: joblib.dump(cache_data, path))
+            # The journal position is saved last, with the model, once everything it covers is on disk
+            if model is not None and (model is not self.__saved_model or position != self.__checkpoint):
+                model.save(INDEX_DIR, {"journal": position, "pending_feedback": pending_feedback})
+                self.__saved_model = model
+            self.__checkpoint = position
+            self.__journal.truncate(position)
+            info("cache successfully saved")
+        except Exception as e:
+            error(f"Error saving cache: {str(e)}")
+
+    def __dump_settings(self, path: str) -> None:
+        """Writes the settings as JSON."""
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump([setting.to_json() for setting in self.settings], file, indent=2)
+
+    @staticmethod
+    def __write_file(path: str, write: Callable[[str], Any]) -> None:
+        """Writes a file through a temporary file renamed over it, so a crash leaves the old or the new one whole."""
+        temporary = f"{path}.tmp"
+        write(temporary)
+        os.replace(temporary, path)
 
     def add(self, key, value):
         """Adds a new immutable value (prevents modification of existing values)."""
@@ -79,9 +232,9 @@ class CacheHandle:
         """Retrieves a value but prevents direct modification."""
         value = getattr(self, key, None)
         if value is None:
-            debug(f"cache miss for key: {key}")
+            debug(f"cache miss for key: {key}", site="cache")
         else:
-            debug(f"cache hit for key: {key}")
+            debug(f"cache hit for key: {key}", site="cache")
         return value
 
     def __setattr__(self, name, value):
@@ -106,20 +259,254 @@ class CacheHandle:
 
     def __repr__(self):
         return repr(self.__dict__)
-def get_model():
+class ModelHolder:
+    """
+    Double-buffered holder for the SearchModel being served.
+
+    Readers take the current model and keep using that object until they are done.
+    Changes are applied to a copy off the event loop and published with a single
+    reference swap, so a search never sees a half-updated model and never waits
+    for a rebuild or retrain.
+    """
+    def __init__(self, model: SearchModel):
+        # Model and version are swapped together so readers always get a matching pair
+        self.__current: tuple[SearchModel, int] = (model, 0)
+        self.__lock = asyncio.Lock()
+        # Keeps checkpoints in order, without holding up changes while one is written
+        self.__checkpoint_lock = asyncio.Lock()
+        self.__listeners: list[Callable[[SearchModel, int], None]] = []
+
+    def add_listener(self, listener: Callable[[SearchModel, int], None]) -> None:
+        """Registers a function called with (model, version) whenever a new model is published, once however often it is added."""
+        if listener not in self.__listeners:
+            self.__listeners.append(listener)
+
+    @property
+    def current(self) -> tuple[SearchModel, int]:
+        """The published (model, version) pair. Treat the model as read-only."""
+        return self.__current
+
+    @property
+    def model(self) -> SearchModel:
+        """The currently published model. Treat it as read-only."""
+        return self.__current[0]
+
+    @property
+    def version(self) -> int:
+        """Incremented every time a new model is published."""
+        return self.__current[1]
+
+    def publish(self, model: SearchModel) -> None:
+        """Atomically replace the served model."""
+        self.__current = (model, self.__current[1] + 1)
+        CacheHandle.load().model = model
+        debug(f"Published model version {self.version}")
+        for listener in self.__listeners:
+            listener(*self.__current)
+
+    async def update(self, change: Callable[[SearchModel], Any]) -> Any:
+        """
+        Applies a change to a copy of the current model and publishes the copy.
+
+        Updates are serialized so none of them is lost. The change runs in a worker
+        thread while searches keep being served from the current model.
+
+        Args:
+            change: Function modifying the model it is given in place
+
+        Returns:
+            Whatever the change function returned
+        """
+        async with self.__lock:
+            model = self.model.copy()
+            result = await asyncio.to_thread(change, model)
+            self.publish(model)
+            return result
+
+    async def apply(self, op: str, data: Any = None) -> Any:
+        """
+        Journals a change and applies it to the model, see update.
+
+        Args:
+            op (str): Name of the change in OPERATIONS
+            data (Any): JSON-serializable arguments of the change
+
+        Returns:
+            Whatever the change returned
+        """
+        cache = CacheHandle.load()
+        def change(model: SearchModel) -> Any:
+            cache.record(op, data)
+            return OPERATIONS[op](model, data)
+        return await self.update(change)
+
+    def receive_feedback(self, events: list[FeedBack]) -> None:
+        """Journals feedback events and queues them for the next learn_pending."""
+        cache = CacheHandle.load()
+        cache.record("feedback", events)
+        cache.pending_feedback.extend(events)
+
+    @property
+    def pending_feedback(self) -> int:
+        """Number of feedback events waiting for learn_pending."""
+        return len(CacheHandle.load().pending_feedback)
+
+    @property
+    def unsaved_changes(self) -> int:
+        """Number of changes journaled since the last checkpoint."""
+        return CacheHandle.load().unsaved_changes
+
+    async def learn_pending(self) -> int:
+        """
+        Hands the feedback received so far to the model, see SearchModel.learn.
+
+        Returns:
+            Number of events the ranker was updated with
+        """
+        cache = CacheHandle.load()
+        pending = cache.pending_feedback
+        def change(model: SearchModel) -> int:
+            batch = pending[:]
+            learned = model.learn(batch)
+            # The batch stays pending for the next run when learn fails
+            cache.record("learn", len(batch))
+            del pending[:len(batch)]
+            return learned
+        return await self.update(change)
+
+    async def checkpoint(self) -> None:
+        """Saves the published model and the journal position it includes, see CacheHandle.checkpoint."""
+        cache = CacheHandle.load()
+        async with self.__checkpoint_lock:
+            # No change runs while the consistent view is taken
+            async with self.__lock:
+                state = (self.model, cache.journal_position, list(cache.pending_feedback))
+            await asyncio.to_thread(cache.checkpoint, *state)
+
+class ResultCache:
+    """
+    LRU cache of encoded search results, bounded by a memory budget and an optional TTL.
+
+    Entries are keyed on the normalized query text, the sorted filters, the paging
+    and engine options and the model version that produced them, and hold the
+    results already encoded as JSON so a hit costs neither a search nor an encode.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 0):
+        """
+        Args:
+            max_bytes (int): Memory budget for the cached entries
+            ttl (float): Seconds an entry stays valid, 0 to keep entries until evicted
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__size = 0
+        # key -> (encoded results, size in bytes, expiry time)
+        self.__entries: OrderedDict[tuple, tuple[str, int, float]] = OrderedDict()
+
+    @staticmethod
+    def key(query: SearchQuery, version: int) -> tuple:
+        """
+        Builds the cache key of a query.
+
+        Case and whitespace do not change what the vectorizer sees, and filters
+        match any of their tags, so both are normalized away.
+
+        Args:
+            query (SearchQuery): The search request
+            version (int): Version of the model answering it
+        """
+        text = " ".join(query["query"].lower().split())
+        filters = tuple(sorted(set(query.get("filters") or ())))
+        return (text, filters, query.get("limit"), query.get("offset", 0), query.get("engine"), version)
+
+    def get(self, key: tuple) -> Optional[str]:
+        """Returns the encoded results cached for a key, or None."""
+        entry = self.__entries.get(key)
+        if entry is not None and self.ttl > 0 and entry[2] < monotonic():
+            self.__discard(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: tuple, encoded: str) -> None:
+        """Caches encoded results, evicting the least recently used entries past the budget."""
+        size = sys.getsizeof(encoded) + sys.getsizeof(key[0])
+        if size > self.max_bytes:
+            return
+        if key in self.__entries:
+            self.__discard(key)
+        self.__entries[key] = (encoded, size, monotonic() + self.ttl)
+        self.__size += size
+        while self.__size > self.max_bytes:
+            self.__discard(next(iter(self.__entries)))
+            self.evictions += 1
+
+    def __discard(self, key: tuple) -> None:
+        self.__size -= self.__entries.pop(key)[1]
+
+    def clear(self) -> None:
+        """Drops every entry, e.g. when the model they came from is replaced."""
+        self.__entries.clear()
+        self.__size = 0
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Hit/miss/eviction counters and current usage."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.__entries),
+            "bytes": self.__size
+        }
+
+def get_model_holder() -> ModelHolder:
+    """
+    Retrieves the holder of the served model, loading the model from cache on first use.
+    
+    Returns:
+        The ModelHolder singleton
+    """
+    global holder
+    if holder is None:
+        cache = CacheHandle.load()
+        if "model" in cache:
+            model = cache.model
+        else:
+            error("No trained model stored Creating empty model will need retrain")
+            model = SearchModel([])
+            cache.model = model
+        holder = ModelHolder(model)
+    return holder
+
+def set_model_holder(replacement: ModelHolder) -> None:
+    """
+    Replaces the holder returned by get_model_holder.
+
+    Acceptor processes serve a snapshot pushed by their coordinator rather than the
+    cached model, through a holder with the same interface (see Acceptors).
+
+    Args:
+        replacement: The holder to return from now on
+    """
+    global holder
+    holder = replacement
+
+def get_model() -> Optional[SearchModel]:
     """
     Retrieves the trained model from cache.
     
     Returns:
         The trained model if available, None otherwise
     """
-    cache = CacheHandle.load()
-    if "model" in cache:
-        return cache.model
-    else:
-        error("No trained model stored Creating empty model will need retrain")
-        cache.model = SearchModel([])
-        return cache.model
+    return get_model_holder().model
 
 # Ensure cache is saved on program exit
 atexit.register(CacheHandle.unload)
@@ -1,4 +1,4 @@
-from typing import TypedDict,Optional,Literal,Union
+from typing import TypedDict,Optional,Literal,Union,NotRequired
 from os import PathLike
 # Define the basic data structures using TypedDict for type hinting
 class PageData(TypedDict):
@@ -24,13 +24,68 @@ class FeedBack(TypedDict):
         query (str): The search query entered by the user
         url (str): The URL of the page that was interacted with
         clicked (int): Indicates whether the user clicked on the result and found it relevant
+        trace (str): Trace id of the search response the result was in, joining the click to it in the query log
     """
     query: str
     url: str
     clicked: int
+    trace: NotRequired[str]
 class SearchQuery(TypedDict):
-    query:str
-    filters:Optional[list[str]]
+    """
+    A search request sent by a client over the /search websocket.
+
+    A connection stays open for any number of queries. Queries carrying an id are
+    answered with a SearchResponse as soon as they complete, possibly out of order.
+    A query with an id and a stream cancels the unanswered query of the same
+    stream, which is answered with a SearchResponse marked cancelled; queries
+    without a stream are never cancelled. Queries without an id get the bare
+    result list, as before sessions existed.
+
+    A batch request sets queries instead of query. Its queries share the other
+    options and are searched together; each one is answered with its own
+    SearchResponse carrying its index in the batch, as soon as it is ready.
+
+    Attributes:
+        query (str): The search text
+        queries (list[str]): Search texts of a batch request, at least one, used instead of query
+        filters (Optional[list[str]]): Only return pages tagged with at least one of these filters
+        limit (Optional[int]): Maximum number of results to return, all results when omitted
+        offset (int): Number of top results to skip, used to request the next page
+        engine (str): Retrieval engine to use instead of the model's default ("dense", "inverted" or "maxscore");
+            with a limit, maxscore only ranks the 100 best keyword matches (RERANK_DEPTH), or offset + limit
+            if more, so its results differ from those of inverted once the ranker is trained
+        id (Union[str, int]): Client chosen id echoed in the response
+        stream (str): Queries of one stream supersede each other, e.g. one per search box, only used with an id
+        trace (str): Trace id to record the query under in the query log instead of a generated one
+    """
+    query: NotRequired[str]
+    queries: NotRequired[list[str]]
+    filters: Optional[list[str]]
+    limit: NotRequired[Optional[int]]
+    offset: NotRequired[int]
+    engine: NotRequired[str]
+    id: NotRequired[Union[str, int]]
+    stream: NotRequired[str]
+    trace: NotRequired[str]
+
+class SearchResponse(TypedDict):
+    """
+    Answer to a SearchQuery that carried an id, or to one query of a batch request.
+
+    Attributes:
+        id (Union[str, int]): The id of the query, when it had one
+        index (int): Position of the answered query in a batch request
+        trace (str): Trace id of the query in the query log, to send back with FeedBack on its results
+        results (list[tuple[str, str, float]]): The (url, title, rank_score) results, when the search succeeded
+        error (str): Why the query was rejected, when it failed
+        cancelled (bool): True when a newer query of the same stream replaced the query before it was answered
+    """
+    id: NotRequired[Union[str, int]]
+    index: NotRequired[int]
+    trace: NotRequired[str]
+    results: NotRequired[list[tuple[str, str, float]]]
+    error: NotRequired[str]
+    cancelled: NotRequired[bool]
 
 class Setting:
     """Represents a configurable setting with name and value."""
@@ -98,3 +153,17 @@ class Setting:
             return int
         elif self.__type == "float":
             return float
+    def to_json(self) -> dict:
+        """Returns the setting as a JSON-serializable dict, see from_json."""
+        return {"name": self.name, "type": self.__type, "value": self.__value}
+    @classmethod
+    def from_json(cls, data: dict) -> 'Setting':
+        """
+        Recreates a setting saved with to_json.
+
+        Args:
+            data (dict): The saved name, type and raw value
+        """
+        setting = cls(data["name"], data["type"])
+        setting.value = data["value"]
+        return setting
@@ -0,0 +1,126 @@
+"""
+Append-only store of the feedback collected for the ranker.
+
+Feedback events arrive one click at a time and are only read in bulk when the
+ranker is trained. ``FeedbackStore`` therefore keeps them in columnar chunks of
+typed arrays, with queries and urls interned to integer ids, and remembers the
+(query, url, clicked) keys it holds in a hash set: recording an event is a few
+dictionary lookups and one row write, whatever the number of events before it.
+The events are only turned into a DataFrame by ``to_frame`` when training.
+"""
+
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterable, List, Set, Tuple
+
+ROW = np.dtype([("query", np.int32), ("url", np.int32), ("clicked", np.int8)])
+
+
+class FeedbackStore:
+    """De-duplicated feedback events stored in fixed-size columnar chunks."""
+
+    # Rows per chunk; a full chunk is never written again
+    CHUNK: int = 65536
+
+    def __init__(self) -> None:
+        """Create an empty store."""
+        self.__keys: Set[Tuple[int, int, int]] = set()
+        self.__query_ids: Dict[str, int] = {}
+        self.__queries: List[str] = []
+        self.__url_ids: Dict[str, int] = {}
+        self.__urls: List[str] = []
+        self.__chunks: List[np.ndarray] = []
+        self.__current: np.ndarray = np.empty(self.CHUNK, dtype=ROW)
+        self.__fill: int = 0
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame) -> 'FeedbackStore':
+        """Build a store from a DataFrame with query, url and clicked columns."""
+        store = cls()
+        for query, url, clicked in zip(frame["query"].tolist(), frame["url"].tolist(), frame["clicked"].tolist()):
+            store.add(query, url, clicked)
+        return store
+
+    @classmethod
+    def from_arrays(cls, queries: Iterable[str], urls: Iterable[str], rows: np.ndarray) -> 'FeedbackStore':
+        """Rebuild a store from the arrays returned by ``to_arrays``.
+
+        Args:
+            queries: Query strings, indexed by the query ids of the rows.
+            urls: Url strings, indexed by the url ids of the rows.
+            rows: Events in arrival order, with the ROW dtype.
+        """
+        store = cls()
+        store.__queries = list(queries)
+        store.__query_ids = {query: i for i, query in enumerate(store.__queries)}
+        store.__urls = list(urls)
+        store.__url_ids = {url: i for i, url in enumerate(store.__urls)}
+        store.__keys = set(zip(rows["query"].tolist(), rows["url"].tolist(), rows["clicked"].tolist()))
+        full = len(rows) // cls.CHUNK * cls.CHUNK
+        store.__chunks = [np.array(rows[start:start + cls.CHUNK]) for start in range(0, full, cls.CHUNK)]
+        store.__fill = len(rows) - full
+        store.__current[:store.__fill] = rows[full:]
+        return store
+
+    def to_arrays(self) -> Tuple[List[str], List[str], np.ndarray]:
+        """Return the store as (queries, urls, rows), see ``from_arrays``."""
+        return list(self.__queries), list(self.__urls), np.concatenate(self.__chunks + [self.__current[:self.__fill]])
+
+    def __len__(self) -> int:
+        return len(self.__chunks) * self.CHUNK + self.__fill
+
+    def add(self, query: str, url: str, clicked: int) -> bool:
+        """Record a feedback event unless an identical one was recorded before.
+
+        Args:
+            query: The search query that generated the results.
+            url: The url of the result the event is about.
+            clicked: 1 if the result was clicked, 0 otherwise.
+
+        Returns:
+            True if the event was new.
+        """
+        query_id = self.__intern(query, self.__query_ids, self.__queries)
+        url_id = self.__intern(url, self.__url_ids, self.__urls)
+        key = (query_id, url_id, int(clicked))
+        if key in self.__keys:
+            return False
+        self.__keys.add(key)
+        self.__current[self.__fill] = key
+        self.__fill += 1
+        if self.__fill == self.CHUNK:
+            self.__chunks.append(self.__current)
+            self.__current = np.empty(self.CHUNK, dtype=ROW)
+            self.__fill = 0
+        return True
+
+    @staticmethod
+    def __intern(value: str, ids: Dict[str, int], values: List[str]) -> int:
+        """Return the id of a string, assigning the next one if it is new."""
+        value_id = ids.setdefault(value, len(values))
+        if value_id == len(values):
+            values.append(value)
+        return value_id
+
+    def to_frame(self) -> pd.DataFrame:
+        """Return the events as a DataFrame with query, url and clicked columns, in arrival order."""
+        rows = np.concatenate(self.__chunks + [self.__current[:self.__fill]])
+        return pd.DataFrame({
+            "query": np.array(self.__queries, dtype=object)[rows["query"]] if len(rows) > 0 else np.empty(0, dtype=object),
+            "url": np.array(self.__urls, dtype=object)[rows["url"]] if len(rows) > 0 else np.empty(0, dtype=object),
+            "clicked": rows["clicked"].astype(np.int64)
+        })
+
+    def copy(self) -> 'FeedbackStore':
+        """Return a copy that can record events without affecting this store.
+
+        Full chunks are shared since they are never written again. The string ids
+        are shared too: they only ever grow, and ids a copy assigns are simply
+        unused by this store.
+        """
+        other = FeedbackStore.__new__(FeedbackStore)
+        other.__dict__.update(self.__dict__)
+        other.__keys = set(self.__keys)
+        other.__chunks = list(self.__chunks)
+        other.__current = self.__current.copy()
+        return other
@@ -0,0 +1,476 @@
+"""
+Inverted index over a fitted TF-IDF matrix.
+
+Each vocabulary term maps to a postings list holding the ids of the documents
+that contain it, sorted by id, and the document's normalized TF-IDF weight for
+that term. A query only touches the postings of its own terms, so the cost of
+scoring depends on how many documents match rather than on the corpus size.
+
+When only the best k documents are needed, ``InvertedIndex.top_k`` uses
+MaxScore-style dynamic pruning: per-term score upper bounds let it stop
+admitting new candidates once the remaining terms cannot lift an unseen
+document into the current top-k, and only probe the remaining postings for the
+documents that are still in contention.
+
+``SegmentedIndex`` lets the index grow as pages are added: new documents go
+to a small delta segment, so existing postings are not rebuilt on every edit.
+
+``FilterIndex`` plays the same role for the page filter tags: one sorted doc id
+array per tag, OR-combined at query time into the set of allowed documents.
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Return the positions of the k highest scores in descending order.
+
+    Only the selected k entries are sorted; the rest of the array is split off
+    with ``argpartition``. Equal scores keep their original relative order, so
+    the result is identical to the first k entries of a stable full sort.
+
+    Args:
+        scores: One-dimensional array of scores.
+        k: Number of positions to return.
+
+    Returns:
+        Array of at most k positions into ``scores``.
+    """
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.intp)
+    if k >= n:
+        return np.argsort(-scores, kind="stable")
+
+    # The k-th best score splits the array; ties on it are taken in position order
+    threshold = scores[np.argpartition(-scores, k - 1)[k - 1]]
+    above = np.flatnonzero(scores > threshold)
+    ties = np.flatnonzero(scores == threshold)[:k - len(above)]
+    selected = np.concatenate([above, ties])
+    return selected[np.lexsort((selected, -scores[selected]))]
+
+
+class InvertedIndex:
+    """Postings lists built from the rows of an L2-normalized TF-IDF matrix."""
+
+    def __init__(self, matrix: csr_matrix, first_doc: int = 0,
+                 max_weights: Optional[np.ndarray] = None) -> None:
+        """Build the postings lists for every term of the matrix.
+
+        Args:
+            matrix: Document-term TF-IDF matrix as produced by ``TfidfVectorizer``,
+                with one L2-normalized row per document. A CSC matrix with sorted
+                indices is used as is, without copying.
+            first_doc: Doc id of the matrix's first row, when it only holds a
+                segment of the corpus.
+            max_weights: Precomputed per-term maximum weights, see ``max_weights``.
+        """
+        postings = matrix.tocsc()
+        postings.sort_indices()
+        self.__postings = postings
+        self.__first_doc: int = first_doc
+        self.__num_docs: int = matrix.shape[0]
+        self.__indptr: np.ndarray = postings.indptr
+        self.__doc_ids: np.ndarray = postings.indices if first_doc == 0 else postings.indices + first_doc
+        self.__weights: np.ndarray = postings.data
+        # Largest weight in each postings list, the per-term score upper bound
+        if max_weights is None:
+            max_weights = np.zeros(len(self.__indptr) - 1)
+            non_empty = np.flatnonzero(np.diff(self.__indptr))
+            if len(non_empty) > 0:
+                max_weights[non_empty] = np.maximum.reduceat(self.__weights, self.__indptr[non_empty])
+        self.__max_weights: np.ndarray = max_weights
+
+    @property
+    def num_docs(self) -> int:
+        """Number of documents covered by the index."""
+        return self.__num_docs
+
+    @property
+    def first_doc(self) -> int:
+        """Doc id of the first document covered by the index."""
+        return self.__first_doc
+
+    @property
+    def postings_matrix(self):
+        """The postings as a document-term CSC matrix, rows relative to first_doc."""
+        return self.__postings
+
+    @property
+    def max_weights(self) -> np.ndarray:
+        """Largest weight of each term's postings list."""
+        return self.__max_weights
+
+    @property
+    def num_terms(self) -> int:
+        """Number of terms, i.e. postings lists, in the index."""
+        return len(self.__indptr) - 1
+
+    def postings(self, term: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the postings list of a term.
+
+        Args:
+            term: Column index of the term in the vectorizer vocabulary.
+
+        Returns:
+            Tuple of (doc_ids, weights) sorted by document id.
+        """
+        start, end = self.__indptr[term], self.__indptr[term + 1]
+        return self.__doc_ids[start:end], self.__weights[start:end]
+
+    def score(self, query_vector: csr_matrix,
+              allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Compute the cosine similarity of a query with every matching document.
+
+        Args:
+            query_vector: 1 x n_terms TF-IDF vector of the query.
+            allowed: Optional boolean mask over all documents; documents outside it
+                are never scored.
+
+        Returns:
+            Tuple of (doc_ids, similarities) for the documents sharing at least
+            one term with the query, sorted by document id.
+        """
+        terms, query_weights = self.__query_terms(query_vector)
+        if len(terms) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float64)
+
+        # Term-at-a-time: concatenate the query terms' postings, then sum per document
+        starts = self.__indptr[terms]
+        ends = self.__indptr[terms + 1]
+        positions = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+        contributions = self.__weights[positions] * np.repeat(query_weights, ends - starts)
+        matches = self.__doc_ids[positions]
+        if allowed is not None:
+            keep = allowed[matches]
+            matches, contributions = matches[keep], contributions[keep]
+        doc_ids, slots = np.unique(matches, return_inverse=True)
+        return doc_ids, np.bincount(slots, weights=contributions, minlength=len(doc_ids))
+
+    def top_k(self, query_vector: csr_matrix, k: int,
+              allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the k documents most similar to a query without scoring every match.
+
+        Terms are visited by decreasing score upper bound. Once the bounds of the
+        terms left to visit add up to less than the current k-th best score, no
+        unseen document can make it into the top-k: the remaining postings are
+        then only probed for the documents already collected, and candidates that
+        can no longer reach the threshold are dropped.
+
+        Args:
+            query_vector: 1 x n_terms TF-IDF vector of the query.
+            k: Number of documents to return.
+            allowed: Optional boolean mask over all documents; documents outside it
+                are never scored.
+
+        Returns:
+            Tuple of (doc_ids, similarities) of at most k documents, best first.
+            Ties are ordered by document id, as in ``score`` followed by ``top_k``.
+        """
+        terms, query_weights = self.__query_terms(query_vector)
+        if len(terms) == 0 or k <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float64)
+
+        bounds = query_weights * self.__max_weights[terms]
+        order = np.argsort(-bounds, kind="stable")
+        terms, query_weights, bounds = terms[order], query_weights[order], bounds[order]
+        # remaining[i] bounds what terms i.. can still add to a document's score
+        remaining = np.cumsum(bounds[::-1])[::-1]
+        # Slack so float rounding in the accumulated scores never prunes an exact tie
+        slack = 1e-9
+
+        doc_ids = np.empty(0, dtype=self.__doc_ids.dtype)
+        scores = np.empty(0, dtype=np.float64)
+        for i, (term, weight) in enumerate(zip(terms, query_weights)):
+            postings, weights = self.postings(term)
+            threshold = self.__threshold(scores, k)
+            if remaining[i] + slack >= threshold:
+                # Unseen documents can still qualify: merge the whole postings list
+                if allowed is not None:
+                    keep = allowed[postings]
+                    postings, weights = postings[keep], weights[keep]
+                doc_ids, scores = self.__merge(doc_ids, scores, postings, weights * weight)
+            else:
+                # Only existing candidates can qualify: look them up in the postings
+                positions = np.searchsorted(postings, doc_ids)
+                positions[positions == len(postings)] = 0
+                found = postings[positions] == doc_ids if len(postings) > 0 else np.zeros(len(doc_ids), dtype=bool)
+                scores[found] += weights[positions[found]] * weight
+
+            # Drop candidates that cannot reach the threshold with the terms left
+            left = remaining[i + 1] if i + 1 < len(remaining) else 0.0
+            threshold = self.__threshold(scores, k)
+            if threshold > 0:
+                keep = scores + left + slack >= threshold
+                doc_ids, scores = doc_ids[keep], scores[keep]
+
+        best = top_k(scores, k)
+        return doc_ids[best], scores[best]
+
+    def __query_terms(self, query_vector: csr_matrix) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the query's terms and their L2-normalized weights."""
+        terms = query_vector.indices
+        query_weights = query_vector.data
+        norm = np.sqrt(np.dot(query_weights, query_weights))
+        if len(terms) == 0 or norm == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float64)
+        return terms, query_weights / norm
+
+    @staticmethod
+    def __merge(doc_ids: np.ndarray, scores: np.ndarray,
+                postings: np.ndarray, contributions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Add a postings list's contributions into the sorted candidate accumulators."""
+        merged = np.concatenate([doc_ids, postings])
+        if len(merged) == 0:
+            return doc_ids, scores
+        # Both inputs are sorted, which the stable sort merges in linear time
+        order = np.argsort(merged, kind="stable")
+        merged = merged[order]
+        contributions = np.concatenate([scores, contributions])[order]
+        starts = np.flatnonzero(np.concatenate([[True], merged[1:] != merged[:-1]]))
+        return merged[starts], np.add.reduceat(contributions, starts)
+
+    @staticmethod
+    def __threshold(scores: np.ndarray, k: int) -> float:
+        """Return the k-th best score collected so far, 0 while fewer than k are known."""
+        if len(scores) < k:
+            return 0.0
+        return float(np.partition(scores, len(scores) - k)[len(scores) - k])
+
+
+class SegmentedIndex:
+    """Inverted index that grows by appending documents without rebuilding existing postings.
+
+    Appended rows form a delta segment, rebuilt from those rows alone on the next
+    lookup. Once the delta outgrows MERGE_RATIO of the base segment the two are
+    merged, so the delta stays small and merges stay rare.
+    """
+
+    # Delta size, relative to the base segment, at which the segments are merged
+    MERGE_RATIO: float = 0.1
+
+    def __init__(self, base: InvertedIndex) -> None:
+        """Start from an index of the current corpus.
+
+        Args:
+            base: Index covering every document so far.
+        """
+        self.__base: InvertedIndex = base
+        self.__delta: Optional[InvertedIndex] = None
+        self.__delta_rows: List[csr_matrix] = []
+        self.__num_docs: int = base.num_docs
+
+    @property
+    def num_docs(self) -> int:
+        """Number of documents covered by the index."""
+        return self.__num_docs
+
+    def copy(self) -> 'SegmentedIndex':
+        """Return a copy that can be extended without affecting this index.
+
+        Segments are never changed once built, so they are shared with the copy.
+        """
+        other = SegmentedIndex.__new__(SegmentedIndex)
+        other.__base = self.__base
+        other.__delta = self.__delta
+        other.__delta_rows = list(self.__delta_rows)
+        other.__num_docs = self.__num_docs
+        return other
+
+    def extend(self, rows: csr_matrix) -> None:
+        """Append documents after all indexed ones.
+
+        Args:
+            rows: TF-IDF rows of the new documents, vectorized with the same vocabulary.
+        """
+        self.__delta_rows.append(rows)
+        self.__delta = None
+        self.__num_docs += rows.shape[0]
+
+    def __segments(self) -> List[InvertedIndex]:
+        """Return the segments to search, folding pending rows into the delta first."""
+        if self.__delta is None and len(self.__delta_rows) > 0:
+            delta = vstack(self.__delta_rows, format="csr")
+            if delta.shape[0] > self.MERGE_RATIO * self.__base.num_docs:
+                self.__base = InvertedIndex(vstack([self.__base.postings_matrix, delta], format="csc"))
+                self.__delta_rows = []
+            else:
+                self.__delta_rows = [delta]
+                self.__delta = InvertedIndex(delta, first_doc=self.__base.num_docs)
+        return [self.__base] if self.__delta is None else [self.__base, self.__delta]
+
+    def score(self, query_vector: csr_matrix,
+              allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Compute the cosine similarity of a query with every matching document.
+
+        See ``InvertedIndex.score``.
+        """
+        results = [segment.score(query_vector, allowed) for segment in self.__segments()]
+        if len(results) == 1:
+            return results[0]
+        # Segments cover consecutive doc id ranges, so the concatenation stays sorted
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+    def top_k(self, query_vector: csr_matrix, k: int,
+              allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the k documents most similar to a query without scoring every match.
+
+        See ``InvertedIndex.top_k``. Each segment is pruned on its own and the
+        per-segment winners are merged.
+        """
+        results = [segment.top_k(query_vector, k, allowed) for segment in self.__segments()]
+        if len(results) == 1:
+            return results[0]
+        doc_ids = np.concatenate([r[0] for r in results])
+        scores = np.concatenate([r[1] for r in results])
+        by_doc = np.argsort(doc_ids, kind="stable")
+        doc_ids, scores = doc_ids[by_doc], scores[by_doc]
+        best = top_k(scores, k)
+        return doc_ids[best], scores[best]
+
+
+class FilterIndex:
+    """Sorted doc id arrays per filter tag, used to restrict a search before scoring."""
+
+    def __init__(self, filters: Iterable[Optional[List[str]]] = ()) -> None:
+        """Index the filter tags of a sequence of documents.
+
+        Args:
+            filters: Filter tag list of each document, in doc id order. Entries
+                that are not lists (missing filters) tag nothing.
+        """
+        grouped: Dict[str, List[int]] = {}
+        num_docs = 0
+        for doc_id, tags in enumerate(filters):
+            num_docs += 1
+            if isinstance(tags, (list, tuple)):
+                for tag in set(tags):
+                    grouped.setdefault(tag, []).append(doc_id)
+        self.__num_docs: int = num_docs
+        self.__doc_ids: Dict[str, np.ndarray] = {
+            tag: np.array(doc_ids, dtype=np.intp) for tag, doc_ids in grouped.items()
+        }
+        # Tags of appended documents, folded into __doc_ids on the next lookup
+        self.__pending: Dict[str, List[int]] = {}
+
+    @property
+    def num_docs(self) -> int:
+        """Number of documents covered by the index."""
+        return self.__num_docs
+
+    @classmethod
+    def from_arrays(cls, tags: List[str], doc_ids: np.ndarray, offsets: np.ndarray,
+                    num_docs: int) -> 'FilterIndex':
+        """Rebuild an index from the arrays returned by ``to_arrays``, without copying them.
+
+        Args:
+            tags: Filter tags.
+            doc_ids: Sorted doc ids of every tag, back to back.
+            offsets: len(tags) + 1 positions, tag i owns doc_ids[offsets[i]:offsets[i + 1]].
+            num_docs: Number of documents covered by the index.
+        """
+        index = cls.__new__(cls)
+        index.__num_docs = num_docs
+        index.__doc_ids = {tag: doc_ids[offsets[i]:offsets[i + 1]] for i, tag in enumerate(tags)}
+        index.__pending = {}
+        return index
+
+    def to_arrays(self, num_docs: Optional[int] = None) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        """Return the index as (tags, doc_ids, offsets), see ``from_arrays``.
+
+        Args:
+            num_docs: Only cover the documents before this doc id, all of them when None.
+        """
+        tags = sorted(set(self.__doc_ids) | set(self.__pending))
+        arrays = []
+        for tag in tags:
+            existing = self.__doc_ids.get(tag, np.empty(0, dtype=np.intp))
+            array = np.concatenate([existing, np.array(self.__pending.get(tag, []), dtype=np.intp)])
+            arrays.append(array if num_docs is None else array[:np.searchsorted(array, num_docs)])
+        offsets = np.zeros(len(tags) + 1, dtype=np.int64)
+        np.cumsum([len(array) for array in arrays], out=offsets[1:])
+        doc_ids = np.concatenate(arrays) if len(arrays) > 0 else np.empty(0, dtype=np.intp)
+        return tags, doc_ids, offsets
+
+    def tags_from(self, first_doc: int) -> List[List[str]]:
+        """Return the filter tags of each document from a doc id on, the inverse of ``add``.
+
+        Only the tail of each tag's doc ids is read, so this costs the size of
+        those documents rather than that of the index.
+        """
+        tags: List[List[str]] = [[] for _ in range(self.__num_docs - first_doc)]
+        for tag in sorted(set(self.__doc_ids) | set(self.__pending)):
+            existing = self.__doc_ids.get(tag, np.empty(0, dtype=np.intp))
+            for doc_id in existing[np.searchsorted(existing, first_doc):].tolist():
+                tags[doc_id - first_doc].append(tag)
+            for doc_id in self.__pending.get(tag, []):
+                if doc_id >= first_doc:
+                    tags[doc_id - first_doc].append(tag)
+        return tags
+
+    def copy(self) -> 'FilterIndex':
+        """Return a copy that can be extended without affecting this index."""
+        other = FilterIndex.__new__(FilterIndex)
+        other.__num_docs = self.__num_docs
+        other.__doc_ids = dict(self.__doc_ids)
+        other.__pending = {tag: list(doc_ids) for tag, doc_ids in self.__pending.items()}
+        return other
+
+    def add(self, tags: Optional[List[str]]) -> int:
+        """Index the filter tags of a new document placed after all existing ones.
+
+        Args:
+            tags: Filter tags of the new document.
+
+        Returns:
+            The doc id given to the document.
+        """
+        doc_id = self.__num_docs
+        self.__num_docs += 1
+        if isinstance(tags, (list, tuple)):
+            for tag in set(tags):
+                self.__pending.setdefault(tag, []).append(doc_id)
+        return doc_id
+
+    def tag_doc_ids(self, tag: str) -> np.ndarray:
+        """Return the sorted ids of the documents carrying a tag."""
+        pending = self.__pending.pop(tag, None)
+        if pending:
+            # Appended ids are larger than every indexed one, so the array stays sorted
+            existing = self.__doc_ids.get(tag, np.empty(0, dtype=np.intp))
+            self.__doc_ids[tag] = np.concatenate([existing, np.array(pending, dtype=np.intp)])
+        return self.__doc_ids.get(tag, np.empty(0, dtype=np.intp))
+
+    def doc_ids(self, filters: List[str]) -> np.ndarray:
+        """Return the sorted ids of the documents carrying any of the given tags.
+
+        Args:
+            filters: Filter tags requested by the query.
+
+        Returns:
+            Sorted array of unique doc ids.
+        """
+        arrays = [self.tag_doc_ids(tag) for tag in set(filters)]
+        arrays = [array for array in arrays if len(array) > 0]
+        if len(arrays) == 0:
+            return np.empty(0, dtype=np.intp)
+        if len(arrays) == 1:
+            return arrays[0]
+        return np.unique(np.concatenate(arrays))
+
+    def mask(self, filters: List[str], num_docs: int) -> np.ndarray:
+        """Return a boolean mask of the documents carrying any of the given tags.
+
+        Args:
+            filters: Filter tags requested by the query.
+            num_docs: Length of the mask; doc ids beyond it are ignored.
+
+        Returns:
+            Boolean array with one entry per document.
+        """
+        mask = np.zeros(num_docs, dtype=bool)
+        doc_ids = self.doc_ids(filters)
+        mask[doc_ids[doc_ids < num_docs]] = True
+        return mask
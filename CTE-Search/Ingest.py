@@ -0,0 +1,280 @@
+"""
+Ingest.py - Streaming bulk ingestion of page dumps and feedback logs
+
+Pages and feedback can be loaded in bulk from JSON files holding an array of
+records (like pages.json and data.json) or from JSON Lines files (one record per
+line, like requests.jsonl). Files are parsed incrementally, a line or a chunk of
+text at a time, so memory holds one chunk and one batch of records rather than
+the file. A JSON Lines line that does not parse counts as an invalid record.
+
+Records are validated against PageData / FeedBack and de-duplicated (pages on
+their url and title, feedback on the whole event). Pages are added to an
+existing model in batches through SearchModel.extend_pages; when there is no
+model yet, the batches are accumulated column by column and the model is built
+once at the end, with the vocabulary fitted on every page. Progress is reported
+through a callback after every batch.
+"""
+
+import json
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, TextIO, Tuple
+import pandas as pd
+from DataTypes import PageData, FeedBack
+from Model import SearchModel
+
+# Characters read from the file at a time
+CHUNK_SIZE = 1 << 20
+# Records handed to the model at a time
+BATCH_SIZE = 10000
+
+class IngestReport:
+    """Counters of a running or finished ingestion."""
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): The file being ingested
+        """
+        self.path = path
+        self.read = 0
+        self.added = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.__start = perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds since the ingestion started."""
+        return perf_counter() - self.__start
+
+    @property
+    def rate(self) -> float:
+        """Records read per second."""
+        return self.read / max(self.elapsed, 1e-9)
+
+    def __str__(self) -> str:
+        return (f"{self.path}: {self.read} read, {self.added} added, {self.duplicates} duplicates, "
+                f"{self.invalid} invalid in {self.elapsed:.1f}s ({self.rate:.0f} records/s)")
+
+class InvalidLine:
+    """A line of a JSON Lines file that does not parse, yielded by iter_records in place of its record."""
+    def __init__(self, number: int, reason: str):
+        """
+        Args:
+            number (int): Line number in the file, from 1
+            reason (str): Why the line does not parse
+        """
+        self.number = number
+        self.reason = reason
+
+    def __str__(self) -> str:
+        return f"Line {self.number} is not valid JSON: {self.reason}"
+
+def iter_records(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[Any]:
+    """
+    Yields the records of a JSON array file or a JSON Lines file one by one.
+
+    A JSON Lines file is read line by line. A line that does not parse is yielded
+    as an InvalidLine, which validate_page and validate_feedback reject, and the
+    following lines are read as usual.
+
+    Args:
+        path (str): File holding a JSON array of records, or one JSON record per line
+        chunk_size (int): Characters of a JSON array file read at a time
+
+    Raises:
+        ValueError: If a JSON array file is not valid JSON
+    """
+    with open(path, encoding="utf-8") as file:
+        first = file.read(1)
+        while first.isspace():
+            first = file.read(1)
+        if first == "[":
+            yield from __iter_array(path, file, chunk_size)
+            return
+        file.seek(0)
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                yield InvalidLine(number, str(e))
+
+def __iter_array(path: str, file: TextIO, chunk_size: int) -> Iterator[Any]:
+    """Yields the records of a JSON array file, read from just after its opening bracket."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+    while True:
+        # Skip the separators between records
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position < len(buffer) and buffer[position] == "]":
+            return
+        if position < len(buffer):
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+                # A number may continue in the next chunk ("12" of "12e3"), only a separator ends it for sure
+                if eof or (end < len(buffer) and buffer[end] in " \t\r\n,]"):
+                    position = end
+                    yield record
+                    continue
+            except json.JSONDecodeError as e:
+                # Most likely a record cut at the end of the chunk
+                if eof:
+                    raise ValueError(f"Invalid JSON in {path}: {str(e)}") from e
+        elif eof:
+            raise ValueError(f"Invalid JSON in {path}: the array is not closed")
+        text = file.read(chunk_size)
+        eof = text == ""
+        buffer = buffer[position:] + text
+        position = 0
+
+def validate_page(record: Any) -> PageData:
+    """
+    Checks a record is a page.
+
+    Args:
+        record (Any): A parsed JSON record
+
+    Returns:
+        PageData: The page, without any unknown fields
+
+    Raises:
+        ValueError: If a field is missing or has the wrong type
+    """
+    if isinstance(record, InvalidLine):
+        raise ValueError(str(record))
+    if not isinstance(record, dict):
+        raise ValueError("A page must be an object")
+    for field in ("url", "title", "content"):
+        if not isinstance(record.get(field), str):
+            raise ValueError(f"Page field {field} must be a string")
+    filters = record.get("filters") or []
+    if not isinstance(filters, list) or not all(isinstance(tag, str) for tag in filters):
+        raise ValueError("Page filters must be a list of strings")
+    return PageData(url=record["url"], title=record["title"], content=record["content"], filters=filters)
+
+def validate_feedback(record: Any) -> FeedBack:
+    """
+    Checks a record is a feedback event.
+
+    Args:
+        record (Any): A parsed JSON record
+
+    Returns:
+        FeedBack: The feedback, without any unknown fields, with its trace id when it has one
+
+    Raises:
+        ValueError: If a field is missing or has the wrong type
+    """
+    if isinstance(record, InvalidLine):
+        raise ValueError(str(record))
+    if not isinstance(record, dict):
+        raise ValueError("Feedback must be an object")
+    for field in ("query", "url"):
+        if not isinstance(record.get(field), str):
+            raise ValueError(f"Feedback field {field} must be a string")
+    if record.get("clicked") not in (0, 1):
+        raise ValueError("Feedback field clicked must be 0 or 1")
+    feedback = FeedBack(query=record["query"], url=record["url"], clicked=int(record["clicked"]))
+    if "trace" in record:
+        if not isinstance(record["trace"], str):
+            raise ValueError("Feedback field trace must be a string")
+        feedback["trace"] = record["trace"]
+    return feedback
+
+def ingest_pages(path: str, model: Optional[SearchModel] = None, batch_size: int = BATCH_SIZE,
+                 progress: Optional[Callable[[IngestReport], None]] = None,
+                 **options) -> Tuple[SearchModel, IngestReport]:
+    """
+    Adds the pages of a file to a model, or builds a model from them.
+
+    Args:
+        path (str): JSON or JSON Lines file of PageData records
+        model (Optional[SearchModel]): Model to extend in place, None to build a new one
+        batch_size (int): Pages validated and added at a time
+        progress (Optional[Callable[[IngestReport], None]]): Called after every batch
+        **options: SearchModel options (engine, ranker) of a new model
+
+    Returns:
+        Tuple[SearchModel, IngestReport]: The model holding the pages and the ingestion counters
+    """
+    report = IngestReport(path)
+    seen_urls = set()
+    seen_titles = set()
+    # Pages are kept column by column, never as one dict per page
+    columns: Dict[str, List[Any]] = {"url": [], "title": [], "content": [], "filters": []}
+    for record in iter_records(path):
+        report.read += 1
+        try:
+            page = validate_page(record)
+        except ValueError:
+            report.invalid += 1
+            continue
+        if page["url"] in seen_urls or page["title"] in seen_titles:
+            report.duplicates += 1
+            continue
+        seen_urls.add(page["url"])
+        seen_titles.add(page["title"])
+        for field, values in columns.items():
+            values.append(page[field])
+        if model is None:
+            report.added += 1
+        elif len(columns["url"]) >= batch_size:
+            add_batch(model, columns, report)
+        if report.read % batch_size == 0 and progress is not None:
+            progress(report)
+
+    if model is None:
+        model = SearchModel(pd.DataFrame(columns), **options)
+    elif len(columns["url"]) > 0:
+        add_batch(model, columns, report)
+    if progress is not None:
+        progress(report)
+    return model, report
+
+def add_batch(model: SearchModel, columns: Dict[str, List[Any]], report: IngestReport) -> None:
+    """Add a batch of page columns to a model and empty them."""
+    batch = len(columns["url"])
+    added = model.extend_pages(pd.DataFrame(columns))
+    report.added += added
+    report.duplicates += batch - added
+    for values in columns.values():
+        values.clear()
+
+def ingest_feedback(path: str, model: SearchModel, batch_size: int = BATCH_SIZE,
+                    progress: Optional[Callable[[IngestReport], None]] = None) -> IngestReport:
+    """
+    Records the feedback of a file in a model.
+
+    The ranker is not retrained, see SearchModel.retrain.
+
+    Args:
+        path (str): JSON or JSON Lines file of FeedBack records
+        model (SearchModel): Model to record the feedback in
+        batch_size (int): Records between two progress reports
+        progress (Optional[Callable[[IngestReport], None]]): Called after every batch
+
+    Returns:
+        IngestReport: The ingestion counters
+    """
+    report = IngestReport(path)
+    for record in iter_records(path):
+        report.read += 1
+        try:
+            feedback = validate_feedback(record)
+        except ValueError:
+            report.invalid += 1
+            continue
+        if model.append_feedback(feedback["query"], feedback):
+            report.added += 1
+        else:
+            report.duplicates += 1
+        if report.read % batch_size == 0 and progress is not None:
+            progress(report)
+    if progress is not None:
+        progress(report)
+    return report
@@ -0,0 +1,122 @@
+"""
+Journal.py - Write-ahead log of the changes made to the cached model and settings
+
+Every change (a page added or removed, feedback received, a retrain, new
+settings) is appended to the journal before it is applied, as one line holding
+its sequence number, operation name and JSON data, prefixed with the CRC-32 of
+the line. Appending costs the size of the change, whatever the size of the model.
+
+A checkpoint saves the model and settings in full, together with the sequence
+number of the last change they include, and then truncates the journal up to
+that number. After a crash the last checkpoint is loaded and the changes
+journaled since are replayed in order. A line cut short by the crash fails its
+checksum and is dropped, along with anything after it.
+"""
+
+import json
+import os
+import threading
+import zlib
+from typing import Any, Iterator, List, Optional, Tuple
+from LogManager import *
+
+class Journal:
+    """Append-only log of numbered changes, see the module docstring."""
+    def __init__(self, path: str, position: int = 0, sync: bool = False):
+        """
+        Opens a journal, creating it if needed and dropping any torn tail.
+
+        Args:
+            path (str): The journal file
+            position (int): Sequence number of the last change already saved by a checkpoint
+            sync (bool): fsync every append, so changes also survive a power loss and not just a crash
+        """
+        self.path = path
+        self.sync = sync
+        self.__lock = threading.Lock()
+        self.__records: List[Tuple[int, str, Any]] = []
+        valid = 0
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                for line in file:
+                    record = self.__decode(line)
+                    if record is None:
+                        warning(f"Dropping the torn end of the journal {path} after {len(self.__records)} changes")
+                        break
+                    self.__records.append(record)
+                    valid += len(line)
+        self.position = max([position] + [seq for seq, _, _ in self.__records])
+        self.__file = open(path, "ab")
+        self.__file.truncate(valid)
+        self.__file.seek(valid)
+
+    @staticmethod
+    def __decode(line: bytes) -> Optional[Tuple[int, str, Any]]:
+        """Returns the (seq, op, data) of a journal line, or None if it is incomplete or corrupted."""
+        try:
+            crc, payload = line.rstrip(b"\n").split(b" ", 1)
+            if not line.endswith(b"\n") or int(crc, 16) != zlib.crc32(payload):
+                return None
+            seq, op, data = json.loads(payload)
+            return seq, op, data
+        except (ValueError, TypeError):
+            return None
+
+    def append(self, op: str, data: Any = None) -> int:
+        """
+        Records a change before it is applied.
+
+        Args:
+            op (str): Name of the operation
+            data (Any): JSON-serializable arguments of the operation
+
+        Returns:
+            int: Sequence number of the change
+        """
+        with self.__lock:
+            seq = self.position + 1
+            payload = json.dumps([seq, op, data]).encode("utf-8")
+            self.__file.write(b"%08x %s\n" % (zlib.crc32(payload), payload))
+            self.__file.flush()
+            if self.sync:
+                os.fsync(self.__file.fileno())
+            self.position = seq
+            return seq
+
+    def replay(self, after: int = 0) -> Iterator[Tuple[int, str, Any]]:
+        """Yields the (seq, op, data) of the changes that were in the journal when it was opened, after a sequence number."""
+        return ((seq, op, data) for seq, op, data in self.__records if seq > after)
+
+    @property
+    def size(self) -> int:
+        """Size of the journal file in bytes."""
+        with self.__lock:
+            return self.__file.tell()
+
+    def truncate(self, position: int) -> None:
+        """
+        Drops the changes up to a sequence number, once a checkpoint has saved them.
+
+        The changes after it are copied to a new file which atomically replaces the journal.
+
+        Args:
+            position (int): Sequence number of the last change saved by the checkpoint
+        """
+        with self.__lock:
+            self.__file.flush()
+            with open(self.path, "rb") as file:
+                kept = [line for line in file if (self.__decode(line) or (0,))[0] > position]
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "wb") as file:
+                file.writelines(kept)
+                file.flush()
+                os.fsync(file.fileno())
+            self.__file.close()
+            os.replace(temporary, self.path)
+            self.__file = open(self.path, "ab")
+            self.__records = [record for record in self.__records if record[0] > position]
+
+    def close(self) -> None:
+        """Flushes and closes the journal file."""
+        with self.__lock:
+            self.__file.close()
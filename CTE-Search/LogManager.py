@@ -2,165 +2,404 @@
 LogManager.py - Custom logging module for CTE-Search application
 
 This module provides a custom logging implementation with the following features:
-- Daily rotating log files stored in a 'logs' directory
-- Asynchronous log file handler updates
-- Log level set to DEBUG
+- Logging calls only enqueue a record; a dedicated writer thread formats them,
+  writes them in batches and flushes, so the event loop never waits on disk I/O
+- Log files stored in a 'logs' directory, rotated daily and whenever they reach
+  MAX_BYTES, rotated files optionally gzip-compressed
+- Per-level sampling and per-site rate limits for hot debug lines
 - Formatted log messages with timestamp, level, and message
-- Global logger instance with convenience methods for different log levels
+- Global convenience functions for the different log levels
 - Custom error callbacks for handling log messages
+- Usable at any time: records logged before logger_loop() starts are kept and written
+- Usable in forked child processes, which get a writer of their own and may log
+  to files of their own (see set_prefix)
+- The writer thread, LogWriter, can write records of other kinds to files of
+  their own, as QueryLog does
 
-The log files are named in the format: logs/cte_search_YYYYMMDD.log
+The log files are named in the format: logs/cte_search_YYYYMMDD.log, rotated
+ones logs/cte_search_YYYYMMDD.N.log.gz
 
 Functions:
-    logger_loop() - Initializes and maintains the logger
-    update_file_handler() - Updates log file handler when date changes
+    logger_loop() - Starts the writer and keeps an eye on the date for rotation
+    update_file_handler() - Asks the writer to rotate the log file if the date changed
     info(msg) - Logs an info message
     debug(msg) - Logs a debug message
     warning(msg) - Logs a warning message
     error(msg) - Logs an error message
     critical(msg) - Logs a critical message
     add_error_callback(callback) - Adds a callback function for error handling
+    set_level(level) - Drops the messages below a level
+    set_sample_rate(level, rate) - Keeps only a share of the messages of a level
+    set_rate_limit(site, per_second) - Limits the messages logged from a site
+    set_prefix(prefix) - Names the log files of this process
+    flush() - Waits until every queued message is written
 """
 
-from logging import Logger, FileHandler, Formatter
+import atexit
+import gzip
 import os
-from datetime import datetime
+import shutil
+import sys
 import asyncio
-from typing import Callable, List
+from datetime import datetime
+from queue import Empty, SimpleQueue
+from threading import Event, Lock, Thread
+from time import monotonic, time
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-# Create logs directory if it doesn't exist
-os.makedirs('logs', exist_ok=True)
+__all__ = ["logger_loop", "update_file_handler", "info", "debug", "warning", "error", "critical",
+           "add_error_callback", "set_level", "set_sample_rate", "set_rate_limit", "set_prefix", "flush"]
 
-# Setup logger
-__LOGGER = Logger('CTE-Search') # We use caps for constance in python
-__LOGGER.setLevel('DEBUG')
+LOG_DIR = "logs"
+# Size in bytes at which the current log file is rotated
+MAX_BYTES = 16 * 1024 * 1024
+# Whether rotated log files are gzip-compressed
+COMPRESS = True
+# Records written per batch before the file is flushed
+BATCH_SIZE = 512
+# Records waiting to be written beyond which new ones are dropped rather than use unbounded memory
+MAX_PENDING = 100000
+# Default number of messages per second a rate-limited site may log
+SITE_RATE = 10.0
 
-# Create formatters and handlers
-formatter = Formatter('[%(asctime)s] - %(levelname)s - %(message)s')
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
 
-# File handler with dynamic name
-__current_date = None
-__file_handler = None
-__ready = False
+__min_level = LEVELS["DEBUG"]
+# level -> keep one message in this many, and the number seen so far
+__sampling: Dict[str, int] = {}
+__sampled: Dict[str, int] = {}
+# site -> messages per second, and its token bucket (tokens, last refill, suppressed count)
+__site_rates: Dict[str, float] = {}
+__site_buckets: Dict[str, List[float]] = {}
+__dropped = 0
 __error_callbacks: List[Callable[[str], None]] = []
 
+def __format(created: float, level: str, msg: str) -> str:
+    """Formats a record as [2024-01-31 12:00:00,123] - LEVEL - message."""
+    stamp = datetime.fromtimestamp(created)
+    return f"[{stamp:%Y-%m-%d %H:%M:%S},{stamp.microsecond // 1000:03d}] - {level} - {msg}\n"
+
+class LogFile:
+    """The current file of a log writer thread, rotated by date and size."""
+    def __init__(self, prefix: str = "cte_search", extension: str = "log"):
+        """
+        Args:
+            prefix (str): Name of the log files before their date
+            extension (str): Extension of the log files
+        """
+        self.prefix = prefix
+        self.extension = extension
+        self.date: Optional[str] = None
+        self.file = None
+
+    def path(self, date: str, part: Optional[int] = None) -> str:
+        name = f"{self.prefix}_{date}" if part is None else f"{self.prefix}_{date}.{part}"
+        return os.path.join(LOG_DIR, f"{name}.{self.extension}")
+
+    def write(self, text: str) -> None:
+        date = datetime.now().strftime("%Y%m%d")
+        if date != self.date:
+            self.rotate(date)
+        elif self.file.tell() >= MAX_BYTES:
+            self.rotate(date, full=True)
+        self.file.write(text)
+
+    def rotate(self, date: str, full: bool = False) -> None:
+        """Switches to the file of a new date, or moves a full file aside."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            if full or COMPRESS:
+                self.archive(self.date)
+        os.makedirs(LOG_DIR, exist_ok=True)
+        self.date = date
+        self.file = open(self.path(date), "a", encoding="utf-8")
+
+    def archive(self, date: str) -> None:
+        """Renames the file of a date to its next free part number, compressing it if enabled."""
+        part = 1
+        while os.path.exists(self.path(date, part)) or os.path.exists(self.path(date, part) + ".gz"):
+            part += 1
+        rotated = self.path(date, part)
+        os.replace(self.path(date), rotated)
+        if COMPRESS:
+            with open(rotated, "rb") as source, gzip.open(rotated + ".gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.remove(rotated)
+
+    def flush(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+
+class LogWriter:
+    """
+    A writer thread appending queued records to the files of a LogFile in batches.
+
+    Records are only queued by put(); the thread turns every batch of them into
+    text with a format function, writes it and flushes. LogManager writes its
+    messages with one, QueryLog its search and click records with another.
+    """
+    def __init__(self, format_batch: Callable[[List[Any]], str], prefix: str = "cte_search",
+                 extension: str = "log", name: str = "LogManager", batch_size: int = BATCH_SIZE):
+        """
+        Args:
+            format_batch (Callable[[List[Any]], str]): Returns the text of a batch of queued records
+            prefix (str): Name of the log files before their date, changing it switches files with the next batch
+            extension (str): Extension of the log files
+            name (str): Name of the writer thread
+            batch_size (int): Records written per batch before the file is flushed
+        """
+        self.prefix = prefix
+        self.extension = extension
+        self.name = name
+        self.batch_size = batch_size
+        self.__format_batch = format_batch
+        # Records, None to wake the writer up, or an Event it sets once it got there
+        self.__queue: SimpleQueue = SimpleQueue()
+        self.__thread: Optional[Thread] = None
+        self.__lock = Lock()
+
+    @property
+    def started(self) -> bool:
+        """Whether the writer thread is running."""
+        return self.__thread is not None
+
+    @property
+    def pending(self) -> int:
+        """Number of records waiting to be written."""
+        return self.__queue.qsize()
+
+    def start(self) -> None:
+        """Starts the writer thread if it is not running yet."""
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__write_loop, name=self.name, daemon=True)
+                self.__thread.start()
+
+    def put(self, record: Any) -> None:
+        """Queues a record, starting the writer thread on the first one."""
+        if self.__thread is None:
+            self.start()
+        self.__queue.put(record)
+
+    def wake(self) -> None:
+        """Has the writer rotate the log file if the date changed, even when nothing is being written."""
+        if self.__thread is not None:
+            self.__queue.put(None)
+
+    def flush(self, timeout: Optional[float] = 5) -> bool:
+        """Waits until the queued records are written, returning False on timeout."""
+        if self.__thread is None:
+            return True
+        written = Event()
+        self.__queue.put(written)
+        return written.wait(timeout)
+
+    def __write_loop(self) -> None:
+        """Body of the writer thread: formats and writes queued records in batches."""
+        log_file = LogFile(self.prefix, self.extension)
+        while True:
+            batch = [self.__queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.__queue.get_nowait())
+            except Empty:
+                pass
+            try:
+                if log_file.prefix != self.prefix:
+                    if log_file.file is not None:
+                        log_file.file.close()
+                    log_file = LogFile(self.prefix, self.extension)
+                text = self.__format_batch([record for record in batch if record is not None and not isinstance(record, Event)])
+                if text:
+                    log_file.write(text)
+                elif log_file.date is not None and datetime.now().strftime("%Y%m%d") != log_file.date:
+                    log_file.rotate(datetime.now().strftime("%Y%m%d"))
+                log_file.flush()
+            except Exception as e:
+                print(f"{self.name} failed to write logs: {e}", file=sys.stderr)
+            for record in batch:
+                if isinstance(record, Event):
+                    record.set()
+
+def __format_records(records: List[Tuple[float, str, str]]) -> str:
+    """Formats a batch of (created, level, message) records, after a warning if messages were dropped."""
+    global __dropped
+    text = "".join(__format(*record) for record in records)
+    if __dropped > 0:
+        dropped, __dropped = __dropped, 0
+        text = __format(time(), "WARNING", f"Dropped {dropped} log messages, the writer fell behind") + text
+    return text
+
+# Writes the (created, level, message) records of this process
+__writer = LogWriter(__format_records)
+
+def __enqueue(level: str, msg, site: Optional[str]) -> bool:
+    """Queues a record unless its level, sampling or site rate limit drops it; returns whether it was queued."""
+    global __dropped
+    if LEVELS[level] < __min_level:
+        return False
+    every = __sampling.get(level)
+    if every is not None:
+        seen = __sampled.get(level, 0)
+        __sampled[level] = seen + 1
+        if seen % every != 0:
+            return False
+    msg = str(msg)
+    if site is not None:
+        rate = __site_rates.get(site, SITE_RATE)
+        now = monotonic()
+        bucket = __site_buckets.setdefault(site, [rate, now, 0])
+        bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2] > 0:
+            msg = f"{msg} ({int(bucket[2])} similar messages suppressed)"
+            bucket[2] = 0
+    if __writer.pending >= MAX_PENDING:
+        __dropped += 1
+        return False
+    __writer.put((time(), level, msg))
+    return True
+
+def __after_fork() -> None:
+    """Gives a forked child process a queue and writer of its own, the writer thread of the parent does not run there."""
+    global __writer, __dropped
+    __writer = LogWriter(__format_records, __writer.prefix)
+    __dropped = 0
+
+os.register_at_fork(after_in_child=__after_fork)
+
 async def update_file_handler():
-    """Periodically updates the log file handler when the date changes."""
-    global __current_date, __file_handler
-    try:
-        current_date = datetime.now().strftime("%Y%m%d")
-        if current_date != __current_date:
-            if __file_handler:
-                __LOGGER.removeHandler(__file_handler)
-                __file_handler.close()
-            __current_date = current_date
-            __file_handler = FileHandler(f'logs/cte_search_{current_date}.log')
-            __file_handler.setFormatter(formatter)
-            __file_handler.setLevel('DEBUG')
-            __LOGGER.addHandler(__file_handler)
-    except Exception as e:
-        __LOGGER.error(f"Failed to update log file handler: {e}")
+    """Asks the writer to rotate the log file if the date changed, even when nothing is being logged."""
+    __writer.wake()
 
 async def logger_loop():
-    """Initializes logger with both file and stream handlers.
-    
-    This function must be run before any logging functions can be used.
-    It creates the initial log file handler and starts an infinite loop
-    that checks for date changes every minute to rotate log files.
+    """Starts the log writer and checks for date changes every minute.
+
+    Logging works without it, records are simply written by the writer thread
+    started on the first call; this keeps the daily rotation on time while
+    nothing is logged.
     """
-    global __current_date, __file_handler, __ready
-
-    # Set up file handler
-    __current_date = datetime.now().strftime("%Y%m%d")
-    __file_handler = FileHandler(f'logs/cte_search_{__current_date}.log')
-    __file_handler.setFormatter(formatter)
-    __file_handler.setLevel('DEBUG')
-    __LOGGER.addHandler(__file_handler)
-    __ready = True
-    # Start async log file updater
+    __writer.start()
     while True:
         await update_file_handler()
         await asyncio.sleep(60)  # Check every minute
 
+def flush(timeout: Optional[float] = 5) -> bool:
+    """Waits until the queued records are written.
+
+    Args:
+        timeout: Seconds to wait at most, None to wait for as long as it takes
+
+    Returns:
+        bool: True if everything was written
+    """
+    return __writer.flush(timeout)
+
+def set_level(level: str):
+    """Drop the messages below a level.
+
+    Args:
+        level: DEBUG, INFO, WARNING, ERROR or CRITICAL
+    """
+    global __min_level
+    __min_level = LEVELS[level]
+
+def set_sample_rate(level: str, rate: float):
+    """Keep only a share of the messages of a level, e.g. 0.01 for one debug message in a hundred.
+
+    Args:
+        level: DEBUG, INFO, WARNING, ERROR or CRITICAL
+        rate: Share of the messages kept, 1 to keep them all
+    """
+    if rate >= 1:
+        __sampling.pop(level, None)
+    else:
+        __sampling[level] = max(1, round(1 / rate))
+
+def set_rate_limit(site: str, per_second: float):
+    """Limit the messages logged with a site, beyond which they are counted but not written.
+
+    Args:
+        site: Name a hot call site passes to the logging functions
+        per_second: Messages per second allowed, in bursts of up to as many
+    """
+    __site_rates[site] = per_second
+    __site_buckets.pop(site, None)
+
+def set_prefix(prefix: str):
+    """Name the log files of this process, so that processes sharing the log directory each write their own.
+
+    Args:
+        prefix: Name of the log files before their date, cte_search by default
+    """
+    __writer.prefix = prefix
+
 def add_error_callback(callback: Callable[[str], None]):
     """Add a callback function to be called when errors occur.
-    
+
     Args:
         callback: A function that takes a string parameter containing the error message
     """
     __error_callbacks.append(callback)
 
-def info(msg):
+def __notify(msg):
+    for callback in __error_callbacks:
+        try:
+            callback(msg)
+        except Exception as e:
+            __enqueue("ERROR", f"Error callback failed: {e}", None)
+
+def info(msg, site: Optional[str] = None):
     """Log an info level message.
-    
+
     Args:
         msg: The message to log
-    
-    Raises:
-        RuntimeError: If logger_loop() hasn't been started
+        site: Optional name of the call site, to rate limit a hot one (see set_rate_limit)
     """
-    if not __ready:
-        raise RuntimeError("Ensure Logger Loop is running before you trying to use logging")
-    __LOGGER.info(msg)
+    __enqueue("INFO", msg, site)
 
-def debug(msg):
+def debug(msg, site: Optional[str] = None):
     """Log a debug level message.
-    
+
     Args:
         msg: The message to log
-    
-    Raises:
-        RuntimeError: If logger_loop() hasn't been started
+        site: Optional name of the call site, to rate limit a hot one (see set_rate_limit)
     """
-    if not __ready:
-        raise RuntimeError("Ensure Logger Loop is running before you trying to use logging")
-    __LOGGER.debug(msg)
+    __enqueue("DEBUG", msg, site)
 
-def warning(msg):
+def warning(msg, site: Optional[str] = None):
     """Log a warning level message.
-    
+
     Args:
         msg: The message to log
-    
-    Raises:
-        RuntimeError: If logger_loop() hasn't been started
+        site: Optional name of the call site, to rate limit a hot one (see set_rate_limit)
     """
-    if not __ready:
-        raise RuntimeError("Ensure Logger Loop is running before you trying to use logging")
-    __LOGGER.warning(msg)
+    __enqueue("WARNING", msg, site)
 
-def error(msg):
+def error(msg, site: Optional[str] = None):
     """Log an error level message.
-    
+
     Args:
         msg: The message to log
-    
-    Raises:
-        RuntimeError: If logger_loop() hasn't been started
+        site: Optional name of the call site, to rate limit a hot one (see set_rate_limit)
     """
-    if not __ready:
-        raise RuntimeError("Ensure Logger Loop is running before you trying to use logging")
-    __LOGGER.error(msg)
-    for callback in __error_callbacks:
-        try:
-            callback(msg)
-        except Exception as e:
-            __LOGGER.error(f"Error callback failed: {e}")
+    __enqueue("ERROR", msg, site)
+    __notify(msg)
 
-def critical(msg):
+def critical(msg, site: Optional[str] = None):
     """Log a critical level message.
-    
+
     Args:
         msg: The message to log
-    
-    Raises:
-        RuntimeError: If logger_loop() hasn't been started
+        site: Optional name of the call site, to rate limit a hot one (see set_rate_limit)
     """
-    if not __ready:
-        raise RuntimeError("Ensure Logger Loop is running before you trying to use logging")
-    __LOGGER.critical(msg)
-    for callback in __error_callbacks:
-        try:
-            callback(msg)
-        except Exception as e:
-            __LOGGER.error(f"Error callback failed: {e}")
\ No newline at end of file
+    __enqueue("CRITICAL", msg, site)
+    __notify(msg)
+
+# Write out what is still queued when the program exits
+atexit.register(flush)
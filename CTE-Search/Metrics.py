@@ -0,0 +1,207 @@
+"""
+Metrics.py - Low-overhead instrumentation of the search server
+
+Counters and latency histograms live in plain dictionaries of the server
+process: recording a value is a dictionary lookup and, for a histogram, a
+bisection over a fixed list of bucket bounds, cheap enough to leave on for every
+query. Gauges, such as the index size, are only read when metrics are rendered,
+through collector functions.
+
+``render`` formats everything in the Prometheus text exposition format, which
+the server serves on its /metrics path. Besides the usual cumulative buckets,
+every histogram also exposes estimated percentiles interpolated within its
+buckets, for readers of the raw text.
+
+When several processes serve, each one sends what ``collect`` returns to the one
+rendering the metrics, which renders them all at once with a process label.
+"""
+
+import bisect
+import math
+from contextlib import contextmanager
+from copy import deepcopy
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Upper bounds in seconds of the latency histogram buckets, four per decade from 10µs to 10s
+BUCKETS: List[float] = [round(10 ** (exponent / 4), 9) for exponent in range(-20, 5)]
+# Percentiles exposed for every histogram
+QUANTILES = (0.5, 0.9, 0.99)
+# Prefix of every exported metric name
+PREFIX = "cte_search_"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class Histogram:
+    """Counts of observed values per bucket, with their sum."""
+    def __init__(self, bounds: List[float] = BUCKETS):
+        """
+        Args:
+            bounds (List[float]): Increasing upper bounds of the buckets, an overflow bucket is added
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """Adds a value to its bucket."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile by linear interpolation within the bucket holding it.
+
+        Args:
+            q (float): The quantile, between 0 and 1
+
+        Returns:
+            float: The estimate, NaN when nothing was observed
+        """
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count > 0 and seen + count >= rank:
+                lower = 0.0 if i == 0 else self.bounds[i - 1]
+                if i == len(self.bounds):
+                    # Nothing is known above the last bound
+                    return lower
+                return lower + (self.bounds[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+__counters: Dict[Tuple[str, Labels], float] = {}
+__histograms: Dict[Tuple[str, Labels], Histogram] = {}
+__collectors: List[Callable[[], Dict[str, float]]] = []
+
+def count(name: str, amount: float = 1, **labels: str) -> None:
+    """
+    Increments a counter, exported as <name>_total.
+
+    Args:
+        name (str): Counter name, without prefix
+        amount (float): Increment
+        **labels (str): Label values of the counter
+    """
+    key = (name, tuple(sorted(labels.items())))
+    __counters[key] = __counters.get(key, 0) + amount
+
+def observe(name: str, seconds: float, **labels: str) -> None:
+    """
+    Records a duration in a latency histogram.
+
+    Args:
+        name (str): Histogram name, without prefix
+        seconds (float): The duration
+        **labels (str): Label values of the histogram
+    """
+    key = (name, tuple(sorted(labels.items())))
+    histogram = __histograms.get(key)
+    if histogram is None:
+        histogram = __histograms[key] = Histogram()
+    histogram.observe(seconds)
+
+@contextmanager
+def timer(name: str, **labels: str) -> Iterator[None]:
+    """Records the duration of a with block in a latency histogram, see observe."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - start, **labels)
+
+def add_collector(collector: Callable[[], Dict[str, float]]) -> None:
+    """
+    Registers a function returning gauge values by name, called every time metrics are rendered.
+
+    Args:
+        collector (Callable[[], Dict[str, float]]): Returns {gauge name without prefix: value}
+    """
+    __collectors.append(collector)
+
+def collect() -> Dict[str, Any]:
+    """
+    Returns a picklable copy of the metrics of this process, the collector gauges read now.
+
+    Returns:
+        Dict[str, Any]: The counters, histograms and gauges by (name, labels), see render
+    """
+    gauges = {}
+    for collector in __collectors:
+        gauges.update({(name, ()): value for name, value in collector().items()})
+    return {"counters": dict(__counters), "histograms": deepcopy(__histograms), "gauges": gauges}
+
+def reset() -> None:
+    """Drops every counter and histogram, as in a forked process that must not report its parent's."""
+    __counters.clear()
+    __histograms.clear()
+
+def get_histogram(name: str, **labels: str) -> Histogram:
+    """Returns the histogram of a name and labels, empty if nothing was observed."""
+    return __histograms.get((name, tuple(sorted(labels.items()))), Histogram())
+
+def __format_labels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+def __format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+def render(processes: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
+    """
+    Formats every metric in the Prometheus text exposition format.
+
+    Args:
+        processes (Optional[Dict[str, Dict[str, Any]]]): Metrics of several processes by name, as
+            returned by collect, rendered with a process label; None for those of this process
+
+    Returns:
+        str: The metrics, one sample per line
+    """
+    counters: Dict[Tuple[str, Labels], float] = {}
+    histograms: Dict[Tuple[str, Labels], Histogram] = {}
+    gauges: Dict[Tuple[str, Labels], float] = {}
+    for process, metrics in (processes or {"": collect()}).items():
+        extra = (("process", process),) if processes is not None else ()
+        counters.update({(name, extra + labels): value for (name, labels), value in metrics["counters"].items()})
+        histograms.update({(name, extra + labels): value for (name, labels), value in metrics["histograms"].items()})
+        gauges.update({(name, extra + labels): value for (name, labels), value in metrics["gauges"].items()})
+
+    lines = []
+    typed = set()
+    def declare(name: str, kind: str) -> None:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        declare(f"{PREFIX}{name}_total", "counter")
+        lines.append(f"{PREFIX}{name}_total{__format_labels(labels)} {__format_value(value)}")
+
+    for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+        declare(PREFIX + name, "histogram")
+        cumulative = 0
+        for bound, bucket in zip(histogram.bounds + [math.inf], histogram.counts):
+            cumulative += bucket
+            le = "+Inf" if math.isinf(bound) else repr(bound)
+            lines.append(f"{PREFIX}{name}_bucket{__format_labels(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{PREFIX}{name}_sum{__format_labels(labels)} {__format_value(histogram.sum)}")
+        lines.append(f"{PREFIX}{name}_count{__format_labels(labels)} {histogram.count}")
+    for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+        declare(f"{PREFIX}{name}_quantile", "gauge")
+        for q in QUANTILES:
+            sample_labels = labels + (("quantile", str(q)),)
+            lines.append(f"{PREFIX}{name}_quantile{__format_labels(sample_labels)} {__format_value(histogram.quantile(q))}")
+
+    for (name, labels), value in sorted(gauges.items()):
+        declare(PREFIX + name, "gauge")
+        lines.append(f"{PREFIX}{name}{__format_labels(labels)} {__format_value(value)}")
+    return "\n".join(lines) + "\n"
@@ -1,42 +1,308 @@
 from DataTypes import PageData, FeedBack
+from Index import FilterIndex, InvertedIndex, SegmentedIndex, top_k
+from Ranker import OnlineRanker
+from Feedback import FeedbackStore
+from Build import parallel_fit_transform, transform_counting_unknown
+from Snapshot import HEADER, ChainedColumn, IndexReader, replace_directory, save_arrays, save_strings, write_header
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.base import clone
 from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 import numpy as np
-from scipy.sparse import csr_matrix
+import joblib
+import os
+import shutil
+from copy import deepcopy
+from time import perf_counter
+from uuid import uuid4
+from scipy.sparse import csc_matrix, csr_matrix, hstack, vstack
 import pandas as pd
-from typing import List, Optional, Tuple, Any
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple, Any, Union
+
+if TYPE_CHECKING:
+    from sklearn.ensemble import RandomForestRegressor
+
+# Retrieval engines: "dense" scores every document with cosine_similarity over the
+# full matrix, "inverted" only scores the documents sharing a term with the query,
+# "maxscore" prunes the postings walk down to the best candidates when a limit is given.
+# The ranker then only sees the RERANK_DEPTH best keyword matches, so once it is trained
+# maxscore can return other pages than inverted; until then the two return the same.
+ENGINES = ("dense", "inverted", "maxscore")
+# Rankers: "forest" refits a RandomForestRegressor on all feedback in retrain(),
+# "online" is an OnlineRanker that learn() also updates from each new batch of feedback.
+RANKERS = ("forest", "online")
+
+def new_forest() -> 'RandomForestRegressor':
+    """Return an untrained forest ranker, importing sklearn.ensemble only once a forest is needed."""
+    from sklearn.ensemble import RandomForestRegressor
+    return RandomForestRegressor()
 
 class SearchModel:
     """A search model that combines keyword-based search with machine learning for improved results."""
+
+    # Number of keyword matches the maxscore engine hands to the trained ranker for a limited query
+    RERANK_DEPTH: int = 100
+    # Drift above which maintain() refits the vocabulary and IDF weights
+    REFRESH_DRIFT: float = 0.2
+    # Share of removed documents above which maintain() compacts them away
+    COMPACT_RATIO: float = 0.2
+    # Number of pages from which the vectorizer is fitted by parallel worker processes
+    PARALLEL_BUILD_DOCS: int = 20000
+    # Worker processes of a parallel fit, 0 for one per CPU core
+    BUILD_WORKERS: int = 0
     
-    def __init__(self, data: List[PageData]) -> None:
+    def __init__(self, data: Union[List[PageData], pd.DataFrame], engine: str = "dense", ranker: str = "forest") -> None:
         """Initialize the search model with page data.
         
         Args:
-            data: List of PageData instances containing page information.
+            data: List of PageData instances containing page information, or a
+                DataFrame with one PageData column per field.
+            engine: Retrieval engine used by improved_search, one of ENGINES.
+            ranker: Ranker trained from the feedback, one of RANKERS.
             
         Raises:
-            ValueError: If data is not a list of PageData instances.
+            ValueError: If data is not a list of PageData instances, or the engine or ranker is unknown.
         """
-        if not all(isinstance(d, PageData) for d in data):
+        if not isinstance(data, pd.DataFrame) and not all(isinstance(d, dict) for d in data):
             raise ValueError("data must be a list of PageData instances")
+        self.engine = engine
         
-        self.__model: RandomForestRegressor = RandomForestRegressor()
+        self.__model: Union['RandomForestRegressor', OnlineRanker] = OnlineRanker() if ranker == "online" else new_forest()
+        self.__trained: bool = False
+        self.ranker = ranker
         self.__df: pd.DataFrame = pd.DataFrame(data)
+        # Batches of pages appended since the page data was last read, folded in by __get_pages()
+        self.__pending_pages: List[pd.DataFrame] = []
         self.__vectorizer: TfidfVectorizer = TfidfVectorizer(stop_words="english")
-        if len(data) > 0:
-            self.__matrix: csr_matrix = self.__fit_vectorizer()
-        self.__trained: bool = False
-        self.__feedback_df: pd.DataFrame = pd.DataFrame(columns=['query', 'url', 'clicked'])
+        self.__matrix: Optional[csr_matrix] = None
+        self.__feedback: Optional[FeedbackStore] = FeedbackStore()
+        # Index directory the page data and feedback are read from on first use, see load()
+        self.__reader: Optional[IndexReader] = None
+        self.__fit_vectorizer()
 
-    def __fit_vectorizer(self) -> csr_matrix:
-        """Fit the TF-IDF vectorizer on page content.
-        
-        Returns:
-            A sparse matrix of TF-IDF features.
+    def __fit_vectorizer(self) -> None:
+        """Fit the TF-IDF vectorizer on page content and reset the index built on it.
+
+        Large corpora are tokenized in parallel worker processes, see Build.
+        """
+        # Fit a fresh vectorizer so copies sharing the current one are left untouched
+        self.__vectorizer = clone(self.__vectorizer)
+        workers = self.BUILD_WORKERS if self.BUILD_WORKERS > 0 else os.cpu_count() or 1
+        if len(self.__df) >= self.PARALLEL_BUILD_DOCS and workers > 1:
+            self.__matrix = parallel_fit_transform(self.__vectorizer, self.__df["content"], workers)
+        elif len(self.__df) > 0:
+            self.__matrix = self.__vectorizer.fit_transform(self.__df["content"])
+        else:
+            self.__matrix = None
+        self.__reset_index()
+
+    def __reset_index(self, deleted: Optional[np.ndarray] = None) -> None:
+        """Reset the state derived from the page data and the fitted matrix.
+
+        Args:
+            deleted: Tombstone flags of the documents, None when none are removed.
+        """
+        self.__pending_rows: List[csr_matrix] = []
+        # Names the matrix in the shared directories of save(), replaced whenever the matrix is
+        self.__base_id: str = uuid4().hex
+        self.__index: Optional[SegmentedIndex] = None
+        self.__deleted: np.ndarray = np.zeros(len(self.__df), dtype=bool) if deleted is None else deleted
+        self.__num_deleted: int = int(self.__deleted.sum())
+        # Drift bookkeeping since the vectorizer was fitted
+        self.__fit_docs: int = len(self.__df) - self.__num_deleted
+        self.__fit_terms: int = 0 if self.__matrix is None else self.__matrix.nnz
+        self.__changed_docs: int = 0
+        self.__unknown_terms: int = 0
+        self.__refresh_columns()
+
+    @property
+    def drift(self) -> float:
+        """How far the corpus has moved away from the fitted vocabulary and IDF weights.
+
+        The larger of the share of documents added or removed since the last fit,
+        and the number of (document, term) occurrences in added pages that the
+        vocabulary does not know relative to the fitted ones.
+        """
+        changed = self.__changed_docs / max(self.__fit_docs, 1)
+        unknown = self.__unknown_terms / max(self.__fit_terms, 1)
+        return max(changed, unknown)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Size of the index: live and removed documents, vocabulary terms and stored matrix entries."""
+        nonzeros = 0 if self.__matrix is None else self.__matrix.nnz + sum(rows.nnz for rows in self.__pending_rows)
+        return {
+            "documents": len(self.__deleted) - self.__num_deleted,
+            "removed_documents": self.__num_deleted,
+            "terms": 0 if self.__matrix is None else self.__matrix.shape[1],
+            "nonzeros": nonzeros
+        }
+
+    @property
+    def engine(self) -> str:
+        """Retrieval engine used by improved_search when no engine is given per call."""
+        return self.__engine
+
+    @engine.setter
+    def engine(self, engine: str) -> None:
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown search engine {engine}, expected one of {', '.join(ENGINES)}")
+        self.__engine = engine
+
+    @property
+    def ranker(self) -> str:
+        """Kind of ranker trained from the feedback, one of RANKERS.
+
+        Switching to another kind starts from an untrained ranker: call retrain()
+        to fit it on the feedback collected so far.
+        """
+        return "online" if isinstance(self.__model, OnlineRanker) else "forest"
+
+    @ranker.setter
+    def ranker(self, ranker: str) -> None:
+        if ranker not in RANKERS:
+            raise ValueError(f"Unknown ranker {ranker}, expected one of {', '.join(RANKERS)}")
+        if ranker != self.ranker:
+            self.__model = OnlineRanker() if ranker == "online" else new_forest()
+            self.__trained = False
+
+    def copy(self) -> 'SearchModel':
+        """Return a copy that can be changed without affecting this model.
+
+        Page data, matrix, index segments and ranker are shared: every change
+        replaces them rather than modifying them in place. Only the few pieces of
+        state that are updated in place are duplicated, so copying is cheap even
+        for a large corpus.
+        """
+        other = SearchModel.__new__(SearchModel)
+        # Copy from the one consistent view of the attributes taken by update()
+        other.__dict__.update(self.__dict__)
+        other.__pending_rows = list(other.__pending_rows)
+        other.__pending_pages = list(other.__pending_pages)
+        other.__deleted = np.array(other.__deleted, dtype=bool)
+        other.__filter_index = other.__filter_index.copy()
+        other.__index = None if other.__index is None else other.__index.copy()
+        other.__feedback = None if other.__feedback is None else other.__feedback.copy()
+        return other
+
+    def __get_pages(self) -> pd.DataFrame:
+        """Return the page data, folding in the pages appended since the last read."""
+        if len(self.__pending_pages) > 0:
+            self.__df = pd.concat([self.__df, *self.__pending_pages], ignore_index=True)
+            self.__pending_pages = []
+        return self.__df
+
+    def __get_matrix(self) -> csr_matrix:
+        """Return the TF-IDF matrix, folding in the rows of pages appended since the last read."""
+        if len(self.__pending_rows) > 0:
+            self.__matrix = self.__full_matrix()
+            self.__pending_rows = []
+            self.__base_id = uuid4().hex
+        return self.__matrix
+
+    def __segments(self) -> List[csr_matrix]:
+        """Return the matrix and a single block of the rows appended since, without copying the matrix."""
+        if len(self.__pending_rows) > 1:
+            self.__pending_rows = [vstack(self.__pending_rows, format="csr")]
+        return [self.__matrix, *self.__pending_rows]
+
+    def __rows(self, doc_ids: np.ndarray) -> csr_matrix:
+        """Return the TF-IDF rows of some documents, in the given order, without folding pending rows into the matrix.
+
+        The matrix of a loaded model is mapped from its index and shared with the
+        other processes mapping it: folding the rows appended since into it would
+        give every process a private copy of the whole matrix.
+        """
+        if len(self.__pending_rows) == 0:
+            return self.__matrix[doc_ids]
+        segments = self.__segments()
+        starts = np.cumsum([0] + [segment.shape[0] for segment in segments])
+        order = np.argsort(doc_ids, kind="stable")
+        bounds = np.searchsorted(doc_ids[order], starts)
+        rows = vstack([segment[doc_ids[order[bounds[i]:bounds[i + 1]]] - starts[i]]
+                       for i, segment in enumerate(segments)], format="csr")
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        return rows[inverse]
+
+    def __similarities(self, query_vectors: csr_matrix, doc_ids: Optional[np.ndarray] = None,
+                       dense_output: bool = True) -> Union[np.ndarray, csr_matrix]:
+        """Return the cosine similarities of queries with some documents, or all of them, see __rows."""
+        if doc_ids is not None:
+            return cosine_similarity(query_vectors, self.__rows(doc_ids), dense_output=dense_output)
+        parts = [cosine_similarity(query_vectors, segment, dense_output=dense_output) for segment in self.__segments()]
+        if len(parts) == 1:
+            return parts[0]
+        return np.hstack(parts) if dense_output else hstack(parts, format="csr")
+
+    def __full_matrix(self) -> csr_matrix:
+        """Return the TF-IDF matrix including pending rows, without changing the model."""
+        if len(self.__pending_rows) == 0:
+            return self.__matrix
+        return vstack([self.__matrix, *self.__pending_rows], format="csr")
+
+    def __require_pages(self) -> None:
+        """Raise if the model has no page data to change, as when loaded from an index saved search_only."""
+        self.__load_pages()
+        if self.__df is None:
+            raise RuntimeError("This model was loaded from a search-only index and cannot be changed")
+
+    def __load_pages(self) -> None:
+        """Read the page data of a model loaded with load(), the first time it is needed."""
+        if self.__df is not None or self.__reader is None or "pages" not in self.__reader:
+            return
+        tags = self.__reader.strings("pages", "page_filter_tags").tolist()
+        offsets = self.__reader.array("pages", "page_filter_offsets")
+        self.__df = pd.DataFrame({
+            "url": self.__urls.tolist(),
+            "title": self.__titles.tolist(),
+            "content": self.__reader.strings("pages", "contents").tolist(),
+            "filters": [tags[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        })
+        # Changes need writable columns rather than the mapped ones
+        self.__urls = self.__column("url")
+        self.__titles = self.__column("title")
+        self.__deleted = np.array(self.__deleted, dtype=bool)
+
+    def __get_feedback(self) -> FeedbackStore:
+        """Return the feedback, read the first time it is needed for a model loaded with load()."""
+        if self.__feedback is None and "feedback" not in self.__reader:
+            self.__feedback = FeedbackStore()
+        elif self.__feedback is None:
+            self.__feedback = FeedbackStore.from_arrays(
+                self.__reader.strings("feedback", "feedback_queries"),
+                self.__reader.strings("feedback", "feedback_urls"),
+                self.__reader.array("feedback", "feedback_rows")
+            )
+        return self.__feedback
+
+    def __get_index(self) -> SegmentedIndex:
+        """Return the inverted index, building it from the TF-IDF matrix on first use."""
+        if self.__index is None:
+            self.__index = SegmentedIndex(InvertedIndex(self.__get_matrix()))
+        return self.__index
+
+    def __live_mask(self) -> Optional[np.ndarray]:
+        """Return a mask of the documents not removed, None when none are."""
+        return None if self.__num_deleted == 0 else ~self.__deleted
+
+    def __refresh_columns(self) -> None:
+        """Extract the per-document columns used at query time into NumPy arrays.
+
+        Ranking reads url/title by position for many documents at once, which
+        is far cheaper on plain arrays than through ``DataFrame.iloc``. Filter tags
+        are indexed once here instead of being checked row by row per query.
         """
-        return self.__vectorizer.fit_transform(self.__df["content"])
+        self.__urls: np.ndarray = self.__column("url")
+        self.__titles: np.ndarray = self.__column("title")
+        self.__filter_index: FilterIndex = FilterIndex(self.__column("filters"))
+
+    def __column(self, name: str, pages: Optional[pd.DataFrame] = None) -> np.ndarray:
+        """Return a column of the page data, or of some pages, as an object array filled with None if the column is missing."""
+        pages = self.__get_pages() if pages is None else pages
+        if name not in pages:
+            return np.full(len(pages), None, dtype=object)
+        return pages[name].to_numpy(dtype=object)
 
     def keyword_search(self, query: str) -> np.ndarray:
         """Perform keyword-based search using cosine similarity.
@@ -45,91 +311,729 @@ class SearchModel:
             query: Search query string.
             
         Returns:
-            Array of similarity scores for each document.
+            Array of similarity scores for each document, 0 for removed ones.
+        """
+        if self.__matrix is None:
+            return np.empty(0, dtype=np.float64)
+        query_vector = self.__vectorizer.transform([query])
+        similarities = self.__similarities(query_vector).flatten()
+        similarities[self.__deleted] = 0
+        return similarities
+
+    def keyword_top_k(self, query: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the k documents with the highest keyword similarity to a query.
+
+        Unlike keyword_search this does not score every document: the inverted
+        index is walked with MaxScore pruning and stops early on common terms.
+
+        Args:
+            query: Search query string.
+            k: Number of documents to return.
+
+        Returns:
+            Tuple of (doc_ids, similarities), best first.
+        """
+        if self.__matrix is None:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float64)
+        return self.__get_index().top_k(self.__vectorizer.transform([query]), k, self.__live_mask())
+
+    def __candidates(self, query: str, engine: str, filters: Optional[List[str]],
+                     depth: Optional[int], timings: Dict[str, float]) -> Tuple[np.ndarray, np.ndarray]:
+        """Score the documents considered for a query with the given engine.
+
+        Args:
+            query: Search query string.
+            engine: Retrieval engine, one of ENGINES.
+            filters: Optional list of filter strings to restrict results.
+            depth: Number of candidates the caller needs, or None for all of them.
+            timings: Dict receiving the seconds spent in the "vectorize", "filter" and "score" phases.
+
+        Returns:
+            Tuple of (doc_ids, similarities) restricted to the filtered documents
+            that were not removed. The dense engine returns all of them, the
+            inverted engine those sharing a term with the query, both sorted by
+            document id. With a depth and a trained ranker, the maxscore engine
+            returns the depth best keyword matches, best first; an untrained ranker
+            ties every candidate, so the page holds the first matches by document
+            id and maxscore returns what inverted does.
         """
+        num_docs = len(self.__deleted)
+        start = perf_counter()
         query_vector = self.__vectorizer.transform([query])
-        return cosine_similarity(query_vector, self.__matrix).flatten()
+        timings["vectorize"] = perf_counter() - start
+        if engine == "dense":
+            start = perf_counter()
+            if not filters:
+                doc_ids = np.arange(num_docs) if self.__num_deleted == 0 else np.flatnonzero(~self.__deleted)
+            else:
+                doc_ids = self.__filter_index.doc_ids(filters)
+                if self.__num_deleted > 0:
+                    doc_ids = doc_ids[~self.__deleted[doc_ids]]
+            timings["filter"] = perf_counter() - start
+            start = perf_counter()
+            if len(doc_ids) == 0:
+                similarities = np.empty(0, dtype=np.float64)
+            elif len(doc_ids) == num_docs:
+                similarities = self.__similarities(query_vector).flatten()
+            else:
+                # Only the rows of the allowed documents are scored
+                similarities = self.__similarities(query_vector, doc_ids).flatten()
+            timings["score"] = perf_counter() - start
+            return doc_ids, similarities
+
+        start = perf_counter()
+        allowed = self.__live_mask()
+        if filters:
+            allowed = self.__filter_index.mask(filters, num_docs) if allowed is None else allowed & self.__filter_index.mask(filters, num_docs)
+        timings["filter"] = perf_counter() - start
+        start = perf_counter()
+        if engine == "maxscore" and depth is not None and self.__trained:
+            candidates = self.__get_index().top_k(query_vector, depth, allowed)
+        else:
+            candidates = self.__get_index().score(query_vector, allowed)
+        timings["score"] = perf_counter() - start
+        return candidates
 
-    def improved_search(self, query: str, filters: Optional[List[str]] = None) -> List[Tuple[str, str, float]]:
+    def improved_search(self, query: str, filters: Optional[List[str]] = None,
+                        limit: Optional[int] = None, offset: int = 0,
+                        engine: Optional[str] = None,
+                        timings: Optional[Dict[str, float]] = None) -> List[Tuple[str, str, float]]:
         """Perform improved search combining keyword search with ML-based ranking.
         
         Args:
             query: Search query string.
             filters: Optional list of filter strings to restrict results.
+            limit: Maximum number of results to return, or None for all of them.
+            offset: Number of top results to skip, for pagination.
+            engine: Retrieval engine overriding the model's engine for this call. With
+                a limit, "maxscore" only ranks the RERANK_DEPTH (or offset + limit) best
+                keyword matches, so its results differ from those of "inverted" once
+                the ranker is trained.
+            timings: Optional dict receiving the seconds spent in the "vectorize",
+                "filter", "score", "rank" and "sort" phases.
             
         Returns:
             List of tuples containing (url, title, rank_score) sorted by rank score.
+
+        Raises:
+            ValueError: If limit or offset is not an integer or negative, or the engine is unknown.
         """
-        similarities = self.keyword_search(query)
-        results = []
-        
-        for i, sim in enumerate(similarities):
-            if filters:
-                page_filters = self.__df.iloc[i].get("filters", [])
-                if not any(f in page_filters for f in filters):
-                    continue
-
-            features = np.array([[sim]])
-            rank_score = self.__model.predict(features)[0] if self.__trained else 0
-            results.append((self.__df.iloc[i]["url"], self.__df.iloc[i]["title"], rank_score))
-        
-        return sorted(results, key=lambda x: x[2], reverse=True)
+        engine = self.__check_options(limit, offset, engine)
+        if self.__matrix is None:
+            return []
+
+        timings = {} if timings is None else timings
+        doc_ids, similarities = self.__candidates(query, engine, filters, self.__depth(limit, offset), timings)
+        # A single predict over every candidate instead of one per document
+        start = perf_counter()
+        rank_scores = self.__rank(similarities)
+        timings["rank"] = perf_counter() - start
+        start = perf_counter()
+        results = self.__page(doc_ids, rank_scores, limit, offset)
+        timings["sort"] = perf_counter() - start
+        return results
+
+    def batch_search(self, queries: List[str], filters: Optional[List[str]] = None,
+                     limit: Optional[int] = None, offset: int = 0,
+                     engine: Optional[str] = None,
+                     timings: Optional[Dict[str, float]] = None) -> List[List[Tuple[str, str, float]]]:
+        """Perform improved_search for many queries at once.
+
+        The queries are vectorized together, scored against the index with a single
+        sparse matrix product and their candidates ranked with a single predict, so
+        the per-call overhead is paid once for the whole batch. The results are those
+        of improved_search for each query, up to float rounding of the similarities.
+
+        Args:
+            queries: Search query strings.
+            filters: Optional list of filter strings restricting the results of every query.
+            limit: Maximum number of results to return per query, or None for all of them.
+            offset: Number of top results to skip for every query.
+            engine: Retrieval engine overriding the model's engine for this call.
+            timings: Optional dict receiving the seconds spent in each phase for the
+                whole batch, as for improved_search.
+
+        Returns:
+            One list of (url, title, rank_score) tuples per query, in query order.
+
+        Raises:
+            ValueError: If limit or offset is not an integer or negative, or the engine is unknown.
+        """
+        engine = self.__check_options(limit, offset, engine)
+        timings = {} if timings is None else timings
+        num_docs = len(self.__deleted)
+        start = perf_counter()
+        if filters:
+            doc_ids = self.__filter_index.doc_ids(filters)
+            if self.__num_deleted > 0:
+                doc_ids = doc_ids[~self.__deleted[doc_ids]]
+        else:
+            doc_ids = np.arange(num_docs) if self.__num_deleted == 0 else np.flatnonzero(~self.__deleted)
+        timings["filter"] = perf_counter() - start
+        if self.__matrix is None or len(queries) == 0 or len(doc_ids) == 0:
+            return [[] for _ in queries]
+
+        start = perf_counter()
+        query_vectors = self.__vectorizer.transform(queries)
+        timings["vectorize"] = perf_counter() - start
+        start = perf_counter()
+        # queries x documents, holding only the pairs sharing a term
+        similarities = csr_matrix(self.__similarities(query_vectors, doc_ids if len(doc_ids) < num_docs else None,
+                                                      dense_output=False))
+        similarities.sort_indices()
+
+        depth = self.__depth(limit, offset)
+        candidates = []
+        for i in range(len(queries)):
+            if engine == "dense":
+                candidates.append((doc_ids, similarities[i].toarray().ravel()))
+                continue
+            # Like InvertedIndex.score: the matching documents, sorted by document id
+            row = slice(similarities.indptr[i], similarities.indptr[i + 1])
+            row_ids, row_similarities = doc_ids[similarities.indices[row]], similarities.data[row]
+            if engine == "maxscore" and depth is not None and self.__trained:
+                best = top_k(row_similarities, depth)
+                row_ids, row_similarities = row_ids[best], row_similarities[best]
+            candidates.append((row_ids, row_similarities))
+        timings["score"] = perf_counter() - start
+
+        start = perf_counter()
+        rank_scores = self.__rank(np.concatenate([c[1] for c in candidates]))
+        timings["rank"] = perf_counter() - start
+        start = perf_counter()
+        bounds = np.cumsum([0] + [len(c[0]) for c in candidates])
+        results = [self.__page(row_ids, rank_scores[bounds[i]:bounds[i + 1]], limit, offset)
+                   for i, (row_ids, _) in enumerate(candidates)]
+        timings["sort"] = perf_counter() - start
+        return results
+
+    def warmup(self) -> float:
+        """Run synthetic searches so the first real query does not pay for lazy initialization.
+
+        A term of the vocabulary is searched with every engine, alone and as a batch:
+        this builds the inverted index, faults in the pages of the mapped arrays the
+        searches walk and goes once through the vectorizer and ranker code paths.
+        The results are discarded.
+
+        Returns:
+            The seconds the warmup took.
+        """
+        start = perf_counter()
+        if self.__matrix is None or len(self.__vectorizer.vocabulary_) == 0:
+            return perf_counter() - start
+        term = next(iter(self.__vectorizer.vocabulary_))
+        for engine in ENGINES:
+            self.improved_search(term, limit=10, engine=engine)
+        self.batch_search([term, term], limit=10)
+        return perf_counter() - start
+
+    def __check_options(self, limit: Optional[int], offset: int, engine: Optional[str]) -> str:
+        """Validate the paging options of a search and return the engine to use."""
+        for name, value in (("offset", offset), ("limit", 0 if limit is None else limit)):
+            if not isinstance(value, (int, np.integer)) or isinstance(value, bool):
+                raise ValueError(f"{name} must be an integer")
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError("limit and offset must not be negative")
+        engine = self.__engine if engine is None else engine
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown search engine {engine}, expected one of {', '.join(ENGINES)}")
+        return engine
+
+    def __depth(self, limit: Optional[int], offset: int) -> Optional[int]:
+        """Return how many keyword matches a limited search hands to the ranker."""
+        return None if limit is None else max(offset + limit, self.RERANK_DEPTH)
 
-    def append_feedback(self, query: str, picked: FeedBack) -> None:
+    def __rank(self, similarities: np.ndarray) -> np.ndarray:
+        """Score candidates with the ranker, 0 for all of them while it is untrained."""
+        if self.__trained and len(similarities) > 0:
+            return self.__model.predict(similarities.reshape(-1, 1))
+        return np.zeros(len(similarities))
+
+    def __page(self, doc_ids: np.ndarray, rank_scores: np.ndarray,
+               limit: Optional[int], offset: int) -> List[Tuple[str, str, float]]:
+        """Return the requested page of candidates by rank score as (url, title, rank_score)."""
+        # Only the requested page is sorted; ties keep candidate order like sorted(reverse=True)
+        k = len(doc_ids) if limit is None else offset + limit
+        order = top_k(rank_scores, k)[offset:]
+        doc_ids = doc_ids[order]
+        return list(zip(self.__urls[doc_ids].tolist(), self.__titles[doc_ids].tolist(), rank_scores[order].tolist()))
+
+    def append_feedback(self, query: str, picked: FeedBack) -> bool:
         """Append user feedback for search results.
+
+        Identical feedback that was already recorded is ignored.
         
         Args:
             query: The search query that generated the results.
             picked: FeedBack instance containing user interaction data.
+
+        Returns:
+            True if the feedback was new.
         """
-        new_feedback = {"query": query, "url": picked.url, "clicked": int(picked.clicked)}
-        
-        # Check if identical feedback already exists
-        existing_feedback = self.__feedback_df[
-            (self.__feedback_df["query"] == query) & 
-            (self.__feedback_df["url"] == picked.url) &
-            (self.__feedback_df["clicked"] == int(picked.clicked))
-        ]
-        
-        if existing_feedback.empty:
-            self.__feedback_df = pd.concat([self.__feedback_df, pd.DataFrame([new_feedback])], ignore_index=True)
+        return self.__get_feedback().add(query, picked["url"], int(picked["clicked"]))
     
-    def retrain(self) -> None:
-        """Retrain the model using collected feedback data."""
-        if self.__feedback_df.empty:
+    def retrain(self) -> Optional[Dict[str, float]]:
+        """Retrain the model using collected feedback data.
+
+        The features of all feedback rows are computed in bulk: each distinct query
+        is vectorized once, and only the similarities of the (query, document) pairs
+        in the feedback are computed instead of scoring the whole corpus per row.
+        Feedback on pages that were removed since is skipped.
+
+        Returns:
+            Seconds spent in each phase ("lookup", "vectorize", "similarity", "fit"),
+            or None when there was no feedback to train on.
+        """
+        self.__require_pages()
+        if len(self.__get_feedback()) == 0:
             print("No feedback data available for training.")
-            return
-        
-        features = []
-        labels = []
-        for _, row in self.__feedback_df.iterrows():
-            doc_index = self.__df[self.__df["url"] == row["url"]].index[0]
-            similarity = self.keyword_search(row["query"])[doc_index]
-            features.append([similarity])
-            labels.append(row["clicked"])
-        
-        self.__model.fit(np.array(features), np.array(labels))
+            return None
+
+        timings = {}
+        feedback = self.__get_feedback().to_frame()
+        similarities, labels = self.__feedback_features(feedback["query"], feedback["url"], feedback["clicked"], timings)
+        if len(labels) == 0:
+            print("No feedback data available for training.")
+            return None
+
+        # Fit a fresh ranker so copies sharing the current one are left untouched
+        start = perf_counter()
+        self.__model = clone(self.__model).fit(similarities.reshape(-1, 1), labels)
         self.__trained = True
+        timings["fit"] = perf_counter() - start
+        return timings
 
-    def __reduce__(self) -> Tuple[Any, Tuple[RandomForestRegressor, pd.DataFrame, TfidfVectorizer, csr_matrix]]:
+    def learn(self, feedback: List[FeedBack]) -> int:
+        """Record a batch of feedback and, with the online ranker, update the ranker from it.
+
+        Unlike retrain() this only looks at the new feedback, so it is cheap enough
+        to run every few minutes. The forest ranker cannot be updated this way and
+        only learns the recorded feedback at its next retrain().
+
+        Args:
+            feedback: New FeedBack events.
+
+        Returns:
+            Number of events the ranker was updated with, duplicates of recorded
+            feedback left out.
+        """
+        self.__require_pages()
+        # The ranker is only updated with the events the feedback store kept
+        feedback = [event for event in feedback if self.append_feedback(event["query"], event)]
+        if self.ranker != "online" or len(feedback) == 0:
+            return 0
+        similarities, labels = self.__feedback_features(pd.Series([event["query"] for event in feedback]),
+                                                        pd.Series([event["url"] for event in feedback]),
+                                                        pd.Series([event["clicked"] for event in feedback]))
+        if len(labels) > 0:
+            # Update a copy so copies sharing the current ranker are left untouched
+            self.__model = deepcopy(self.__model).partial_fit(similarities.reshape(-1, 1), labels)
+            self.__trained = True
+        return len(labels)
+
+    def __feedback_features(self, queries: pd.Series, urls: pd.Series, clicked: pd.Series,
+                            timings: Optional[Dict[str, float]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Compute the ranker features and labels of feedback events in bulk.
+
+        Each distinct query is vectorized once, and only the similarities of the
+        (query, document) pairs in the feedback are computed. Events on pages that
+        were removed since are skipped.
+
+        Args:
+            queries: Query of each event.
+            urls: Picked url of each event.
+            clicked: Click label of each event.
+            timings: Optional dict receiving the seconds spent in the "lookup",
+                "vectorize" and "similarity" phases.
+
+        Returns:
+            Tuple of (similarities, labels) of the events on live pages.
+        """
+        timings = {} if timings is None else timings
+        start = perf_counter()
+        # url -> doc id of the live documents, the first one when a url repeats
+        live = np.flatnonzero(~self.__deleted)[::-1]
+        doc_ids_by_url = dict(zip(self.__urls[live].tolist(), live.tolist()))
+        doc_ids = np.array([doc_ids_by_url.get(url, -1) for url in urls.tolist()], dtype=np.intp)
+        known = doc_ids >= 0
+        doc_ids = doc_ids[known]
+        labels = clicked.to_numpy()[known].astype(np.float64)
+        timings["lookup"] = perf_counter() - start
+        if len(doc_ids) == 0:
+            return np.empty(0, dtype=np.float64), labels
+
+        start = perf_counter()
+        query_ids, distinct_queries = pd.factorize(queries[known])
+        query_vectors = normalize(self.__vectorizer.transform(distinct_queries))
+        timings["vectorize"] = perf_counter() - start
+
+        # Row-wise dot products of the feedback pairs: the cosine similarity keyword_search would give
+        start = perf_counter()
+        documents = normalize(self.__rows(doc_ids))
+        similarities = np.asarray(query_vectors[query_ids].multiply(documents).sum(axis=1)).ravel()
+        timings["similarity"] = perf_counter() - start
+        return similarities, labels
+
+    def __reduce__(self) -> Tuple[Any, Tuple['RandomForestRegressor', pd.DataFrame, TfidfVectorizer, csr_matrix, str, np.ndarray, bool, FeedbackStore]]:
         """Enable pickling of SearchModel instances.
         
         Returns:
             Tuple containing rebuild method and necessary arguments.
         """
-        return (SearchModel.rebuild, (self.__model, self.__df, self.__vectorizer, self.__matrix))
+        self.__load_pages()
+        matrix = None if self.__matrix is None else self.__get_matrix()
+        return (SearchModel.rebuild, (self.__model, self.__get_pages(), self.__vectorizer, matrix, self.__engine, self.__deleted, self.__trained, self.__get_feedback()))
+
     def append_page_data(self, new_page: PageData):
+        """Add a page to the index without refitting the vectorizer.
+
+        The page is vectorized against the current vocabulary and appended to the
+        matrix and the postings; terms the vocabulary does not know count towards
+        the drift that eventually triggers a refit in maintain().
+
+        Args:
+            new_page: The page to add.
+
+        Raises:
+            RuntimeError: If a page with the same title already exists.
+        """
+        self.__require_pages()
+        if "title" in self.__df and new_page["title"] in self.__titles[~self.__deleted]:
+            raise RuntimeError(f"Invalid Page {new_page['title']} already exists. Please remove old page.")
+        self.extend_pages(pd.DataFrame([new_page]))
+
+    def extend_pages(self, pages: pd.DataFrame) -> int:
+        """Add a batch of pages to the index without refitting the vectorizer.
+
+        Works like append_page_data for many pages at once: the batch is
+        vectorized with a single transform and appended to the matrix and the
+        postings as one block. Pages whose title is already indexed, or repeats
+        the title of an earlier page of the batch, are skipped.
+
+        The cost is that of the batch rather than of the index: the batch is kept
+        aside until the page data is next read as a whole, and only its own urls,
+        titles and filters are added to the columns searches read.
 
-        if "title" in self.__df and new_page["title"] in self.__df["title"].values:
-            raise RuntimeError(f"Invalid Page {new_page.title} already exists. Please remove old page.")
-        self.__df = pd.concat([self.__df, pd.DataFrame([new_page])], ignore_index=True)
+        Args:
+            pages: DataFrame with one PageData column per field.
+
+        Returns:
+            Number of pages added.
+        """
+        self.__require_pages()
+        pages = pages.drop_duplicates("title")
+        if "title" in self.__df and len(self.__deleted) > 0:
+            pages = pages[~pages["title"].isin(self.__titles[~self.__deleted])]
+        if len(pages) == 0:
+            return 0
+        if self.__matrix is None:
+            # First pages of an empty model: there is no vocabulary to extend yet
+            self.__df = pd.concat([self.__get_pages(), pages], ignore_index=True)
+            self.__fit_vectorizer()
+            return len(pages)
+
+        self.__pending_pages.append(pages)
+        self.__urls = np.concatenate([self.__urls, self.__column("url", pages)])
+        self.__titles = np.concatenate([self.__titles, self.__column("title", pages)])
+        for tags in self.__column("filters", pages):
+            self.__filter_index.add(tags)
+        self.__deleted = np.concatenate([self.__deleted, np.zeros(len(pages), dtype=bool)])
+
+        rows, unknown_terms = transform_counting_unknown(self.__vectorizer, pages["content"])
+        self.__pending_rows.append(rows)
+        if self.__index is not None:
+            self.__index.extend(rows)
+        self.__unknown_terms += unknown_terms
+        self.__changed_docs += len(pages)
+        return len(pages)
     
     def remove_pages(self, title: str):
-        self.__df = self.__df[self.__df["title"] != title]
+        """Remove every page with the given title.
+
+        Removed pages become tombstones: they are excluded from searches right
+        away and dropped from the matrix and indexes by the next compact().
+
+        Args:
+            title: Title of the pages to remove.
+        """
+        self.__require_pages()
+        removed = np.flatnonzero((self.__titles == title) & ~self.__deleted)
+        self.__deleted[removed] = True
+        self.__num_deleted += len(removed)
+        self.__changed_docs += len(removed)
+
+    def compact(self) -> None:
+        """Drop removed pages from the page data, the matrix and the indexes."""
+        self.__require_pages()
+        if self.__num_deleted == 0:
+            return
+        live = ~self.__deleted
+        self.__matrix = self.__get_matrix()[live]
+        self.__df = self.__get_pages()[live].reset_index(drop=True)
+        self.__pending_rows = []
+        self.__base_id = uuid4().hex
+        self.__index = None
+        self.__deleted = np.zeros(len(self.__df), dtype=bool)
+        self.__num_deleted = 0
+        self.__refresh_columns()
+
+    def refresh(self) -> None:
+        """Refit the vocabulary and IDF weights on the current pages, dropping removed ones."""
+        self.__require_pages()
+        self.__df = self.__get_pages()[~self.__deleted].reset_index(drop=True)
+        self.__fit_vectorizer()
+
+    @property
+    def pending_maintenance(self) -> Optional[str]:
+        """The work maintain() would do now: "refresh", "compact" or None."""
+        if self.drift > self.REFRESH_DRIFT:
+            return "refresh"
+        if self.__num_deleted > self.COMPACT_RATIO * len(self.__deleted):
+            return "compact"
+        return None
+
+    def maintain(self) -> Optional[str]:
+        """Refresh the vocabulary or compact removed pages once past their thresholds.
+
+        Returns:
+            "refresh" or "compact" for the work that was done, None if none was needed.
+        """
+        action = self.pending_maintenance
+        if action == "refresh":
+            self.refresh()
+        elif action == "compact":
+            self.compact()
+        return action
         
+    @property
+    def modified(self) -> bool:
+        """False while a model loaded with load() still matches its index, having only served searches."""
+        return self.__reader is None or self.__df is not None or self.__feedback is not None
+
+    def __vectorizer_params(self) -> Dict[str, Any]:
+        """Return the vectorizer parameters in a JSON-serializable form."""
+        params = self.__vectorizer.get_params()
+        params["dtype"] = np.dtype(params["dtype"]).name
+        return params
+
+    @staticmethod
+    def __restore_vectorizer(params: Dict[str, Any], vocabulary: Iterable[str], idf: np.ndarray) -> TfidfVectorizer:
+        """Recreate a fitted vectorizer from its parameters, vocabulary and IDF weights."""
+        params = dict(params, dtype=np.dtype(params["dtype"]).type, ngram_range=tuple(params["ngram_range"]))
+        vectorizer = TfidfVectorizer(**params)
+        vectorizer.vocabulary_ = {term: i for i, term in enumerate(vocabulary)}
+        vectorizer.idf_ = idf
+        return vectorizer
+
+    def save(self, directory: str, checkpoint: Optional[Dict[str, Any]] = None, search_only: bool = False,
+             shared: Optional[str] = None) -> None:
+        """Write the model to an index directory, see Snapshot for the format.
+
+        The model loaded back by load() can be changed and retrained like this one,
+        unless it was saved search_only: the page data and feedback are then left
+        out, as the search workers and acceptors only map what searching needs.
+
+        The documents of the matrix, as last fitted or compacted, are saved as the
+        base segments, the pages appended since as the delta segment. With a shared
+        directory the base segments are written there the first time a model with
+        this matrix is saved, and linked by every later save, so that saving only
+        costs the size of the delta, the tombstones and the ranker. A delta past
+        SegmentedIndex.MERGE_RATIO of the matrix is folded into a new base first,
+        as the index of the loaded model would merge it anyway.
+
+        Args:
+            directory: Directory to create; an existing index there is only replaced once the new one is complete.
+            checkpoint: JSON-serializable state saved in the header with the model, such as
+                the journal position it includes; read it back from IndexReader(directory).metadata.
+            search_only: Leave the page data and feedback out, making the saved model read-only.
+            shared: Directory keeping the base segments for the saves given the same one, in the
+                same parent directory as directory. The caller deletes the ones no index links any more.
+        """
+        if not search_only:
+            self.__require_pages()
+        if self.__matrix is not None and len(self.__deleted) - self.__matrix.shape[0] > SegmentedIndex.MERGE_RATIO * self.__matrix.shape[0]:
+            self.__get_matrix()
+        temporary = f"{directory}.tmp"
+        if os.path.exists(temporary):
+            shutil.rmtree(temporary)
+        os.makedirs(temporary)
+        base_docs = 0 if self.__matrix is None else self.__matrix.shape[0]
+        metadata = {
+            "engine": self.__engine,
+            "trained": self.__trained,
+            "num_docs": len(self.__deleted),
+            "base_docs": base_docs,
+            "drift": [self.__fit_docs, self.__fit_terms, self.__changed_docs, self.__unknown_terms],
+            "checkpoint": checkpoint or {}
+        }
+        if self.__matrix is not None:
+            metadata.update(num_terms=self.__matrix.shape[1], vectorizer=self.__vectorizer_params())
+        linked = []
+        if shared is None:
+            segments = self.__save_base(temporary)
+        else:
+            segments = {}
+            base = os.path.join(shared, f"base-{self.__base_id}")
+            if not os.path.exists(os.path.join(base, HEADER)):
+                os.makedirs(f"{base}.tmp", exist_ok=True)
+                write_header(f"{base}.tmp", {"base_docs": base_docs}, self.__save_base(f"{base}.tmp"))
+                replace_directory(f"{base}.tmp", base)
+            linked.append(base)
+        if len(self.__deleted) > base_docs:
+            delta = vstack(self.__pending_rows, format="csr")
+            tags = self.__filter_index.tags_from(base_docs)
+            segments["delta"] = (
+                save_arrays(temporary, {
+                    "delta_data": delta.data,
+                    "delta_indices": delta.indices,
+                    "delta_indptr": delta.indptr
+                })
+                + save_strings(temporary, "delta_urls", self.__urls[base_docs:])
+                + save_strings(temporary, "delta_titles", self.__titles[base_docs:])
+                + save_strings(temporary, "delta_filter_tags", [tag for doc_tags in tags for tag in doc_tags])
+                + save_arrays(temporary, {"delta_filter_offsets": np.cumsum([0] + [len(doc_tags) for doc_tags in tags])})
+            )
+        if not search_only:
+            filters = [tags if isinstance(tags, (list, tuple)) else [] for tags in self.__column("filters")]
+            segments["pages"] = (
+                save_strings(temporary, "contents", self.__column("content"))
+                + save_strings(temporary, "page_filter_tags", [tag for tags in filters for tag in tags])
+                + save_arrays(temporary, {"page_filter_offsets": np.cumsum([0] + [len(tags) for tags in filters])})
+            )
+        segments["deleted"] = save_arrays(temporary, {"deleted": self.__deleted})
+        if not search_only:
+            queries, urls, rows = self.__get_feedback().to_arrays()
+            segments["feedback"] = (
+                save_strings(temporary, "feedback_queries", queries)
+                + save_strings(temporary, "feedback_urls", urls)
+                + save_arrays(temporary, {"feedback_rows": rows})
+            )
+        joblib.dump(self.__model, os.path.join(temporary, "ranker.joblib"))
+        segments["ranker"] = ["ranker.joblib"]
+        write_header(temporary, metadata, segments, linked)
+        replace_directory(temporary, directory)
+
+    def __save_base(self, directory: str) -> Dict[str, List[str]]:
+        """Write the base segments: vocabulary, matrix, postings, columns and filters of the documents in the matrix.
+
+        Returns:
+            The files written, by segment.
+        """
+        base_docs = 0 if self.__matrix is None else self.__matrix.shape[0]
+        segments = {}
+        if self.__matrix is not None:
+            segments["vocabulary"] = save_strings(directory, "vocabulary", self.__vectorizer.get_feature_names_out())
+            segments["idf"] = save_arrays(directory, {"idf": self.__vectorizer.idf_})
+            segments["matrix"] = save_arrays(directory, {
+                "matrix_data": self.__matrix.data,
+                "matrix_indices": self.__matrix.indices,
+                "matrix_indptr": self.__matrix.indptr
+            })
+            # Saved so the processes mapping the index do not each build the inverted index
+            postings = InvertedIndex(self.__matrix)
+            segments["postings"] = save_arrays(directory, {
+                "postings_data": postings.postings_matrix.data,
+                "postings_indices": postings.postings_matrix.indices,
+                "postings_indptr": postings.postings_matrix.indptr,
+                "postings_max": postings.max_weights
+            })
+        urls = self.__urls if len(self.__urls) == base_docs else self.__urls[:base_docs]
+        titles = self.__titles if len(self.__titles) == base_docs else self.__titles[:base_docs]
+        segments["columns"] = save_strings(directory, "urls", urls) + save_strings(directory, "titles", titles)
+        tags, filter_doc_ids, filter_offsets = self.__filter_index.to_arrays(base_docs)
+        segments["filters"] = (
+            save_strings(directory, "filter_tags", tags)
+            + save_arrays(directory, {"filter_doc_ids": filter_doc_ids, "filter_offsets": filter_offsets})
+        )
+        return segments
+
+    @classmethod
+    def load(cls, directory: str, verify: bool = True) -> 'SearchModel':
+        """Load a model written by save().
+
+        Only the header is read up front: the matrix, postings, vocabulary and
+        columns needed to search are memory-mapped, so processes loading the same
+        index share its memory, and the page contents and feedback are only read
+        when the model is first changed or retrained. A model saved search_only
+        can search but not be changed.
+
+        Args:
+            directory: Index directory.
+            verify: Check each segment against its checksums when it is first read.
+
+        Returns:
+            The loaded SearchModel.
+
+        Raises:
+            ValueError: If the index has an unsupported format version or a corrupted segment.
+        """
+        reader = IndexReader(directory, verify)
+        metadata = reader.metadata
+        num_docs = metadata["num_docs"]
+        base_docs = metadata.get("base_docs", num_docs)
+        obj = cls.__new__(cls)
+        obj.engine = metadata["engine"]
+        obj.__model = joblib.load(reader.path("ranker", "ranker.joblib"))
+        obj.__trained = metadata["trained"]
+        obj.__df = None
+        obj.__pending_pages = []
+        obj.__reader = reader
+        obj.__feedback = None
+        obj.__pending_rows = []
+        obj.__base_id = uuid4().hex
+        obj.__index = None
+        obj.__fit_docs, obj.__fit_terms, obj.__changed_docs, obj.__unknown_terms = metadata["drift"]
+        if "matrix" in reader:
+            obj.__vectorizer = cls.__restore_vectorizer(metadata["vectorizer"], reader.strings("vocabulary", "vocabulary"),
+                                                        reader.array("idf", "idf"))
+            obj.__matrix = csr_matrix((
+                reader.array("matrix", "matrix_data"),
+                reader.array("matrix", "matrix_indices"),
+                reader.array("matrix", "matrix_indptr")
+            ), shape=(base_docs, metadata["num_terms"]))
+            if "delta" in reader:
+                obj.__pending_rows = [csr_matrix((
+                    reader.array("delta", "delta_data"),
+                    reader.array("delta", "delta_indices"),
+                    reader.array("delta", "delta_indptr")
+                ), shape=(num_docs - base_docs, metadata["num_terms"]))]
+            if "postings" in reader:
+                postings = csc_matrix((
+                    reader.array("postings", "postings_data"),
+                    reader.array("postings", "postings_indices"),
+                    reader.array("postings", "postings_indptr")
+                ), shape=(base_docs, metadata["num_terms"]))
+                obj.__index = SegmentedIndex(InvertedIndex(postings, max_weights=reader.array("postings", "postings_max")))
+                for rows in obj.__pending_rows:
+                    obj.__index.extend(rows)
+        else:
+            obj.__vectorizer = TfidfVectorizer(stop_words="english")
+            obj.__matrix = None
+        obj.__deleted = reader.array("deleted", "deleted")
+        obj.__num_deleted = int(obj.__deleted.sum())
+        obj.__urls = reader.strings("columns", "urls")
+        obj.__titles = reader.strings("columns", "titles")
+        obj.__filter_index = FilterIndex.from_arrays(
+            # Indexes before the base segments kept the tags in the metadata
+            metadata["filter_tags"] if "filter_tags" in metadata else reader.strings("filters", "filter_tags").tolist(),
+            reader.array("filters", "filter_doc_ids"),
+            reader.array("filters", "filter_offsets"),
+            base_docs
+        )
+        if "delta" in reader:
+            obj.__urls = ChainedColumn([obj.__urls, reader.strings("delta", "delta_urls")])
+            obj.__titles = ChainedColumn([obj.__titles, reader.strings("delta", "delta_titles")])
+            tags = reader.strings("delta", "delta_filter_tags").tolist()
+            offsets = reader.array("delta", "delta_filter_offsets")
+            for i in range(len(offsets) - 1):
+                obj.__filter_index.add(tags[offsets[i]:offsets[i + 1]])
+        return obj
+
     @classmethod
-    def rebuild(cls, model: RandomForestRegressor, df: pd.DataFrame, 
-                vectorizer: TfidfVectorizer, matrix: csr_matrix) -> 'SearchModel':
+    def rebuild(cls, model: 'RandomForestRegressor', df: pd.DataFrame, 
+                vectorizer: TfidfVectorizer, matrix: csr_matrix, engine: str = "dense",
+                deleted: Optional[np.ndarray] = None, trained: bool = True,
+                feedback: Optional[FeedbackStore] = None) -> 'SearchModel':
         """Rebuild a SearchModel instance from pickled data.
         
         Args:
@@ -137,14 +1041,23 @@ class SearchModel:
             df: DataFrame containing page data.
             vectorizer: Fitted TfidfVectorizer instance.
             matrix: TF-IDF feature matrix.
+            engine: Retrieval engine used by improved_search.
+            deleted: Tombstone flags of removed pages not compacted yet.
+            trained: Whether the ranker has been fitted.
+            feedback: Feedback collected for the ranker, none when omitted.
             
         Returns:
             Reconstructed SearchModel instance.
         """
         obj = cls.__new__(cls)
         obj.__df = df
+        obj.__pending_pages = []
         obj.__vectorizer = vectorizer
         obj.__model = model
         obj.__matrix = matrix
-        obj.__trained = True
+        obj.__trained = trained
+        obj.__feedback = FeedbackStore() if feedback is None else feedback
+        obj.__reader = None
+        obj.engine = engine
+        obj.__reset_index(deleted)
         return obj
@@ -0,0 +1,94 @@
+"""
+QueryLog.py - Structured log of every search and click, for ranking and capacity analysis
+
+Every search is written as one JSON line to logs/queries_YYYYMMDD.jsonl: its
+trace id, query and options, the number of results and their top urls, the
+model version and worker process that served it and the seconds spent in each
+phase. Every click received on /feedback is written under the trace id of the
+search it came from, with the FeedBack fields, so impressions and clicks are
+joined on the trace id, and the click lines can be loaded back as they are with
+``Ingest.ingest_feedback`` (search lines are skipped as invalid there).
+
+As with LogManager, the server only queues records: a LogManager.LogWriter
+thread decodes the results, builds the JSON lines and writes them in batches.
+"""
+
+import json
+from secrets import token_hex
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+from LogManager import LogWriter
+from DataTypes import FeedBack, SearchQuery
+
+# Urls of the best results recorded per search
+TOP_URLS = 10
+# Records written per batch before the file is flushed
+BATCH_SIZE = 512
+
+def new_trace_id() -> str:
+    """Returns a random trace id for a request."""
+    return token_hex(8)
+
+class QueryLog:
+    """Append-only JSON Lines log of searches and clicks, written by a background thread."""
+    def __init__(self, prefix: str = "queries"):
+        """
+        Args:
+            prefix (str): Name of the log files before their date
+        """
+        self.__writer = LogWriter(self.__format_batch, prefix, "jsonl", "QueryLog", BATCH_SIZE)
+        self.__writer.start()
+
+    def search(self, trace: str, query: SearchQuery, text: str, encoded: str, version: int,
+               details: Optional[Dict[str, Any]] = None, index: Optional[int] = None) -> None:
+        """
+        Records a search once it is answered.
+
+        Args:
+            trace (str): Trace id of the request
+            query (SearchQuery): The search request
+            text (str): The search text, one of the queries of a batch request
+            encoded (str): The results encoded as a JSON list, as sent to the client
+            version (int): Model version that produced the results
+            details (Optional[Dict[str, Any]]): Worker and per-phase timings of the search, None if it came from the result cache
+            index (Optional[int]): Position of the query in a batch request
+        """
+        record = {
+            "type": "search",
+            "time": time(),
+            "trace": trace,
+            "query": text,
+            "filters": query.get("filters"),
+            "limit": query.get("limit"),
+            "offset": query.get("offset", 0),
+            "engine": query.get("engine"),
+            "version": version,
+            "cached": details is None
+        }
+        if index is not None:
+            record["index"] = index
+        if details is not None:
+            record.update(details)
+        self.__writer.put((record, encoded))
+
+    def click(self, event: FeedBack) -> None:
+        """Records a feedback event, under the trace id of its search when the client sent it back."""
+        record = {"type": "click", "time": time(), "trace": event.get("trace"),
+                  "query": event["query"], "url": event["url"], "clicked": int(event["clicked"])}
+        self.__writer.put((record, None))
+
+    def flush(self, timeout: Optional[float] = 5) -> bool:
+        """Waits until the queued records are written, returning False on timeout."""
+        return self.__writer.flush(timeout)
+
+    @staticmethod
+    def __format_batch(batch: List[Tuple[Dict[str, Any], Optional[str]]]) -> str:
+        """Decodes the results of a batch of (record, encoded results) and returns its JSON lines."""
+        lines = []
+        for record, encoded in batch:
+            if encoded is not None:
+                results = json.loads(encoded)
+                record["results"] = len(results)
+                record["top"] = [result[0] for result in results[:TOP_URLS]]
+            lines.append(json.dumps(record) + "\n")
+        return "".join(lines)
@@ -0,0 +1,74 @@
+"""
+Ranker that learns from feedback incrementally.
+
+The ranker scores a candidate from its keyword similarity alone. Instead of
+refitting a forest on every feedback row, ``OnlineRanker`` keeps click-through
+statistics per similarity bin: each feedback event adds to the clicks and views
+of its bin, and a score is the smoothed click-through rate interpolated between
+the bin centers. Updating it costs the size of the mini-batch, whatever the
+amount of feedback seen before, so new clicks can be folded in within minutes.
+
+It follows the scikit-learn estimator interface (``fit``, ``partial_fit``,
+``predict``) so SearchModel can use it in place of the RandomForestRegressor.
+"""
+
+import numpy as np
+from sklearn.base import BaseEstimator, RegressorMixin
+
+
+class OnlineRanker(RegressorMixin, BaseEstimator):
+    """Click-through rate per keyword similarity bin, updatable one mini-batch at a time."""
+
+    def __init__(self, bins: int = 50, prior: float = 1.0) -> None:
+        """Create an untrained ranker.
+
+        Args:
+            bins: Number of equal-width bins splitting similarities in [0, 1].
+            prior: Weight, in views, of the overall click-through rate mixed into
+                every bin so sparsely seen bins are not ranked on a handful of clicks.
+        """
+        self.bins = bins
+        self.prior = prior
+
+    def fit(self, X: np.ndarray, y: np.ndarray) -> 'OnlineRanker':
+        """Learn the statistics from scratch.
+
+        Args:
+            X: n x 1 array of keyword similarities.
+            y: Click labels, 1 for a click and 0 for a result seen but not picked.
+        """
+        self.clicks_ = np.zeros(self.bins)
+        self.views_ = np.zeros(self.bins)
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X: np.ndarray, y: np.ndarray) -> 'OnlineRanker':
+        """Add a mini-batch of feedback to the statistics.
+
+        Args:
+            X: n x 1 array of keyword similarities.
+            y: Click labels, 1 for a click and 0 for a result seen but not picked.
+        """
+        if not hasattr(self, "views_"):
+            return self.fit(X, y)
+        slots = self.__bin(np.asarray(X, dtype=np.float64).reshape(-1))
+        self.clicks_ = self.clicks_ + np.bincount(slots, weights=np.asarray(y, dtype=np.float64), minlength=self.bins)
+        self.views_ = self.views_ + np.bincount(slots, minlength=self.bins)
+        return self
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """Score candidates by the smoothed click-through rate around their similarity.
+
+        Args:
+            X: n x 1 array of keyword similarities.
+
+        Returns:
+            Array of n scores.
+        """
+        overall = self.clicks_.sum() / max(self.views_.sum(), 1)
+        rates = (self.clicks_ + self.prior * overall) / (self.views_ + self.prior)
+        centers = (np.arange(self.bins) + 0.5) / self.bins
+        return np.interp(np.asarray(X, dtype=np.float64).reshape(-1), centers, rates)
+
+    def __bin(self, similarities: np.ndarray) -> np.ndarray:
+        """Return the bin of each similarity."""
+        return np.clip((similarities * self.bins).astype(np.intp), 0, self.bins - 1)
@@ -1,47 +1,501 @@
-from asyncio import sleep, create_task, get_event_loop, to_thread
+from asyncio import Event, Semaphore, Task, as_completed, create_task, get_running_loop, sleep, wait
 import websockets as ws
-from Cache import CacheHandle,get_model
+from Cache import CacheHandle,ResultCache,get_model_holder
 from LogManager import *
-from DataTypes import SearchQuery
-from multiprocessing.pool import Pool
-from typing import Callable
+from DataTypes import SearchQuery, SearchResponse, Setting
+from Ingest import validate_feedback
+from Model import RANKERS, SearchModel
+from Workers import SearchPool, ThreadSearcher
+from Metrics import add_collector, count, observe, render
+from QueryLog import QueryLog, new_trace_id
+from http import HTTPStatus
+from typing import Any, AsyncIterator, Callable, Optional
+from time import monotonic, perf_counter, time
 import json
+import os
+import signal
 
-# Global process pool for handling CPU-intensive tasks
-__POOL = Pool()
+# Runs the searches: worker processes created by start_server, or the search thread of an acceptor process
+search_pool: Optional[SearchPool | ThreadSearcher] = None
+# Encoded results of recent queries, created by start_server or an acceptor process
+result_cache: Optional[ResultCache] = None
+# Structured log of the searches and clicks, created by start_server or an acceptor process
+query_log: Optional[QueryLog] = None
+# Seconds spent in each phase of the last start_server until it was ready
+startup_timings: dict[str, float] = {}
+# Returns the text served on /metrics: those of this process, or in an acceptor process those of every process
+metrics_page: Callable[[], str] = render
+# Maximum number of queries a single connection may have running at once
+MAX_IN_FLIGHT = 8
+# Number of queries of a batch request searched together on one worker
+BATCH_CHUNK = 64
+# Prefix of the environment variables overriding settings, e.g. CTE_SEARCH_PORT=8080
+ENV_PREFIX = "CTE_SEARCH_"
+# Seconds the searches in flight are given to finish once the server is asked to stop
+DRAIN_TIMEOUT = 30.0
+# Signals the serve command drains the server on
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+# Open /search connections, and whether the server is draining them before it stops
+sessions: set['SearchSession'] = set()
+draining = False
 
-async def quick_fork(target: Callable, *args, **kwargs):
+class SearchSession:
     """
-    Executes a CPU-intensive function in a separate process pool.
-    
+    A persistent /search connection serving a stream of queries.
+
+    Queries run concurrently, at most MAX_IN_FLIGHT at a time; further messages are
+    not read until a slot frees up. A query that carries an id and a stream replaces
+    the unanswered query of that stream, which is cancelled and answered with a
+    SearchResponse marked cancelled instead of its results.
+    """
+    def __init__(self, websocket: ws.ServerConnection):
+        self.websocket = websocket
+        self.__slots = Semaphore(MAX_IN_FLIGHT)
+        # stream -> its unanswered query and that query's id
+        self.__streams: dict[str, tuple[Task, str | int]] = {}
+        self.__tasks: set[Task] = set()
+
+    async def submit(self, message: str | bytes, received: float):
+        """
+        Starts answering a query message, waiting for a free slot first.
+
+        Args:
+            message (str | bytes): The raw websocket message
+            received (float): perf_counter() time the message was received at
+        """
+        start = perf_counter()
+        try:
+            query: SearchQuery = json.loads(message)
+            if "queries" in query:
+                queries = query["queries"]
+                if not isinstance(queries, list) or len(queries) == 0 or not all(isinstance(text, str) for text in queries):
+                    raise TypeError("queries must be a non-empty list of strings")
+            else:
+                query["query"]
+            if not isinstance(query.get("stream", ""), str):
+                raise TypeError("stream must be a string")
+        except (ValueError, TypeError, KeyError):
+            count("errors", reason="malformed")
+            warning("Rejected malformed search query")
+            await self.websocket.send(json.dumps({"error": "Malformed search query"}))
+            return
+        observe("stage_seconds", perf_counter() - start, stage="decode")
+        if draining:
+            count("errors", reason="draining")
+            error_response = {"error": "Server is shutting down"}
+            if "id" in query:
+                error_response = SearchResponse(id=query["id"], **error_response)
+            await self.websocket.send(json.dumps(error_response))
+            return
+
+        stream = query.get("stream") if "id" in query else None
+        if stream is not None and stream in self.__streams:
+            stale, stale_id = self.__streams.pop(stream)
+            stale.cancel()
+            await wait([stale])
+            if stale.cancelled():
+                await self.websocket.send(json.dumps(SearchResponse(id=stale_id, cancelled=True)))
+
+        await self.__slots.acquire()
+        task = create_task(self.__answer(query, received))
+        # Released once the task is done, even when it is cancelled before it started running
+        task.add_done_callback(lambda done: self.__slots.release())
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        if stream is not None:
+            self.__streams[stream] = (task, query["id"])
+            task.add_done_callback(lambda done: self.__forget(stream, done))
+
+    def __forget(self, stream: str, task: Task):
+        """Drops a finished query from its stream unless a newer one already took its place."""
+        if stream in self.__streams and self.__streams[stream][0] is task:
+            del self.__streams[stream]
+
+    async def __answer(self, query: SearchQuery, received: float):
+        """Runs one query and sends its response."""
+        kind = "batch" if "queries" in query else "single"
+        # Time spent waiting between the message arriving and its search starting
+        observe("stage_seconds", perf_counter() - received, stage="receive")
+        count("queries", kind=kind)
+        trace = query.get("trace") or new_trace_id()
+        try:
+            if kind == "batch":
+                async for index, encoded in cached_batch_search(query, trace):
+                    await self.__send(query, trace, encoded, index)
+            else:
+                await self.__send(query, trace, await cached_search(query, trace))
+            observe("query_seconds", perf_counter() - received, kind=kind)
+        except ValueError as e:
+            count("errors", reason="rejected")
+            warning(f"Rejected search query: {str(e)}")
+            error_response = {"error": str(e)}
+            if "id" in query:
+                error_response = SearchResponse(id=query["id"], **error_response)
+            await self.websocket.send(json.dumps(error_response))
+        except Exception:
+            count("errors", reason="failed")
+            raise
+
+    async def __send(self, query: SearchQuery, trace: str, encoded: str, index: Optional[int] = None):
+        """Sends encoded results, in a SearchResponse unless the query is a bare legacy one."""
+        start = perf_counter()
+        if "id" not in query and index is None:
+            await self.websocket.send(encoded)
+            observe("stage_seconds", perf_counter() - start, stage="send")
+            return
+        # The results are already encoded, only the envelope is built here
+        fields = []
+        if "id" in query:
+            fields.append(f'"id": {json.dumps(query["id"])}')
+        if index is not None:
+            fields.append(f'"index": {index}')
+        fields.append(f'"trace": {json.dumps(trace)}')
+        fields.append(f'"results": {encoded}')
+        await self.websocket.send("{" + ", ".join(fields) + "}")
+        observe("stage_seconds", perf_counter() - start, stage="send")
+
+    @property
+    def in_flight(self) -> set[Task]:
+        """The queries still running."""
+        return set(self.__tasks)
+
+    def close(self):
+        """Cancels the queries still running when the connection goes away."""
+        for task in list(self.__tasks):
+            task.cancel()
+
+async def cached_search(query: SearchQuery, trace: str) -> str:
+    """
+    Answers a query from the result cache, searching on a worker on a miss, and records it in the query log.
+
     Args:
-        target (Callable): The function to execute
-        *args: Positional arguments for the target function
-        **kwargs: Keyword arguments for the target function
-        
+        query (SearchQuery): The search request
+        trace (str): Trace id of the request
+
     Returns:
-        The result of the target function
+        str: The results encoded as a JSON list
     """
-    task =__POOL.apply_async(target, args, kwargs)
-    if not task.ready():
-        await sleep(0)
-    else:
-        return task.get()
+    model, version = get_model_holder().current
+    encoded = result_cache.get(ResultCache.key(query, version))
+    count("cache_lookups", result="miss" if encoded is None else "hit")
+    details = None
+    if encoded is None:
+        details = {}
+        results, version = await search_pool.search(model, version, query, details)
+        encoded = json.dumps(results)
+        result_cache.put(ResultCache.key(query, version), encoded)
+    query_log.search(trace, query, query["query"], encoded, version, details)
+    return encoded
+
+async def cached_batch_search(query: SearchQuery, trace: str) -> AsyncIterator[tuple[int, str]]:
+    """
+    Answers the queries of a batch request as they become ready.
+
+    Cached queries are answered first. The others are searched in chunks of
+    BATCH_CHUNK queries, each chunk in a single SearchModel.batch_search call on
+    a worker, the chunks running in parallel. Every query is recorded in the
+    query log under the trace id of the batch and its index.
+
+    Args:
+        query (SearchQuery): The batch request
+        trace (str): Trace id of the request
+
+    Yields:
+        tuple[int, str]: The index of a query in the batch and its results encoded as a JSON list
+    """
+    model, version = get_model_holder().current
+    queries = query["queries"]
+    misses = []
+    for index, text in enumerate(queries):
+        encoded = result_cache.get(ResultCache.key({**query, "query": text}, version))
+        count("cache_lookups", result="miss" if encoded is None else "hit")
+        if encoded is None:
+            misses.append(index)
+        else:
+            query_log.search(trace, query, text, encoded, version, index=index)
+            yield index, encoded
+
+    async def search_chunk(chunk: list[int]):
+        details = {}
+        results, served = await search_pool.batch_search(model, version, query, [queries[i] for i in chunk], details)
+        return chunk, results, served, details
+
+    tasks = [create_task(search_chunk(misses[i:i + BATCH_CHUNK])) for i in range(0, len(misses), BATCH_CHUNK)]
+    try:
+        for next_chunk in as_completed(tasks):
+            chunk, results, served, details = await next_chunk
+            for index, result in zip(chunk, results):
+                encoded = json.dumps(result)
+                result_cache.put(ResultCache.key({**query, "query": queries[index]}, served), encoded)
+                query_log.search(trace, query, queries[index], encoded, served, details, index)
+                yield index, encoded
+    finally:
+        for task in tasks:
+            task.cancel()
 
 async def handle_search(websocket: ws.ServerConnection):
     """
     Handles incoming search requests from websocket clients.
+
+    The connection stays open and every message is a SearchQuery, see SearchSession.
     
     Args:
         websocket (ws.ServerConnection): The websocket connection to the client
     """
-    model = get_model()
-    if model:
-        query: SearchQuery = json.loads(await websocket.recv())
-        results = await quick_fork(model.improved_search, query["query"], query["filters"])
-        await websocket.send(json.dumps(results))
+    session = SearchSession(websocket)
+    sessions.add(session)
+    try:
+        async for message in websocket:
+            await session.submit(message, perf_counter())
+    finally:
+        sessions.discard(session)
+        session.close()
+
+async def handle_feedback(websocket: ws.ServerConnection):
+    """
+    Collects the feedback clients send over a persistent connection.
+
+    Every message is a FeedBack or a list of them. The events are handed to the
+    model in mini-batches by learn_feedback, and recorded in the query log under
+    the trace id of the search response they are about.
+
+    Args:
+        websocket (ws.ServerConnection): The websocket connection to the client
+    """
+    async for message in websocket:
+        try:
+            events = json.loads(message)
+            events = [validate_feedback(event) for event in (events if isinstance(events, list) else [events])]
+        except ValueError:
+            warning("Rejected malformed feedback")
+            await websocket.send(json.dumps({"error": "Malformed feedback"}))
+            continue
+        get_model_holder().receive_feedback(events)
+        for event in events:
+            query_log.click(event)
+
+async def learn_feedback(interval: float = 300):
+    """
+    Periodically hands the feedback received since the last run to the model.
+
+    With the online ranker the published model ranks with the new clicks right away,
+    without waiting for the next retrain. See SearchModel.learn.
+
+    Args:
+        interval (float): Seconds between mini-batches
+    """
+    holder = get_model_holder()
+    while True:
+        await sleep(interval)
+        pending = holder.pending_feedback
+        if pending == 0:
+            continue
+        try:
+            learned = await holder.learn_pending()
+            debug(f"Recorded {pending} feedback events, ranker updated with {learned}")
+        except Exception as e:
+            error(f"Feedback update failed: {str(e)}")
+
+async def maintain_model(interval: float = 60):
+    """
+    Periodically compacts removed pages and refreshes the vocabulary of the served model.
+
+    Page edits only append rows or mark tombstones; the heavier rebuilds happen here,
+    on a copy of the model that is hot-swapped in once SearchModel.maintain is done.
+
+    Args:
+        interval (float): Seconds between maintenance checks
+    """
+    holder = get_model_holder()
+    while True:
+        await sleep(interval)
+        try:
+            if holder.model.pending_maintenance:
+                action = await holder.apply("maintain")
+                info(f"Model maintenance ran: {action}")
+        except Exception as e:
+            error(f"Model maintenance failed: {str(e)}")
+
+async def retrain_model(interval: float = 3600):
+    """
+    Retrains the ranker at every multiple of the interval (on the hour by default).
+
+    The retrain runs on a copy of the model which replaces the served one when done,
+    so searches are not slowed down while it runs.
+
+    Args:
+        interval (float): Seconds between retrains
+    """
+    holder = get_model_holder()
+    while True:
+        await sleep(interval - time() % interval)
+        try:
+            timings = await holder.apply("retrain")
+            if timings is not None:
+                phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items())
+                info(f"Model retrained ({phases}), now serving version {holder.version}")
+                # Replaying a retrain would refit the whole ranker, save the result instead
+                await holder.checkpoint()
+        except Exception as e:
+            error(f"Scheduled retrain failed: {str(e)}")
+
+async def checkpoint_cache(interval: float = 600):
+    """
+    Periodically saves the model and settings and truncates the journal of changes.
+
+    Changes are journaled as they happen, so this only bounds how long the journal
+    (and its replay on the next start) can grow. See CacheHandle.checkpoint.
+
+    Args:
+        interval (float): Seconds between checkpoints
+    """
+    holder = get_model_holder()
+    cache = CacheHandle.load()
+    while True:
+        await sleep(interval)
+        if cache.unsaved_changes > 0:
+            await holder.checkpoint()
+            debug(f"Checkpoint saved at journal position {cache.journal_position}")
+
+def serve_metrics(connection: ws.ServerConnection, request: ws.Request) -> Optional[ws.Response]:
+    """
+    Answers plain HTTP requests for /metrics, before any websocket handshake.
+
+    Args:
+        connection (ws.ServerConnection): The connection the request came in on
+        request (ws.Request): The HTTP request
+
+    Returns:
+        Optional[ws.Response]: The metrics in the Prometheus text format, or None to go on with the handshake
+    """
+    if request.path == "/metrics":
+        return connection.respond(HTTPStatus.OK, metrics_page())
+    return None
+
+def collect_index_stats() -> dict[str, float]:
+    """Gauges of the served model and the result cache, read when metrics are scraped."""
+    holder = get_model_holder()
+    gauges = {f"index_{name}": value for name, value in holder.model.stats.items()}
+    gauges["model_version"] = holder.version
+    gauges["pending_feedback"] = holder.pending_feedback
+    gauges["unsaved_changes"] = holder.unsaved_changes
+    if result_cache is not None:
+        gauges.update({f"result_cache_{name}": value for name, value in result_cache.stats.items()})
+    gauges.update({f"startup_{phase}_seconds": seconds for phase, seconds in startup_timings.items()})
+    return gauges
+
+add_collector(collect_index_stats)
+
+def resolve_settings(overrides: Optional[dict[str, str]] = None) -> list[Setting]:
+    """
+    Returns the cached settings with those given in the environment or as overrides replaced.
+
+    An override wins over a CTE_SEARCH_<NAME> environment variable, which wins over
+    the cached value. The replaced values only apply to this process, the cached
+    settings are left unchanged.
+
+    Args:
+        overrides (Optional[dict[str, str]]): Raw values by setting name, e.g. from the command line
+
+    Returns:
+        list[Setting]: The settings to run with
+
+    Raises:
+        ValueError: If an override names an unknown setting or a value does not match the type of its setting
+    """
+    overrides = overrides or {}
+    settings = CacheHandle.load().settings
+    unknown = set(overrides) - {setting.name for setting in settings}
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+    resolved = []
+    for setting in settings:
+        value = overrides.get(setting.name, os.environ.get(ENV_PREFIX + setting.name.upper()))
+        if value is not None:
+            setting = Setting.from_json({**setting.to_json(), "value": value})
+        resolved.append(setting)
+    return resolved
+
+def server_config(overrides: Optional[dict[str, str]] = None) -> dict[str, Any]:
+    """
+    Returns the configuration the server runs with: the settings of resolve_settings, defaults filled in.
+
+    Args:
+        overrides (Optional[dict[str, str]]): Setting values replacing the cached ones
+
+    Returns:
+        dict[str, Any]: address, port, workers, result_cache_mb, result_cache_ttl, ranker and acceptors
+
+    Raises:
+        ValueError: If the settings are invalid, see resolve_settings, or the ranker is unknown
+    """
+    # Default server configuration
+    config = {
+        "address": "0.0.0.0",
+        "port": 80,  # Set default port to standard websocket port
+        "workers": 0,  # One search worker per CPU core
+        "result_cache_mb": 64,
+        "result_cache_ttl": 0.0,  # Cached results live until evicted or the model changes
+        "ranker": "",  # Keep the ranker of the cached model
+        "acceptors": 1  # A single process accepting connections
+    }
+    # Settings whose empty or zero value means the default
+    defaulted = ("address", "port", "result_cache_mb", "acceptors")
+    for setting in resolve_settings(overrides):
+        if setting.name in config and not (setting.name in defaulted and not setting.value):
+            config[setting.name] = setting.value
+    if config["ranker"] not in ("",) + RANKERS:
+        raise ValueError(f"Unknown ranker {config['ranker']}, expected one of {', '.join(RANKERS)}")
+    return config
+
+def clear_result_cache(model: SearchModel, version: int):
+    """Drops the cached results once another model version is served, registered as a model holder listener."""
+    if result_cache is not None:
+        result_cache.clear()
+
+async def apply_ranker(ranker: str):
+    """
+    Switches the served model to the ranker of the settings, recording the time it took in startup_timings.
+
+    Args:
+        ranker (str): One of the Model RANKERS, or empty to keep the ranker of the cached model
+    """
+    holder = get_model_holder()
+    if ranker != "" and ranker != holder.model.ranker:
+        start = perf_counter()
+        await holder.apply("ranker", ranker)
+        startup_timings["ranker"] = perf_counter() - start
+        info(f"Switched to the {ranker} ranker")
+
+async def drain(server: ws.Server, timeout: float = DRAIN_TIMEOUT):
+    """
+    Stops the server without dropping the searches in flight.
+
+    New connections are refused right away and new queries on open connections
+    are answered with an error, while the queries already running get up to
+    timeout seconds to be answered. The connections are then closed with code
+    1001 (going away).
+
+    Args:
+        server (ws.Server): The server to stop
+        timeout (float): Seconds to wait for the searches in flight
+    """
+    global draining
+    draining = True
+    server.server.close()
+    deadline = monotonic() + timeout
+    while True:
+        pending = set().union(*(session.in_flight for session in sessions))
+        if not pending or monotonic() >= deadline:
+            break
+        await wait(pending, timeout=deadline - monotonic())
+    if pending:
+        warning(f"Dropping {len(pending)} searches still running after {timeout}s")
     else:
-        critical("Failed to load model")
+        info("Every search in flight was answered")
+    server.close()
+    await server.wait_closed()
+    draining = False
 
 async def handle_server(websocket: ws.ServerConnection):
     """
@@ -53,32 +507,111 @@ async def handle_server(websocket: ws.ServerConnection):
     try:
         if websocket.request.path == "/search":
             await handle_search(websocket)
+        elif websocket.request.path == "/feedback":
+            await handle_feedback(websocket)
     except ws.ConnectionClosed as e:
         error(f"disconnected: {str(e)}")
 
 
-async def start_server():
+async def start_server(started: Optional[float] = None, overrides: Optional[dict[str, str]] = None,
+                       stop: Optional[Event] = None, drain_timeout: float = DRAIN_TIMEOUT):
     """
     Initializes and starts the websocket server using configuration from cache.
     Handles server lifecycle and logging.
+
+    Connections are only accepted once the cache is loaded and every search worker
+    has loaded and warmed up the model, so the first queries are as fast as the
+    next ones. The time spent in each phase is logged and exported as metrics.
+
+    With more than one acceptor in the settings, this process coordinates acceptor
+    processes sharing the port instead of serving itself, see Acceptors.
+
+    Args:
+        started (Optional[float]): perf_counter() when the process started, to also
+            report the time spent before start_server, mostly importing modules
+        overrides (Optional[dict[str, str]]): Setting values replacing the cached ones, see resolve_settings
+        stop (Optional[Event]): Set to stop the server, draining it first (see drain); without it the
+            server runs until the task is cancelled
+        drain_timeout (float): Seconds the searches in flight are given to finish once stop is set
     """
-    cache = CacheHandle.load()
-    # Default server configuration
-    addr = "0.0.0.0"
-    port = 80  # Set default port to standard websocket port
-    if "settings" in cache:
-        for setting in cache.settings:
-            if setting.name == "address":
-                addr = setting.value if setting.value != "" else addr
-            elif setting.name == "port":
-                port = setting.value if setting.value != 0 else port
-
-    server = await ws.serve(
-        handler=handle_server,
-        host=addr,
-        port=int(port)
-    )
-    
-    info(f"WebSocket server started on ws://{addr}:{port}")
-    await server.wait_closed()
+    global search_pool, result_cache, query_log
+    startup_timings.clear()
+    if started is not None:
+        startup_timings["imports"] = perf_counter() - started
+    start = perf_counter()
+    holder = get_model_holder()
+    startup_timings["cache"] = perf_counter() - start
+    config = server_config(overrides)
+    if config["acceptors"] > 1:
+        from Acceptors import Coordinator  # Acceptors builds on this module
+        await Coordinator(config, drain_timeout).run(stop)
+        return
+    search_pool = SearchPool(config["workers"])
+    result_cache = ResultCache(config["result_cache_mb"] * 1024 * 1024, config["result_cache_ttl"])
+    query_log = query_log or QueryLog()
+    holder.add_listener(clear_result_cache)
+    await apply_ranker(config["ranker"])
+    addr, port = config["address"], config["port"]
+
+    model, version = holder.current
+    background = []
+    try:
+        startup_timings.update(await search_pool.start(model, version))
+        start = perf_counter()
+        server = await ws.serve(
+            handler=handle_server,
+            process_request=serve_metrics,
+            host=addr,
+            port=int(port)
+        )
+        startup_timings["listen"] = perf_counter() - start
+
+        breakdown = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in startup_timings.items())
+        info(f"WebSocket server ready on ws://{addr}:{port} in {sum(startup_timings.values()):.3f}s ({breakdown})")
+        background = [create_task(maintain_model()), create_task(retrain_model()), create_task(learn_feedback()),
+                      create_task(checkpoint_cache())]
+        if stop is not None:
+            await stop.wait()
+            await drain(server, drain_timeout)
+        await server.wait_closed()
+    finally:
+        for task in background:
+            task.cancel()
+        search_pool.shutdown()
     info("Server closed")
+
+def stop_on_signals(stop: Event):
+    """
+    Sets an event on the first of the STOP_SIGNALS the running event loop receives.
+
+    Args:
+        stop (Event): The event, as start_server takes it
+    """
+    def request_stop(signum: int):
+        if not stop.is_set():
+            info(f"Received {signal.Signals(signum).name}, draining the server")
+            stop.set()
+    for signum in STOP_SIGNALS:
+        get_running_loop().add_signal_handler(signum, request_stop, signum)
+
+async def serve(overrides: Optional[dict[str, str]] = None, started: Optional[float] = None,
+                drain_timeout: float = DRAIN_TIMEOUT):
+    """
+    Runs the server without the interface until SIGTERM or SIGINT, then drains it.
+
+    The cache is checkpointed on exit as usual, see CacheHandle.unload.
+
+    Args:
+        overrides (Optional[dict[str, str]]): Setting values replacing the cached ones, see resolve_settings
+        started (Optional[float]): perf_counter() when the process started, see start_server
+        drain_timeout (float): Seconds the searches in flight are given to finish after the signal
+    """
+    stop = Event()
+    stop_on_signals(stop)
+    try:
+        await start_server(started, overrides, stop, drain_timeout)
+    finally:
+        for signum in STOP_SIGNALS:
+            get_running_loop().remove_signal_handler(signum)
+        if query_log is not None:
+            query_log.flush()
@@ -0,0 +1,306 @@
+"""
+Snapshot.py - Memory-mappable on-disk index of the search model
+
+An index directory holds one .npy file per array of the model (the CSR TF-IDF
+matrix, the postings, the document columns, the filter index, the vocabulary,
+the page data and the feedback) next to a small JSON header naming the format
+and its version, the model metadata, and the files of each segment (vocabulary,
+idf, matrix, postings, columns, pages, filters, deleted, feedback, ranker) with
+their CRC-32 checksums. IndexReader only reads the header up front; a segment is
+checked against its checksums and mapped read-only the first time it is used,
+so every process loading the same index shares a single copy of it through the
+page cache rather than holding its own.
+
+Strings, such as urls, titles and vocabulary terms, are stored as one UTF-8 byte
+buffer plus an offsets array and decoded on access by StringColumn.
+
+A segment may also be stored in another directory, which the header names
+relative to the index. The versions exported to the search workers and acceptors
+share the segments of the documents they have in common this way: only the
+documents added since, the tombstones and the ranker are written per version.
+
+SearchModel.save and SearchModel.load build on these helpers. The checkpoint
+of the cache and the versions exported to the search workers and acceptors are
+all index directories, the latter saved without the pages and feedback segments.
+"""
+
+import json
+import os
+import shutil
+import zlib
+import numpy as np
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Union
+
+HEADER = "header.json"
+# Format name and version written in every index header; version 2 added the postings segment,
+# version 3 the delta segment and segments stored in other directories
+INDEX_FORMAT = "cte-search-index"
+INDEX_VERSION = 3
+
+class StringColumn:
+    """Read-only column of strings stored as a UTF-8 buffer and row offsets."""
+    def __init__(self, buffer: np.ndarray, offsets: np.ndarray):
+        """Wrap existing arrays, typically memory-mapped.
+
+        Args:
+            buffer (np.ndarray): uint8 array holding every string back to back
+            offsets (np.ndarray): n + 1 positions in buffer, string i is buffer[offsets[i]:offsets[i + 1]]
+        """
+        self.buffer = buffer
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, values: Iterable[Any]) -> 'StringColumn':
+        """Encode a sequence of strings; None is stored as an empty string."""
+        encoded = [("" if value is None else str(value)).encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(buffer, offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __decode(self, i: int) -> str:
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __getitem__(self, index: Union[int, slice, np.ndarray]) -> Union[str, np.ndarray]:
+        """Return one string, or an object array of strings for a slice, index array or mask."""
+        positions = column_positions(index, len(self))
+        if isinstance(positions, int):
+            return self.__decode(positions)
+        return np.array([self.__decode(i) for i in positions], dtype=object)
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self.__decode(i)
+
+    def tolist(self) -> List[str]:
+        return list(self)
+
+class ChainedColumn:
+    """Read-only concatenation of string columns, such as those of the base and delta segments of an index."""
+    def __init__(self, parts: List[StringColumn]):
+        """
+        Args:
+            parts (List[StringColumn]): Columns holding consecutive rows
+        """
+        self.parts = parts
+        self.__starts = np.cumsum([0] + [len(part) for part in parts])
+
+    def __len__(self) -> int:
+        return int(self.__starts[-1])
+
+    def __getitem__(self, index: Union[int, slice, np.ndarray]) -> Union[str, np.ndarray]:
+        """Return one string, or an object array of strings, as StringColumn does."""
+        positions = column_positions(index, len(self))
+        if isinstance(positions, int):
+            part = int(np.searchsorted(self.__starts, positions, side="right")) - 1
+            return self.parts[part][positions - int(self.__starts[part])]
+        positions = np.asarray(positions, dtype=np.int64)
+        parts = np.searchsorted(self.__starts, positions, side="right") - 1
+        values = np.empty(len(positions), dtype=object)
+        for part in np.unique(parts):
+            rows = parts == part
+            values[rows] = self.parts[part][positions[rows] - self.__starts[part]]
+        return values
+
+    def __iter__(self) -> Iterator[str]:
+        for part in self.parts:
+            yield from part
+
+    def tolist(self) -> List[str]:
+        return list(self)
+
+def column_positions(index: Union[int, slice, np.ndarray], size: int) -> Union[int, range, np.ndarray]:
+    """Resolve an index into a column of size strings to a row, or to the rows it selects.
+
+    Raises:
+        IndexError: If the index is out of bounds or a mask of the wrong shape
+    """
+    if isinstance(index, (int, np.integer)):
+        i = int(index)
+        if not -size <= i < size:
+            raise IndexError(f"index {i} is out of bounds for a column of {size} strings")
+        return i % size
+    if isinstance(index, slice):
+        return range(*index.indices(size))
+    positions = np.asarray(index)
+    if positions.dtype == bool:
+        if positions.shape != (size,):
+            raise IndexError(f"boolean index of shape {positions.shape} does not match a column of {size} strings")
+        return np.flatnonzero(positions)
+    if positions.size and ((positions < -size).any() or (positions >= size).any()):
+        raise IndexError(f"index is out of bounds for a column of {size} strings")
+    return positions.ravel() % max(size, 1)
+
+def save_arrays(directory: str, arrays: Dict[str, np.ndarray]) -> List[str]:
+    """Write each array to <directory>/<name>.npy.
+
+    Args:
+        directory (str): Existing directory to write into
+        arrays (Dict[str, np.ndarray]): Arrays by name
+
+    Returns:
+        List[str]: Names of the files written
+    """
+    files = []
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(array), allow_pickle=False)
+        files.append(f"{name}.npy")
+    return files
+
+def load_array(directory: str, name: str) -> np.ndarray:
+    """Map <directory>/<name>.npy read-only.
+
+    Args:
+        directory (str): Snapshot directory
+        name (str): Array name
+
+    Returns:
+        np.ndarray: The memory-mapped array (a plain array if it is empty, which cannot be mapped)
+    """
+    path = os.path.join(directory, f"{name}.npy")
+    try:
+        return np.load(path, mmap_mode="r", allow_pickle=False)
+    except ValueError:
+        # Zero-length arrays cannot be memory-mapped
+        return np.load(path, allow_pickle=False)
+
+def save_strings(directory: str, name: str, values: Iterable[Any]) -> List[str]:
+    """Write a string column as <name>_buffer.npy and <name>_offsets.npy, returning the file names."""
+    column = values if isinstance(values, StringColumn) else StringColumn.from_strings(values)
+    return save_arrays(directory, {f"{name}_buffer": column.buffer, f"{name}_offsets": column.offsets})
+
+def load_strings(directory: str, name: str) -> StringColumn:
+    """Map a string column written by save_strings."""
+    return StringColumn(load_array(directory, f"{name}_buffer"), load_array(directory, f"{name}_offsets"))
+
+def checksum(path: str) -> int:
+    """Return the CRC-32 of a file."""
+    crc = 0
+    with open(path, "rb") as file:
+        while block := file.read(1 << 20):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+def write_header(directory: str, metadata: Dict[str, Any], segments: Dict[str, List[str]],
+                 linked: Optional[List[str]] = None) -> None:
+    """Write the header of an index directory, checksumming the files of every segment.
+
+    Args:
+        directory (str): Index directory holding the segment files
+        metadata (Dict[str, Any]): JSON-serializable model metadata
+        segments (Dict[str, List[str]]): File names of each segment
+        linked (Optional[List[str]]): Other index directories whose segments all belong to this index;
+            siblings of this one, so they are found again once this one is renamed. Their checksums
+            are taken from the headers of those directories rather than computed again.
+    """
+    header = {
+        "format": INDEX_FORMAT,
+        "version": INDEX_VERSION,
+        "metadata": metadata,
+        "segments": {
+            segment: {name: checksum(os.path.join(directory, name)) for name in files}
+            for segment, files in segments.items()
+        },
+        "directories": {}
+    }
+    for other in linked or []:
+        with open(os.path.join(other, HEADER)) as file:
+            for segment, files in json.load(file)["segments"].items():
+                header["segments"][segment] = files
+                header["directories"][segment] = os.path.relpath(other, directory)
+    with open(os.path.join(directory, HEADER), "w") as file:
+        json.dump(header, file)
+
+def linked_directories(directory: str) -> Set[str]:
+    """Return the directories holding segments of an index other than its own, see write_header."""
+    with open(os.path.join(directory, HEADER)) as file:
+        header = json.load(file)
+    return {os.path.normpath(os.path.join(directory, other)) for other in header.get("directories", {}).values()}
+
+class IndexReader:
+    """Lazy reader of an index directory written with write_header."""
+    def __init__(self, directory: str, verify: bool = True):
+        """Read and check the header; segments are only read when used.
+
+        Args:
+            directory (str): Index directory
+            verify (bool): Check each segment against its checksums when first used
+
+        Raises:
+            ValueError: If the directory is not an index of a supported version
+        """
+        restore_directory(directory)
+        with open(os.path.join(directory, HEADER)) as file:
+            header = json.load(file)
+        if header.get("format") != INDEX_FORMAT:
+            raise ValueError(f"{directory} is not a search index")
+        if header.get("version", 0) > INDEX_VERSION:
+            raise ValueError(f"{directory} has index format version {header['version']}, "
+                             f"this version only reads up to {INDEX_VERSION}")
+        self.directory = directory
+        self.metadata: Dict[str, Any] = header["metadata"]
+        self.__segments: Dict[str, Dict[str, int]] = header["segments"]
+        self.__directories: Dict[str, str] = header.get("directories", {})
+        self.__verify = verify
+        self.__checked = set()
+
+    def __contains__(self, segment: str) -> bool:
+        return segment in self.__segments
+
+    def path(self, segment: str, name: str) -> str:
+        """Return the path of a segment file, checking the segment first.
+
+        Raises:
+            ValueError: If a file of the segment does not match its checksum
+        """
+        directory = self.segment_directory(segment)
+        if self.__verify and segment not in self.__checked:
+            for file, expected in self.__segments[segment].items():
+                if checksum(os.path.join(directory, file)) != expected:
+                    raise ValueError(f"Index segment {segment} is corrupted: {file} does not match its checksum")
+            self.__checked.add(segment)
+        return os.path.join(directory, name)
+
+    def segment_directory(self, segment: str) -> str:
+        """Return the directory holding the files of a segment, this one unless it is linked from another."""
+        return os.path.normpath(os.path.join(self.directory, self.__directories.get(segment, "")))
+
+    def array(self, segment: str, name: str) -> np.ndarray:
+        """Map an array of a segment, see load_array."""
+        self.path(segment, f"{name}.npy")
+        return load_array(self.segment_directory(segment), name)
+
+    def strings(self, segment: str, name: str) -> StringColumn:
+        """Map a string column of a segment, see load_strings."""
+        self.path(segment, f"{name}_buffer.npy")
+        return load_strings(self.segment_directory(segment), name)
+
+def replace_directory(temporary: str, directory: str) -> None:
+    """Move a fully written snapshot into place, replacing any previous one.
+
+    Readers never see a half-written snapshot: it only appears under its final
+    name once complete. The previous one is renamed aside before the new one is
+    renamed in and only deleted after, so a crash in between leaves it to
+    restore_directory rather than losing both.
+
+    Args:
+        temporary (str): Directory the snapshot was written to
+        directory (str): Final snapshot directory
+    """
+    previous = f"{directory}.old"
+    restore_directory(directory)
+    if os.path.exists(previous):
+        shutil.rmtree(previous)
+    if os.path.exists(directory):
+        os.replace(directory, previous)
+    os.replace(temporary, directory)
+    shutil.rmtree(previous, ignore_errors=True)
+
+def restore_directory(directory: str) -> None:
+    """Put back the previous snapshot of a directory when a crash stopped replace_directory between its renames."""
+    previous = f"{directory}.old"
+    if not os.path.exists(directory) and os.path.exists(previous):
+        os.replace(previous, directory)
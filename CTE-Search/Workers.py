@@ -0,0 +1,373 @@
+"""
+Workers.py - Search worker processes for CTE-Search
+
+Searches run in a pool of worker processes so they use every core instead of
+competing with the websocket server for the event loop. Workers do not receive
+the model itself: the served model is exported once per version as a search-only
+index (see Snapshot), which each worker memory-maps read-only the first time it
+serves that version. Versions exported from the same matrix share its segments, so
+an export only writes what changed since the matrix was last rebuilt. A search only ships the query arguments in and the results out,
+and all workers share one copy of the index in memory.
+
+While a new version is being exported, searches keep being served from the
+previous snapshot. Once it is exported, each worker picks the new version up with
+its next search: it loads it and runs a warmup search on it (see SearchModel.warmup)
+on a thread, and keeps serving the version it has mapped until then, so no query
+pays for loading a snapshot. Workers load the version served when the pool starts
+before taking any search.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from asyncio import Task, create_task, gather, get_running_loop, shield, to_thread
+from threading import Lock, Thread
+from time import perf_counter
+import os
+import shutil
+from typing import Any, Dict, List, Optional, Tuple
+from LogManager import *
+from Metrics import observe
+from Model import SearchModel
+from Snapshot import HEADER, linked_directories
+from DataTypes import SearchQuery
+
+# Snapshot version and model served by this worker process
+worker_version: Optional[int] = None
+worker_model: Optional[SearchModel] = None
+# Version this worker is loading and warming up in the background, see serve_worker_model
+worker_loading: Optional[int] = None
+worker_lock = Lock()
+
+def init_worker(directory: Optional[str], version: Optional[int]) -> None:
+    """Initializer of a worker process, loading and warming up the version served when its pool started.
+
+    The worker only takes searches once this returns, so none of them pays for the load.
+    """
+    if version is None:
+        return
+    try:
+        warm_worker_model(directory, version)
+    except Exception as e:
+        # The version may be gone by the time a worker is started; its first search loads the current one
+        warning(f"Warming up model version {version} failed: {str(e)}")
+
+def warm_worker_model(directory: str, version: int) -> float:
+    """Maps the snapshot of a version, warms it up and makes it the model of the worker.
+
+    Args:
+        directory: Snapshot directory of the version
+        version: Model version the snapshot holds
+
+    Returns:
+        The seconds spent loading and warming up the snapshot
+    """
+    global worker_version, worker_model, worker_loading
+    start = perf_counter()
+    try:
+        # Written by this server moments ago, the segments are not checksummed again in every worker
+        model = SearchModel.load(directory, verify=False)
+        model.warmup()
+        with worker_lock:
+            if worker_version is None or version > worker_version:
+                worker_model, worker_version = model, version
+    finally:
+        with worker_lock:
+            if worker_loading == version:
+                worker_loading = None
+    return perf_counter() - start
+
+def background_warmup(directory: str, version: int) -> None:
+    """Runs warm_worker_model on a thread of the worker, logging its failure."""
+    try:
+        seconds = warm_worker_model(directory, version)
+        debug(f"Search worker {os.getpid()} warmed up model version {version} in {seconds:.3f}s")
+    except Exception as e:
+        # The next search starts over with the version it is given
+        warning(f"Warming up model version {version} failed: {str(e)}")
+
+def serve_worker_model(directory: str, version: int) -> Tuple[SearchModel, int]:
+    """Returns the model a search runs on and its version, picking up a newer snapshot version.
+
+    A worker already serving a model keeps serving it while a thread loads and
+    warms up the new version, which replaces it once ready. Each worker switches
+    over on its own, so neither searches nor the other workers wait for it.
+
+    Args:
+        directory: Snapshot directory of the version
+        version: Latest model version
+    """
+    global worker_loading
+    with worker_lock:
+        model, served = worker_model, worker_version
+        if served == version or served is not None and worker_loading is not None:
+            return model, served
+        if served is not None:
+            worker_loading = version
+    if served is None:
+        # Nothing to serve from until this worker has a version
+        warm_worker_model(directory, version)
+        return worker_model, worker_version
+    Thread(target=background_warmup, args=(directory, version), name="Warmup", daemon=True).start()
+    return model, served
+
+def run_warmup(directory: str, version: int) -> Tuple[float, int]:
+    """Loads and warms up a snapshot version unless the worker already serves it.
+
+    Returns:
+        The seconds spent loading and warming up the snapshot and the pid of the worker
+    """
+    start = perf_counter()
+    if worker_version != version:
+        warm_worker_model(directory, version)
+    return perf_counter() - start, os.getpid()
+
+def run_search(directory: str, version: int, query: str, filters: Optional[List[str]], limit: Optional[int],
+               offset: int, engine: Optional[str]) -> Tuple[List[Tuple[str, str, float]], Dict[str, float], int, int]:
+    """Runs a search against the latest snapshot version the worker is ready to serve. See SearchModel.improved_search.
+
+    Returns:
+        The results, the seconds spent in each phase of the search, the pid of the worker
+        and the model version that produced the results
+    """
+    model, served = serve_worker_model(directory, version)
+    timings = {}
+    results = model.improved_search(query, filters, limit=limit, offset=offset, engine=engine, timings=timings)
+    return results, timings, os.getpid(), served
+
+def run_batch_search(directory: str, version: int, queries: List[str], filters: Optional[List[str]], limit: Optional[int],
+                     offset: int, engine: Optional[str]) -> Tuple[List[List[Tuple[str, str, float]]], Dict[str, float], int, int]:
+    """Runs a batch of searches against the latest snapshot version the worker is ready to serve. See SearchModel.batch_search.
+
+    Returns:
+        The results, the seconds spent in each phase of the whole batch, the pid of the
+        worker and the model version that produced the results
+    """
+    model, served = serve_worker_model(directory, version)
+    timings = {}
+    results = model.batch_search(queries, filters, limit=limit, offset=offset, engine=engine, timings=timings)
+    return results, timings, os.getpid(), served
+
+def snapshot_path(directory: str, version: int) -> str:
+    """Returns the directory a model version is exported to, see export_snapshot."""
+    return os.path.join(directory, f"v{version}")
+
+def export_snapshot(model: SearchModel, directory: str, version: int, previous: Optional[int]) -> str:
+    """Saves a model version as a search-only index for worker or acceptor processes to map.
+
+    Only the documents added since the matrix was last rebuilt are written to the version's
+    directory: the base segments are shared by every version exported from the same matrix
+    (see SearchModel.save), so a publish costs the size of the changes rather than of the index.
+    The previous version is kept for the searches still running on it, older ones are deleted
+    along with the base segments no kept version uses.
+
+    Args:
+        model: The model to export
+        directory: Directory holding the exported versions
+        version: Version of the model
+        previous: Version searched until this one takes over, None if there is none
+
+    Returns:
+        The directory the version was exported to
+    """
+    path = snapshot_path(directory, version)
+    os.makedirs(directory, exist_ok=True)
+    model.save(path, search_only=True, shared=directory)
+    keep = {f"v{version}", f"v{previous}"}
+    for name in list(keep):
+        if os.path.exists(os.path.join(directory, name, HEADER)):
+            keep |= {os.path.basename(other) for other in linked_directories(os.path.join(directory, name))}
+    for name in os.listdir(directory):
+        if name not in keep:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    return path
+
+class SearchPool:
+    """Pool of worker processes searching memory-mapped snapshots of the served model."""
+    def __init__(self, workers: int = 0, directory: str = "snapshots"):
+        """Create an idle pool; workers start with start() or the first search.
+
+        Args:
+            workers (int): Number of worker processes, 0 for one per CPU core
+            directory (str): Directory holding the exported snapshots
+        """
+        self.__workers = workers if workers > 0 else os.cpu_count() or 1
+        self.__directory = directory
+        self.__executor: Optional[ProcessPoolExecutor] = None
+        self.__version: Optional[int] = None
+        self.__export: Optional[Task] = None
+        # Seconds spent exporting and warming up the last version
+        self.__export_timings: Dict[str, float] = {}
+
+    @property
+    def workers(self) -> int:
+        """Number of worker processes."""
+        return self.__workers
+
+    def __path(self, version: int) -> str:
+        return snapshot_path(self.__directory, version)
+
+    def __get_executor(self) -> ProcessPoolExecutor:
+        """Return the executor, starting the worker processes on first use."""
+        if self.__executor is None:
+            version = self.__version
+            self.__executor = ProcessPoolExecutor(max_workers=self.__workers, initializer=init_worker,
+                                                  initargs=(None if version is None else self.__path(version), version))
+            info(f"Started {self.__workers} search workers")
+        return self.__executor
+
+    async def start(self, model: SearchModel, version: int) -> Dict[str, float]:
+        """
+        Exports a model version, then starts the workers, each of which loads and warms it up.
+
+        Awaiting this before accepting connections keeps the first queries from paying
+        for the export, the snapshot loads and the lazy initialization of the model.
+
+        Args:
+            model: The served model
+            version: Version of the served model
+
+        Returns:
+            The seconds spent exporting the snapshot ("snapshot") and warming up the workers ("warmup")
+        """
+        await self.__current_version(model, version)
+        timings = dict(self.__export_timings)
+        if self.__executor is None:
+            start = perf_counter()
+            loop = get_running_loop()
+            executor = self.__get_executor()
+            # Each worker warms the version up in its initializer, before taking any of these
+            results = await gather(*(loop.run_in_executor(executor, run_warmup, self.__path(self.__version), self.__version)
+                                     for _ in range(self.__workers)))
+            timings["warmup"] = perf_counter() - start
+            debug(f"{len(set(pid for _, pid in results))} search workers warmed up model version {self.__version}")
+        return timings
+
+    async def __export_snapshot(self, model: SearchModel, version: int) -> None:
+        """Export a model version off the event loop and hand it to the searches that follow.
+
+        Each worker keeps serving the version it has until it has warmed up the new one,
+        see serve_worker_model.
+        """
+        start = perf_counter()
+        await to_thread(export_snapshot, model, self.__directory, version, self.__version)
+        self.__export_timings = {"snapshot": perf_counter() - start}
+        self.__version = version
+        info(f"Search workers now pick up model version {version}")
+
+    async def __current_version(self, model: SearchModel, version: int) -> int:
+        """Return the snapshot version to search, starting the export of a newer one if needed."""
+        if version != self.__version and (self.__export is None or self.__export.done()):
+            self.__export = create_task(self.__export_snapshot(model, version))
+        if self.__version is None:
+            # Nothing to serve from until the first export is done
+            await shield(self.__export)
+        return self.__version
+
+    async def search(self, model: SearchModel, version: int, query: SearchQuery,
+                     details: Optional[Dict[str, Any]] = None) -> Tuple[List[Tuple[str, str, float]], int]:
+        """
+        Runs a search on a worker process.
+
+        Args:
+            model: The served model, only exported when its version is new to the pool
+            version: Version of the served model
+            query: The search request
+            details: Optional dict receiving the pid of the worker ("worker") and the
+                seconds spent in each phase of the search ("timings")
+
+        Returns:
+            The ranked (url, title, rank_score) results, and the model version that
+            produced them which lags behind version while its snapshot is exported and
+            until the worker has warmed it up
+        """
+        return await self.__run(run_search, model, version, query, query["query"], details)
+
+    async def batch_search(self, model: SearchModel, version: int, query: SearchQuery, queries: List[str],
+                           details: Optional[Dict[str, Any]] = None) -> Tuple[List[List[Tuple[str, str, float]]], int]:
+        """
+        Runs a batch of searches together on one worker process.
+
+        Args:
+            model: The served model, only exported when its version is new to the pool
+            version: Version of the served model
+            query: The search request holding the options shared by the batch
+            queries: The search texts to run
+            details: Optional dict receiving the worker and timings of the batch, as for search
+
+        Returns:
+            One list of ranked (url, title, rank_score) results per query, and the
+            model version that produced them
+        """
+        return await self.__run(run_batch_search, model, version, query, queries, details)
+
+    async def __run(self, function, model: SearchModel, version: int, query: SearchQuery, text,
+                    details: Optional[Dict[str, Any]]) -> Tuple[Any, int]:
+        """Run a search function on a worker with the options of a query."""
+        snapshot = await self.__current_version(model, version)
+        results, timings, worker, served = await get_running_loop().run_in_executor(
+            self.__get_executor(),
+            function,
+            self.__path(snapshot),
+            snapshot,
+            text,
+            query.get("filters"),
+            query.get("limit"),
+            query.get("offset", 0),
+            query.get("engine")
+        )
+        for stage, seconds in timings.items():
+            observe("stage_seconds", seconds, stage=stage)
+        if details is not None:
+            details.update(worker=worker, timings=timings)
+        return results, served
+
+    def shutdown(self) -> None:
+        """Stops the worker processes once their current searches are done, dropping the queued ones."""
+        if self.__export is not None:
+            self.__export.cancel()
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+            self.__executor = None
+
+class ThreadSearcher:
+    """Runs searches on a thread of this process, with the interface of SearchPool.
+
+    Acceptor processes (see Acceptors) search the snapshot they mapped themselves:
+    each of them already has a core to itself, so a search thread keeps their event
+    loop free without the round trip to a worker process.
+    """
+    def __init__(self):
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Search")
+
+    async def search(self, model: SearchModel, version: int, query: SearchQuery,
+                     details: Optional[Dict[str, Any]] = None) -> Tuple[List[Tuple[str, str, float]], int]:
+        """Runs a search on the model it is given, see SearchPool.search."""
+        return await self.__run(model.improved_search, version, query, query["query"], details)
+
+    async def batch_search(self, model: SearchModel, version: int, query: SearchQuery, queries: List[str],
+                           details: Optional[Dict[str, Any]] = None) -> Tuple[List[List[Tuple[str, str, float]]], int]:
+        """Runs a batch of searches on the model it is given, see SearchPool.batch_search."""
+        return await self.__run(model.batch_search, version, query, queries, details)
+
+    async def __run(self, function, version: int, query: SearchQuery, text,
+                    details: Optional[Dict[str, Any]]) -> Tuple[Any, int]:
+        """Run a search method on the search thread with the options of a query."""
+        timings = {}
+        results = await get_running_loop().run_in_executor(self.__executor, partial(
+            function,
+            text,
+            query.get("filters"),
+            limit=query.get("limit"),
+            offset=query.get("offset", 0),
+            engine=query.get("engine"),
+            timings=timings
+        ))
+        for stage, seconds in timings.items():
+            observe("stage_seconds", seconds, stage=stage)
+        if details is not None:
+            details.update(worker=os.getpid(), timings=timings)
+        return results, version
+
+    def shutdown(self) -> None:
+        """Stops the search thread once the current search is done, dropping the queued ones."""
+        self.__executor.shutdown(wait=False, cancel_futures=True)
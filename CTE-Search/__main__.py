@@ -1,14 +1,110 @@
+from time import perf_counter
+# Taken before anything else is imported, for the startup report of the serve command
+STARTED = perf_counter()
 
-from cli import Interface
-from asyncio import create_task, sleep, run, gather
+from asyncio import create_task, sleep, run, gather, to_thread
+from argparse import ArgumentParser
 from LogManager import *
+from LogManager import LEVELS
+
+# The commands import what they need when they run: the model modules pull in
+# scikit-learn, pandas and scipy, which take most of the startup time.
+
+# Settings the serve command can override, with their help text
+SERVE_SETTINGS = {
+    "address": "address to listen on",
+    "port": "port to listen on",
+    "workers": "search worker processes, 0 for one per CPU core; unused with several acceptors",
+    "result_cache_mb": "size of the result cache in megabytes",
+    "result_cache_ttl": "seconds cached results live, 0 until evicted",
+    "ranker": "ranker to serve with, forest or online",
+    "acceptors": "processes accepting connections on the shared port, each searching on its own thread",
+}
 
 async def start_multitasking():
-    # LOGGER MUST START FIRST FOR LOGGING TO WORK
+    from cli import Interface
+    # Start the logger first, logging works without it but it keeps the daily rotation on time
     logger_task = create_task(logger_loop()) #Start the Logger loop in a separate task
     inter = Interface()
     interface_task = create_task(inter.run())  # Start curses in a separate task
     await gather(interface_task,logger_task)
 
+async def start_ingest(pages: list[str], feedback: list[str], rebuild: bool, retrain: bool):
+    """
+    Loads page dumps and feedback logs into the cached model, printing progress as it goes.
+
+    Args:
+        pages (list[str]): JSON / JSON Lines files of PageData records
+        feedback (list[str]): JSON / JSON Lines files of FeedBack records
+        rebuild (bool): Build a new model from the page files instead of extending the cached one
+        retrain (bool): Retrain the ranker once everything is loaded
+    """
+    from Cache import CacheHandle
+    from Ingest import ingest_feedback, ingest_pages
+    logger_task = create_task(logger_loop())
+    await sleep(0)  # Let the logger start
+    try:
+        cache = CacheHandle.load()
+        model = None if rebuild else cache.get("model")
+        # Extend a copy so the checkpoint on exit sees a changed model
+        model = None if model is None else model.copy()
+        for path in pages:
+            model, report = await to_thread(ingest_pages, path, model, progress=print)
+            info(f"Ingested pages {report}")
+        if model is None:
+            raise SystemExit("There is no model to add feedback to, ingest pages first")
+        for path in feedback:
+            report = await to_thread(ingest_feedback, path, model, progress=print)
+            info(f"Ingested feedback {report}")
+        if retrain:
+            timings = await to_thread(model.retrain)
+            print(f"Retrained the ranker: {timings}")
+        cache.model = model
+    finally:
+        logger_task.cancel()
+
+async def start_serving(overrides: dict[str, str], drain_timeout: float):
+    """
+    Runs the server headless, without the interface, until SIGTERM or SIGINT.
+
+    Args:
+        overrides (dict[str, str]): Setting values given on the command line
+        drain_timeout (float): Seconds the searches in flight are given to finish on SIGTERM
+    """
+    from Server import serve, server_config
+    try:
+        server_config(overrides)
+    except ValueError as e:
+        raise SystemExit(f"Invalid settings: {e}")
+    logger_task = create_task(logger_loop())
+    try:
+        await serve(overrides, STARTED, drain_timeout)
+    finally:
+        logger_task.cancel()
+
 if __name__ == "__main__":
-    run(start_multitasking())
+    parser = ArgumentParser(prog="CTE-Search", description="Search server for the CTE website. Starts the interface when run without a command.")
+    commands = parser.add_subparsers(dest="command")
+    ingest = commands.add_parser("ingest", help="load page dumps and feedback logs into the model")
+    ingest.add_argument("pages", nargs="*", help="JSON or JSON Lines files of pages")
+    ingest.add_argument("--feedback", nargs="+", default=[], help="JSON or JSON Lines files of feedback")
+    ingest.add_argument("--rebuild", action="store_true", help="build a new model from the page files instead of extending the cached one")
+    ingest.add_argument("--retrain", action="store_true", help="retrain the ranker once everything is loaded")
+    serve = commands.add_parser("serve", help="run the server without the interface, until SIGTERM",
+                                description="Run the server without the interface. Settings are taken from the "
+                                            "command line, then from CTE_SEARCH_<NAME> environment variables, then "
+                                            "from the cache; overrides are not saved. SIGTERM stops accepting "
+                                            "connections and lets the searches in flight finish.")
+    for name, description in SERVE_SETTINGS.items():
+        serve.add_argument(f"--{name.replace('_', '-')}", dest=name, help=description)
+    serve.add_argument("--drain-timeout", type=float, default=30.0, help="seconds the searches in flight are given to finish on SIGTERM")
+    serve.add_argument("--log-level", choices=list(LEVELS), default="DEBUG", help="drop the log messages below this level")
+    args = parser.parse_args()
+    if args.command == "ingest":
+        run(start_ingest(args.pages, args.feedback, args.rebuild, args.retrain))
+    elif args.command == "serve":
+        set_level(args.log_level)
+        overrides = {name: getattr(args, name) for name in SERVE_SETTINGS if getattr(args, name) is not None}
+        run(start_serving(overrides, args.drain_timeout))
+    else:
+        run(start_multitasking())
@@ -1,9 +1,8 @@
 import curses
 import asyncio
 from LogManager import *
-from Cache import CacheHandle, get_model
+from Cache import CacheHandle, get_model_holder
 from DataTypes import Setting, PageData
-from Server import start_server
 import json
 
 async def get_text_input(stdscr, prompt: str) -> str:
@@ -65,7 +64,6 @@ class ModelMenu(Menu):
 
     async def on_option(self, index: int) -> Menu | None | int:
         if index == 0:
-            model = get_model()
             new_page: PageData = {}
             new_page["title"] = await get_text_input(self.stdscr, "Enter Page Title: ")
             new_page["content"] = await get_text_input(self.stdscr, "Enter Page Content: ")
@@ -75,7 +73,12 @@ class ModelMenu(Menu):
                 new_page["filters"].append(filter_input)
                 filter_input = await get_text_input(self.stdscr, "Enter a filter (leave blank to finish): ")
             new_page["url"] = await get_text_input(self.stdscr, "Enter the URL local to the server (e.g., /home): ")
-            model.append_page_data(new_page)
+            try:
+                await get_model_holder().apply("add_page", new_page)
+            except Exception as e:
+                error(str(e))
+                self.stdscr.addstr(str(e))
+                self.stdscr.refresh()
         elif index == 1:
             pass  # TODO: Implement page removal
         elif index == self.max_index:
@@ -105,7 +108,7 @@ class SettingsMenu(Menu):
             self.stdscr.refresh()
         self.options[index] = setting
         cache = CacheHandle.load()
-        cache.settings = self.options[:-1]
+        cache.set_settings(self.options[:-1])
         debug(str(cache))
         
     @staticmethod
@@ -128,6 +131,7 @@ class SettingsMenu(Menu):
             self.task = None
         else:
             self.options[1] = "Stop Server"
+            from Server import start_server  # Imported with the first start, the interface does not need it
             self.task = asyncio.create_task(start_server())
 
 class MainMenu(Menu):
@@ -175,6 +179,7 @@ class MainMenu(Menu):
             self.task = None
         else:
             self.options[1] = "Stop Server"
+            from Server import start_server  # Imported with the first start, the interface does not need it
             self.task = asyncio.create_task(start_server())
 class Interface:
     """Main interface controller handling menu navigation and input."""
@@ -0,0 +1,38 @@
+import os
+import random
+import sys
+
+import pytest
+
+# The modules import each other by their flat names
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ("python learn code beginner data science machine learning deep neural cooking pizza food cake "
+         "meditation stress focus art music history math physics chemistry biology web design css html").split()
+TAGS = ["programming", "python", "food", "art", "science"]
+
+def make_pages(count: int, seed: int = 1) -> list:
+    """Random PageData records over a small vocabulary, so queries share many terms."""
+    rng = random.Random(seed)
+    return [{
+        "url": f"site.com/p{i}",
+        "title": f"Page {i}",
+        "content": " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 40))),
+        "filters": rng.sample(TAGS, rng.randint(0, 2))
+    } for i in range(count)]
+
+@pytest.fixture(scope="session", autouse=True)
+def log_dir(tmp_path_factory):
+    """Writes the logs of the whole run to one directory, wherever the writer thread happens to be when it opens them."""
+    import LogManager
+    LogManager.LOG_DIR = str(tmp_path_factory.mktemp("logs"))
+    return LogManager.LOG_DIR
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Runs every test in an empty directory, where the cache, index, journal and logs are written."""
+    import Cache
+    monkeypatch.chdir(tmp_path)
+    # Each test loads its own cache from there, which is dropped again before the exit checkpoint
+    monkeypatch.setattr(Cache, "cache", None)
+    return tmp_path
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from Build import parallel_fit_transform, transform_counting_unknown
+from conftest import make_pages
+
+def documents(count):
+    # Empty, stop-word-only, repeated and non-ASCII contents next to the random pages
+    contents = [page["content"] for page in make_pages(count)]
+    return contents + ["", "the and of", "Python PYTHON python", "café crème brûlée", contents[0]]
+
+@pytest.mark.parametrize("params", [{"stop_words": "english"}, {}, {"sublinear_tf": True, "smooth_idf": False},
+                                    {"ngram_range": (1, 2), "use_idf": False}, {"dtype": np.float32}])
+@pytest.mark.parametrize("workers", [1, 2, 3])
+def test_parallel_fit_transform_matches_fit_transform(params, workers):
+    texts = documents(200)
+    expected_vectorizer = TfidfVectorizer(**params)
+    expected = expected_vectorizer.fit_transform(texts)
+    vectorizer = TfidfVectorizer(**params)
+    matrix = parallel_fit_transform(vectorizer, texts, workers)
+
+    assert vectorizer.vocabulary_ == expected_vectorizer.vocabulary_
+    assert list(vectorizer.vocabulary_) == list(expected_vectorizer.vocabulary_)
+    if expected_vectorizer.use_idf:
+        assert vectorizer.idf_.tobytes() == expected_vectorizer.idf_.tobytes()
+    for actual, wanted in ((matrix, expected), (vectorizer.transform(texts[:20]), expected_vectorizer.transform(texts[:20]))):
+        assert actual.shape == wanted.shape and actual.dtype == wanted.dtype
+        for name in ("data", "indices", "indptr"):
+            assert getattr(actual, name).dtype == getattr(wanted, name).dtype
+            assert getattr(actual, name).tobytes() == getattr(wanted, name).tobytes()
+
+def test_empty_vocabulary_raises_like_fit_transform():
+    texts = ["the and of", ""]
+    with pytest.raises(ValueError):
+        TfidfVectorizer(stop_words="english").fit_transform(texts)
+    with pytest.raises(ValueError):
+        parallel_fit_transform(TfidfVectorizer(stop_words="english"), texts, 2)
+
+@pytest.mark.parametrize("params", [{"stop_words": "english"}, {}, {"sublinear_tf": True, "smooth_idf": False},
+                                    {"ngram_range": (1, 2), "use_idf": False}, {"dtype": np.float32}])
+def test_transform_counting_unknown_matches_transform(params):
+    vectorizer = TfidfVectorizer(**params).fit(documents(100)[:50])
+    texts = documents(100)[50:]
+    expected = vectorizer.transform(texts)
+    matrix, unknown = transform_counting_unknown(vectorizer, texts)
+
+    analyze = vectorizer.build_analyzer()
+    assert unknown == sum(len(set(analyze(text)).difference(vectorizer.vocabulary_)) for text in texts) > 0
+    assert matrix.shape == expected.shape and matrix.dtype == expected.dtype
+    for name in ("data", "indices", "indptr"):
+        assert getattr(matrix, name).dtype == getattr(expected, name).dtype
+        assert getattr(matrix, name).tobytes() == getattr(expected, name).tobytes()
@@ -0,0 +1,165 @@
+import asyncio
+import os
+
+import pytest
+
+import Cache
+from Cache import CacheHandle, ModelHolder, ResultCache
+from Model import SearchModel
+from conftest import make_pages
+
+CLICKS = [{"query": "python code", "url": f"site.com/p{i}", "clicked": i % 2} for i in range(6)]
+
+def test_learn_only_updates_the_ranker_with_new_feedback():
+    model = SearchModel(make_pages(100), ranker="online")
+    assert model.learn(CLICKS + CLICKS[:2]) == len(CLICKS)
+    assert model.learn(CLICKS[:3]) == 0
+    assert model.learn(CLICKS[:1] + [{"query": "pizza", "url": "site.com/p7", "clicked": 1}]) == 1
+
+def test_failed_learn_keeps_the_batch_pending(monkeypatch):
+    holder = ModelHolder(SearchModel(make_pages(100), ranker="online"))
+    holder.receive_feedback(CLICKS)
+    def failing_learn(model, feedback):
+        raise RuntimeError("learn failed")
+    with monkeypatch.context() as patch:
+        patch.setattr(SearchModel, "learn", failing_learn)
+        with pytest.raises(RuntimeError):
+            asyncio.run(holder.learn_pending())
+    assert holder.pending_feedback == len(CLICKS) and holder.version == 0
+    assert asyncio.run(holder.learn_pending()) == len(CLICKS)
+    assert holder.pending_feedback == 0 and holder.version == 1
+
+def query(text: str, **options) -> tuple:
+    return ResultCache.key({"query": text, **options}, 1)
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces the cache's monotonic clock with one the test moves by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(Cache, "monotonic", lambda: now[0])
+    return now
+
+def test_equivalent_queries_share_a_key():
+    assert query("Python  Code", filters=["b", "a", "a"]) == query(" python code ", filters=["a", "b"])
+    assert query("python") != query("python", offset=10)
+    assert ResultCache.key({"query": "python"}, 1) != ResultCache.key({"query": "python"}, 2)
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = ResultCache(ttl=10)
+    cache.put(query("python"), "[1]")
+    clock[0] += 10
+    assert cache.get(query("python")) == "[1]"
+    # A hit does not extend the entry's lifetime
+    clock[0] += 0.5
+    assert cache.get(query("python")) is None
+    assert cache.stats == {"hits": 1, "misses": 1, "evictions": 0, "entries": 0, "bytes": 0}
+    # Putting the results again starts a new lifetime
+    cache.put(query("python"), "[2]")
+    clock[0] += 5
+    assert cache.get(query("python")) == "[2]"
+
+def test_entries_without_ttl_never_expire(clock):
+    cache = ResultCache()
+    cache.put(query("python"), "[1]")
+    clock[0] += 1e9
+    assert cache.get(query("python")) == "[1]"
+
+def test_least_recently_used_entries_are_evicted_past_the_byte_budget():
+    probe = ResultCache()
+    probe.put(query("q0"), "x" * 100)
+    size = probe.stats["bytes"]
+    cache = ResultCache(max_bytes=3 * size)
+    for i in range(3):
+        cache.put(query(f"q{i}"), "x" * 100)
+    assert cache.stats["bytes"] == 3 * size and cache.evictions == 0
+    cache.get(query("q0"))
+    cache.put(query("q3"), "x" * 100)
+    assert cache.evictions == 1 and cache.stats["entries"] == 3 and cache.stats["bytes"] == 3 * size
+    assert cache.get(query("q1")) is None
+    assert [cache.get(query(f"q{i}")) is not None for i in (0, 2, 3)] == [True, True, True]
+
+def test_a_larger_entry_evicts_as_many_entries_as_needed():
+    probe = ResultCache()
+    probe.put(query("q0"), "x" * 100)
+    size = probe.stats["bytes"]
+    cache = ResultCache(max_bytes=4 * size)
+    for i in range(4):
+        cache.put(query(f"q{i}"), "x" * 100)
+    # Takes just over two entries of room
+    cache.put(query("big"), "x" * (size + 100))
+    assert cache.evictions == 3 and cache.stats["entries"] == 2
+    assert cache.stats["bytes"] <= cache.max_bytes
+    assert cache.get(query("q3")) is not None and cache.get(query("big")) is not None
+
+def test_replacing_an_entry_does_not_count_it_twice():
+    cache = ResultCache()
+    cache.put(query("python"), "x" * 100)
+    size = cache.stats["bytes"]
+    cache.put(query("python"), "x" * 100)
+    assert cache.stats["entries"] == 1 and cache.stats["bytes"] == size
+    cache.clear()
+    assert cache.stats["entries"] == 0 and cache.stats["bytes"] == 0
+
+def test_entries_over_the_whole_budget_are_not_cached():
+    cache = ResultCache(max_bytes=1000)
+    cache.put(query("small"), "[]")
+    cache.put(query("python"), "x" * 1000)
+    assert cache.get(query("python")) is None and cache.get(query("small")) == "[]"
+    assert cache.evictions == 0 and cache.stats["entries"] == 1
+
+def reload_cache(monkeypatch) -> CacheHandle:
+    """Drops the loaded cache, as a restart would, and loads it again from disk."""
+    monkeypatch.setattr(Cache, "cache", None)
+    return CacheHandle.load()
+
+def page(i: int) -> dict:
+    return {"url": f"new.com/{i}", "title": f"New page {i}", "content": f"zebra{i} python", "filters": []}
+
+def test_changes_since_the_checkpoint_are_replayed(monkeypatch):
+    cache = CacheHandle.load()
+    cache.model = SearchModel(make_pages(50))
+    cache.checkpoint()
+    holder = ModelHolder(cache.model)
+    asyncio.run(holder.apply("add_page", page(1)))
+    holder.receive_feedback(CLICKS[:2])
+    asyncio.run(holder.checkpoint())
+    asyncio.run(holder.apply("add_page", page(2)))
+    asyncio.run(holder.apply("remove_page", "Page 3"))
+    holder.receive_feedback(CLICKS[2:])
+
+    cache = reload_cache(monkeypatch)
+    assert cache.model.stats["documents"] == 51
+    urls = {url for url, _, _ in cache.model.improved_search("python")}
+    assert {"new.com/1", "new.com/2"} <= urls and "site.com/p3" not in urls
+    assert cache.pending_feedback == CLICKS
+    assert cache.unsaved_changes == 3
+
+def test_a_failed_checkpoint_keeps_the_journal(monkeypatch):
+    cache = CacheHandle.load()
+    cache.model = SearchModel(make_pages(50))
+    cache.checkpoint()
+    holder = ModelHolder(cache.model)
+    asyncio.run(holder.apply("add_page", page(1)))
+    settings = CacheHandle.create_settings()
+    next(setting for setting in settings if setting.name == "port").value = 8123
+    cache.set_settings(settings)
+    def failing_save(model, directory, checkpoint=None):
+        raise OSError("disk full")
+    with monkeypatch.context() as patch:
+        patch.setattr(SearchModel, "save", failing_save)
+        asyncio.run(holder.checkpoint())
+    assert cache.unsaved_changes == 2
+
+    cache = reload_cache(monkeypatch)
+    assert cache.model.stats["documents"] == 51
+    assert next(setting for setting in cache.settings if setting.name == "port").value == 8123
+
+def test_an_interrupted_index_swap_is_restored(monkeypatch):
+    cache = CacheHandle.load()
+    cache.model = SearchModel(make_pages(50))
+    cache.checkpoint()
+    # A crash between the two renames of replace_directory
+    os.replace(Cache.INDEX_DIR, f"{Cache.INDEX_DIR}.old")
+    cache = reload_cache(monkeypatch)
+    assert cache.model.stats["documents"] == 50
+    assert not os.path.exists(f"{Cache.INDEX_DIR}.old")
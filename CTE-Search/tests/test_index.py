@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix, random as sparse_random
+
+from Index import FilterIndex, InvertedIndex, SegmentedIndex, top_k
+
+NUM_TERMS = 40
+
+def random_corpus(rng, num_docs):
+    """Random document-term matrix with many exact score ties.
+
+    Weights are multiples of 1/8, so every score is a sum of exact binary
+    fractions and does not depend on the order the terms are added in. A
+    quarter of the rows repeat earlier ones.
+    """
+    matrix = sparse_random(num_docs, NUM_TERMS, density=0.15, format="csr", random_state=rng)
+    matrix.data = rng.integers(1, 9, size=len(matrix.data)) / 8
+    rows = np.arange(num_docs)
+    copies = rng.choice(num_docs, size=num_docs // 4, replace=False)
+    rows[copies] = rng.integers(0, num_docs, size=len(copies))
+    return matrix[rows]
+
+def random_query(rng):
+    # 1, 4 or 16 terms of weight 1 normalize to an exact 1, 1/2 or 1/4
+    terms = rng.choice(NUM_TERMS, size=rng.choice([1, 4, 16]), replace=False)
+    return csr_matrix((np.ones(len(terms)), (np.zeros(len(terms), dtype=int), terms)), shape=(1, NUM_TERMS))
+
+def exhaustive_top_k(matrix, query, k, allowed=None):
+    weights = query.data / np.sqrt(np.dot(query.data, query.data))
+    scores = matrix[:, query.indices].toarray() @ weights
+    matches = scores > 0 if allowed is None else (scores > 0) & allowed
+    doc_ids = np.flatnonzero(matches)
+    best = np.lexsort((doc_ids, -scores[doc_ids]))[:k]
+    return doc_ids[best], scores[doc_ids][best]
+
+@pytest.mark.parametrize("seed", range(20))
+def test_top_k_matches_exhaustive_scoring(seed):
+    rng = np.random.default_rng(seed)
+    matrix = random_corpus(rng, 300)
+    index = InvertedIndex(matrix)
+    for _ in range(10):
+        query = random_query(rng)
+        allowed = rng.random(matrix.shape[0]) < 0.7
+        for k in (1, 5, 17, 300, 400):
+            for mask in (None, allowed):
+                doc_ids, scores = index.top_k(query, k, mask)
+                expected_ids, expected_scores = exhaustive_top_k(matrix, query, k, mask)
+                assert doc_ids.tolist() == expected_ids.tolist()
+                assert scores.tolist() == expected_scores.tolist()
+
+@pytest.mark.parametrize("seed", range(10))
+def test_segmented_top_k_matches_exhaustive_scoring(seed):
+    rng = np.random.default_rng(seed)
+    matrix = random_corpus(rng, 400)
+    # A small extension stays in the delta segment, a large one is merged into the base
+    for base_docs in (390, 300):
+        index = SegmentedIndex(InvertedIndex(matrix[:base_docs]))
+        index.extend(matrix[base_docs:base_docs + 5])
+        index.extend(matrix[base_docs + 5:])
+        for _ in range(10):
+            query = random_query(rng)
+            allowed = rng.random(matrix.shape[0]) < 0.7
+            for k in (1, 5, 17, 400):
+                for mask in (None, allowed):
+                    doc_ids, scores = index.top_k(query, k, mask)
+                    expected_ids, expected_scores = exhaustive_top_k(matrix, query, k, mask)
+                    assert doc_ids.tolist() == expected_ids.tolist()
+                    assert scores.tolist() == expected_scores.tolist()
+
+def test_segment_doc_ids_start_at_first_doc():
+    rng = np.random.default_rng(0)
+    matrix = random_corpus(rng, 50)
+    index = InvertedIndex(matrix[20:], first_doc=20)
+    query = random_query(rng)
+    allowed = np.arange(50) >= 20
+    doc_ids, scores = index.top_k(query, 10)
+    expected_ids, expected_scores = exhaustive_top_k(matrix, query, 10, allowed)
+    assert doc_ids.tolist() == expected_ids.tolist()
+    assert scores.tolist() == expected_scores.tolist()
+
+@pytest.mark.parametrize("seed", range(10))
+def test_pages_of_top_k_match_a_stable_full_sort(seed):
+    rng = np.random.default_rng(seed)
+    # Few distinct values, so most pages start or end inside a run of ties
+    scores = rng.integers(0, 6, size=200) / 4
+    ranking = np.argsort(-scores, kind="stable")
+    for offset in (0, 1, 7, 50, 199, 200, 250):
+        for limit in (1, 10, 33):
+            page = top_k(scores, offset + limit)[offset:]
+            assert page.tolist() == ranking[offset:offset + limit].tolist()
+
+def per_row_mask(filters, doc_tags):
+    """The filter mask as searches computed it before FilterIndex, document by document."""
+    return np.array([isinstance(tags, list) and any(tag in tags for tag in filters) for tags in doc_tags], dtype=bool)
+
+@pytest.mark.parametrize("seed", range(10))
+def test_filter_index_matches_a_per_row_mask_as_documents_are_added(seed):
+    rng = np.random.default_rng(seed)
+    tags = ["a", "b", "c", "d", "e"]
+
+    def random_tags():
+        return None if rng.random() < 0.1 else list(rng.choice(tags, size=rng.integers(0, 3), replace=False))
+
+    doc_tags = [random_tags() for _ in range(rng.integers(0, 100))]
+    index = FilterIndex(doc_tags)
+    for _ in range(5):
+        for _ in range(rng.integers(0, 30)):
+            doc_tags.append(random_tags())
+            assert index.add(doc_tags[-1]) == len(doc_tags) - 1
+        for filters in (["a"], ["b", "c"], ["e", "e"], ["z"], tags):
+            expected = per_row_mask(filters, doc_tags)
+            assert index.mask(filters, len(doc_tags)).tolist() == expected.tolist()
+            assert index.doc_ids(filters).tolist() == np.flatnonzero(expected).tolist()
+        # The query folded the tags of the added documents into the arrays, which are reused from then on
+        assert all(index.tag_doc_ids(tag) is index.tag_doc_ids(tag) for tag in tags)
+        copy = FilterIndex.from_arrays(*index.to_arrays(), len(doc_tags))
+        assert all(copy.tag_doc_ids(tag).tolist() == index.tag_doc_ids(tag).tolist() for tag in tags)
@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+from Ingest import InvalidLine, ingest_feedback, ingest_pages, iter_records
+from Model import SearchModel
+from conftest import make_pages
+
+def test_bad_lines_count_as_invalid_records(workdir):
+    pages = make_pages(5)
+    lines = [json.dumps(pages[0]), "{\"url\": \"site.com/torn", json.dumps(pages[1]), "", "not json",
+             json.dumps(pages[2]), json.dumps(pages[3]), "[1, 2", json.dumps(pages[4])]
+    (workdir / "pages.jsonl").write_text("\n".join(lines) + "\n", encoding="utf-8")
+    records = list(iter_records("pages.jsonl"))
+    assert [record.number for record in records if isinstance(record, InvalidLine)] == [2, 5, 8]
+    model, report = ingest_pages("pages.jsonl")
+    assert (report.read, report.added, report.invalid) == (8, 5, 3)
+    assert model.stats["documents"] == 5
+
+def test_records_split_across_chunks_are_read_whole(workdir):
+    records = [123456789, -0.000125, 1e300, "a string", {"query": "python", "url": "site.com/p1", "clicked": 1}, [], True, None]
+    (workdir / "records.json").write_text(json.dumps(records), encoding="utf-8")
+    (workdir / "records.jsonl").write_text("\n".join(json.dumps(record) for record in records), encoding="utf-8")
+    for chunk_size in (1, 2, 3, 5, 7, 1 << 20):
+        assert list(iter_records("records.json", chunk_size)) == records
+    assert list(iter_records("records.jsonl")) == records
+
+def test_an_invalid_array_file_raises(workdir):
+    (workdir / "pages.json").write_text("[{\"url\": 1}, {", encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(iter_records("pages.json", 4))
+
+def test_feedback_lines_are_validated(workdir):
+    events = [{"query": "python", "url": "site.com/p1", "clicked": 1}, "{", {"query": "python", "url": "site.com/p1", "clicked": 1},
+              {"query": "python", "url": "site.com/p2", "clicked": 3}, {"query": "cake", "url": "site.com/p3", "clicked": 0}]
+    (workdir / "feedback.jsonl").write_text("\n".join(event if isinstance(event, str) else json.dumps(event) for event in events),
+                                            encoding="utf-8")
+    report = ingest_feedback("feedback.jsonl", SearchModel(make_pages(10)))
+    assert (report.read, report.added, report.duplicates, report.invalid) == (5, 2, 1, 2)
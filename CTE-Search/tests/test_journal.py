@@ -0,0 +1,41 @@
+import pytest
+
+from Journal import Journal
+
+def test_changes_are_replayed_after_the_checkpoint(workdir):
+    journal = Journal("journal.log")
+    for i in range(5):
+        journal.append("add_page", {"title": f"Page {i}"})
+    journal.truncate(2)
+    journal.append("retrain")
+    journal.close()
+    reopened = Journal("journal.log", 2)
+    assert [(seq, op) for seq, op, _ in reopened.replay(2)] == [(3, "add_page"), (4, "add_page"), (5, "add_page"), (6, "retrain")]
+    assert [seq for seq, _, _ in reopened.replay(4)] == [5, 6]
+    assert reopened.append("maintain") == 7
+
+@pytest.mark.parametrize("tail", [b"0badc0de [4, \"add_page\", {\"title\": \"Pa", b"\n", b"zz\n"])
+def test_a_torn_tail_is_dropped(workdir, tail):
+    journal = Journal("journal.log")
+    for i in range(3):
+        journal.append("feedback", [i])
+    journal.close()
+    with open("journal.log", "ab") as file:
+        file.write(tail)
+    reopened = Journal("journal.log")
+    assert [data for _, _, data in reopened.replay()] == [[0], [1], [2]]
+    assert reopened.append("feedback", [3]) == 4
+    reopened.close()
+    assert [data for _, _, data in Journal("journal.log").replay()] == [[0], [1], [2], [3]]
+
+def test_a_corrupted_change_drops_everything_after_it(workdir):
+    journal = Journal("journal.log")
+    for i in range(4):
+        journal.append("feedback", [i])
+    journal.close()
+    with open("journal.log", "rb") as file:
+        lines = file.readlines()
+    lines[1] = lines[1].replace(b"[1]", b"[9]")
+    with open("journal.log", "wb") as file:
+        file.writelines(lines)
+    assert [data for _, _, data in Journal("journal.log").replay()] == [[0]]
@@ -0,0 +1,61 @@
+import glob
+import gzip
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+import LogManager
+from LogManager import LogWriter
+
+def read_log(path: str) -> list:
+    with (gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, encoding="utf-8")) as file:
+        return file.read().splitlines()
+
+def test_full_files_are_rotated_and_compressed_without_losing_lines(monkeypatch):
+    monkeypatch.setattr(LogManager, "MAX_BYTES", 200)
+    monkeypatch.setattr(LogManager, "COMPRESS", True)
+    writer = LogWriter(lambda records: "".join(f"{record}\n" for record in records), prefix="rotation_test", batch_size=1)
+    for i in range(100):
+        writer.put(f"line {i:03d}")
+    assert writer.flush()
+
+    date = datetime.now().strftime("%Y%m%d")
+    current = os.path.join(LogManager.LOG_DIR, f"rotation_test_{date}.log")
+    rotated = sorted(glob.glob(os.path.join(LogManager.LOG_DIR, f"rotation_test_{date}.*.log.gz")),
+                     key=lambda path: int(path.rsplit(".", 3)[1]))
+    # Lines of 9 bytes fill a file of 200 every 23 lines
+    assert len(rotated) == 4
+    assert all(sum(len(line) + 1 for line in read_log(path)) >= 200 for path in rotated)
+    lines = [line for path in rotated + [current] for line in read_log(path)]
+    assert lines == [f"line {i:03d}" for i in range(100)]
+
+def test_sampling_keeps_the_configured_share_of_messages():
+    LogManager.set_sample_rate("DEBUG", 0.1)
+    try:
+        for i in range(2000):
+            LogManager.debug(f"sampled message {i}")
+    finally:
+        LogManager.set_sample_rate("DEBUG", 1)
+    assert LogManager.flush()
+    kept = [line for path in glob.glob(os.path.join(LogManager.LOG_DIR, "cte_search_*.log"))
+            for line in read_log(path) if " - DEBUG - sampled message " in line]
+    assert 180 <= len(kept) <= 220
+
+def test_messages_logged_before_the_logger_loop_starts_are_written(tmp_path):
+    # A fresh interpreter, so nothing has started the writer before the first message
+    script = (
+        "import asyncio, LogManager\n"
+        f"LogManager.LOG_DIR = {str(tmp_path)!r}\n"
+        "LogManager.info('logged before the loop')\n"
+        "async def main():\n"
+        "    loop = asyncio.create_task(LogManager.logger_loop())\n"
+        "    await asyncio.sleep(0.1)\n"
+        "    LogManager.info('logged after the loop')\n"
+        "    assert LogManager.flush()\n"
+        "    loop.cancel()\n"
+        "asyncio.run(main())\n"
+    )
+    subprocess.run([sys.executable, "-c", script], check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    lines = [line for path in glob.glob(os.path.join(tmp_path, "cte_search_*.log")) for line in read_log(path)]
+    assert [line.split(" - ", 2)[2] for line in lines] == ["logged before the loop", "logged after the loop"]
@@ -0,0 +1,23 @@
+import Metrics
+
+def test_processes_are_rendered_under_a_process_label():
+    Metrics.count("test_events", kind="a")
+    Metrics.observe("test_seconds", 0.002)
+    first = Metrics.collect()
+    Metrics.count("test_events", 2, kind="a")
+    second = Metrics.collect()
+    lines = Metrics.render({"coordinator": first, "acceptor0": second}).splitlines()
+    assert 'cte_search_test_events_total{process="acceptor0",kind="a"} 3' in lines
+    assert 'cte_search_test_events_total{process="coordinator",kind="a"} 1' in lines
+    assert 'cte_search_test_seconds_count{process="coordinator"} 1' in lines
+    # Every metric is declared once, its samples following the declaration
+    declared = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+    assert len(declared) == len(set(declared))
+    positions = [i for i, line in enumerate(lines) if line.startswith("cte_search_test_events_total")]
+    assert positions == list(range(positions[0], positions[0] + 2))
+
+def test_collect_is_a_copy():
+    Metrics.observe("test_copied_seconds", 0.5)
+    collected = Metrics.collect()
+    Metrics.observe("test_copied_seconds", 0.5)
+    assert collected["histograms"][("test_copied_seconds", ())].count == 1
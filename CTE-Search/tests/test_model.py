@@ -0,0 +1,194 @@
+import pickle
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import Model
+from Model import ENGINES, SearchModel
+from conftest import WORDS, make_pages
+
+@pytest.fixture(scope="module")
+def model():
+    return SearchModel(make_pages(300))
+
+@pytest.mark.parametrize("query", ["python data science", "pizza", "zebra"])
+def test_results_are_sorted_by_score_with_ties_in_page_order(model, query):
+    results = model.improved_search(query)
+    keys = [(-score, int(url.rsplit("/p", 1)[1])) for url, _, score in results]
+    assert keys == sorted(keys)
+
+def test_filters_keep_the_order_of_the_unfiltered_ranking(model):
+    tagged = {page["url"] for page in make_pages(300) if {"food", "art"} & set(page["filters"])}
+    ranking = model.improved_search("python pizza")
+    assert model.improved_search("python pizza", ["food", "art"]) == [result for result in ranking if result[0] in tagged]
+
+@pytest.mark.parametrize("options", [{"limit": "10"}, {"limit": 2.5}, {"limit": True}, {"offset": "1"},
+                                     {"offset": None}, {"limit": -1}, {"offset": -2}])
+def test_invalid_paging_options_raise_value_error(model, options):
+    with pytest.raises(ValueError):
+        model.improved_search("python", **options)
+    with pytest.raises(ValueError):
+        model.batch_search(["python"], **options)
+
+def test_pages_match_the_full_ranking(model):
+    full = model.improved_search("python data science")
+    assert model.improved_search("python data science", limit=5, offset=3) == full[3:8]
+
+@pytest.mark.parametrize("search_only", [False, True])
+def test_a_saved_index_searches_like_the_model(model, workdir, search_only):
+    changed = model.copy()
+    changed.append_page_data({"url": "new.com/1", "title": "New page", "content": "python pizza", "filters": ["food"]})
+    changed.remove_pages("Page 4")
+    changed.save("index", search_only=search_only)
+    loaded = SearchModel.load("index")
+    for engine in ENGINES:
+        for filters in (None, ["food"]):
+            assert loaded.improved_search("python pizza", filters, limit=20, engine=engine) == \
+                changed.improved_search("python pizza", filters, limit=20, engine=engine)
+    assert loaded.stats == changed.stats
+    if search_only:
+        with pytest.raises(RuntimeError):
+            loaded.append_page_data({"url": "new.com/2", "title": "Other page", "content": "cake", "filters": []})
+    else:
+        loaded.remove_pages("New page")
+        assert loaded.stats["documents"] == changed.stats["documents"] - 1
+
+def test_a_saved_index_keeps_the_filters_of_every_page(model, workdir):
+    model.save("index")
+    loaded = SearchModel.load("index")
+    # Compacting reads the page data back and indexes its filters again
+    loaded.remove_pages("Page 4")
+    loaded.compact()
+    changed = model.copy()
+    changed.remove_pages("Page 4")
+    changed.compact()
+    for filters in (["food"], ["art", "science"]):
+        assert loaded.improved_search("python pizza", filters) == changed.improved_search("python pizza", filters)
+
+def test_extended_pages_are_kept_by_copies_pickles_and_saves(workdir):
+    pages = make_pages(300)
+    model = SearchModel(pages[:200])
+    original = model.copy()
+    for start in (200, 250):
+        # The first ten pages of each batch are already indexed
+        assert model.extend_pages(pd.DataFrame(pages[start - 10:start + 50])) == 50
+    assert original.stats["documents"] == 200 and model.stats["documents"] == 300
+    model.save("index")
+    for other in (pickle.loads(pickle.dumps(model)), SearchModel.load("index")):
+        for filters in (None, ["food"]):
+            assert other.improved_search("python pizza", filters) == model.improved_search("python pizza", filters)
+        other.remove_pages("Page 260")
+        other.compact()
+        assert other.improved_search("python pizza", ["food"]) == \
+            [result for result in model.improved_search("python pizza", ["food"]) if result[1] != "Page 260"]
+
+class FeatureRecorder:
+    """Stands in for the clone of the ranker retrain() fits, keeping what it is fitted on."""
+    def fit(self, features, labels):
+        self.features, self.labels = features, labels
+        return self
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_retrain_features_match_a_keyword_search_per_feedback_row(monkeypatch, seed):
+    rng = random.Random(seed)
+    pages = make_pages(200, seed)
+    model = SearchModel(pages[:150])
+    model.extend_pages(pd.DataFrame(pages[150:]))
+    # A second page with the url of an earlier one: its feedback goes to the first live one
+    pages.append({"url": "site.com/p3", "title": "Page 3 again", "content": "pizza cake", "filters": []})
+    model.append_page_data(pages[-1])
+    removed = set(rng.sample([page["title"] for page in pages], 20))
+    for title in removed:
+        model.remove_pages(title)
+    urls = [page["url"] for page in pages] + ["gone.com/1", "gone.com/2"]
+    feedback = []
+    for _ in range(300):
+        query = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+        event = {"query": query, "url": rng.choice(urls), "clicked": rng.randint(0, 1)}
+        if model.append_feedback(query, event):
+            feedback.append(event)
+    recorder = FeatureRecorder()
+    monkeypatch.setattr(Model, "clone", lambda ranker: recorder)
+    model.retrain()
+
+    # The features as computed before they were vectorized: one keyword search per feedback row
+    doc_ids = {}
+    for doc_id, page in enumerate(pages):
+        if page["title"] not in removed:
+            doc_ids.setdefault(page["url"], doc_id)
+    rows = [event for event in feedback if event["url"] in doc_ids]
+    expected = [model.keyword_search(event["query"])[doc_ids[event["url"]]] for event in rows]
+    assert recorder.features.ravel() == pytest.approx(expected)
+    assert recorder.labels.tolist() == [event["clicked"] for event in rows]
+
+def trained_model(seed, num_pages=None):
+    """A model of random pages, some appended and some removed, with a ranker trained on random feedback."""
+    rng = random.Random(seed)
+    pages = make_pages(num_pages or rng.randint(50, 300), seed)
+    model = SearchModel(pages[:len(pages) * 3 // 4])
+    model.extend_pages(pd.DataFrame(pages[len(pages) * 3 // 4:]))
+    for title in rng.sample([page["title"] for page in pages], len(pages) // 10):
+        model.remove_pages(title)
+    for _ in range(200):
+        query = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+        model.append_feedback(query, {"query": query, "url": rng.choice(pages)["url"], "clicked": rng.randint(0, 1)})
+    model.retrain()
+    return model, rng
+
+def same_results(actual, expected):
+    return [result[:2] for result in actual] == [result[:2] for result in expected] \
+        and [result[2] for result in actual] == pytest.approx([result[2] for result in expected])
+
+@pytest.mark.parametrize("seed", range(4))
+def test_the_inverted_engine_ranks_the_matching_documents_like_the_dense_engine(seed):
+    model, rng = trained_model(seed)
+    queries = [" ".join(rng.choice(WORDS + ["zebra"]) for _ in range(rng.randint(1, 4))) for _ in range(8)]
+    for filters in (None, ["food"], ["art", "science"]):
+        for limit in (None, 10):
+            for query in queries:
+                similarities = model.keyword_search(query)
+                dense = model.improved_search(query, filters, engine="dense")
+                matching = [result for result in dense if similarities[int(result[0].rsplit("/p", 1)[1])] > 0]
+                inverted = model.improved_search(query, filters, limit=limit, engine="inverted")
+                assert same_results(inverted, matching[:limit])
+            batch = model.batch_search(queries, filters, limit=limit, engine="inverted")
+            assert all(same_results(results, model.improved_search(query, filters, limit=limit, engine="inverted"))
+                       for query, results in zip(queries, batch))
+
+def test_filters_match_a_per_row_check_after_pages_are_added_and_removed():
+    pages = make_pages(200, 5)
+    model = SearchModel(pages[:120])
+    model.extend_pages(pd.DataFrame(pages[120:160]))
+    for page in pages[160:]:
+        model.append_page_data(page)
+    removed = {f"Page {i}" for i in range(0, 200, 7)}
+    for title in removed:
+        model.remove_pages(title)
+    for filters in (["food"], ["art", "science"], ["unknown"]):
+        # Untrained, the dense engine lists every live document in page order
+        expected = [page["url"] for page in pages if page["title"] not in removed and set(filters) & set(page["filters"])]
+        assert [url for url, _, _ in model.improved_search("python", filters, engine="dense")] == expected
+
+@pytest.mark.parametrize("seed", range(4))
+def test_maxscore_returns_what_inverted_does_while_the_ranker_is_untrained(seed):
+    rng = random.Random(seed)
+    model = SearchModel(make_pages(400, seed))
+    queries = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))) for _ in range(10)]
+    for filters in (None, ["food"]):
+        for limit, offset in ((None, 0), (5, 0), (10, 95), (150, 0)):
+            for query in queries:
+                assert model.improved_search(query, filters, limit=limit, offset=offset, engine="maxscore") == \
+                    model.improved_search(query, filters, limit=limit, offset=offset, engine="inverted")
+            assert model.batch_search(queries, filters, limit=limit, offset=offset, engine="maxscore") == \
+                model.batch_search(queries, filters, limit=limit, offset=offset, engine="inverted")
+
+def test_maxscore_only_ranks_the_best_keyword_matches_once_the_ranker_is_trained():
+    model, rng = trained_model(1, 1000)
+    for _ in range(10):
+        query = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+        similarities = model.keyword_search(query)
+        threshold = np.sort(similarities)[::-1][SearchModel.RERANK_DEPTH - 1]
+        for url, _, _ in model.improved_search(query, limit=10, engine="maxscore"):
+            assert similarities[int(url.rsplit("/p", 1)[1])] >= threshold
@@ -0,0 +1,30 @@
+import glob
+import json
+import os
+
+import LogManager
+from QueryLog import QueryLog
+
+def read_lines(pattern: str) -> list:
+    lines = []
+    for path in glob.glob(os.path.join(LogManager.LOG_DIR, pattern)):
+        with open(path, encoding="utf-8") as file:
+            lines += file.read().splitlines()
+    return lines
+
+def test_searches_and_clicks_are_written_as_json_lines():
+    log = QueryLog("queries_test")
+    results = json.dumps([[f"site.com/p{i}", f"Page {i}", 1.0 / (i + 1)] for i in range(12)])
+    log.search("abc", {"query": "Python", "limit": 12}, "Python", results, 3, {"worker": 1, "timings": {"score": 0.1}})
+    log.search("abd", {"queries": ["python"]}, "python", "[]", 3, None, index=0)
+    log.click({"query": "Python", "url": "site.com/p0", "clicked": 1, "trace": "abc"})
+    assert log.flush()
+    search, batch, click = [json.loads(line) for line in read_lines("queries_test_*.jsonl")]
+    assert (search["trace"], search["results"], search["top"][-1], search["worker"]) == ("abc", 12, "site.com/p9", 1)
+    assert (batch["index"], batch["results"], batch["cached"]) == (0, 0, True)
+    assert (click["type"], click["trace"], click["clicked"]) == ("click", "abc", 1)
+
+def test_messages_are_written_by_the_log_writer():
+    LogManager.info("written through the writer")
+    assert LogManager.flush()
+    assert any(line.endswith(" - INFO - written through the writer") for line in read_lines("cte_search_*.log"))
@@ -0,0 +1,161 @@
+import asyncio
+import glob
+import json
+import os
+
+import pytest
+
+import Cache
+import Server
+from Cache import ModelHolder, ResultCache
+from Model import SearchModel
+from QueryLog import QueryLog
+from Workers import SearchPool
+from conftest import make_pages
+
+class FakeWebSocket:
+    """Collects what a SearchSession sends."""
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(json.loads(message))
+
+@pytest.fixture
+def served(monkeypatch):
+    """Serves a small model from one search worker."""
+    monkeypatch.setattr(Cache, "holder", ModelHolder(SearchModel(make_pages(200))))
+    monkeypatch.setattr(Server, "search_pool", SearchPool(1))
+    monkeypatch.setattr(Server, "result_cache", ResultCache())
+    monkeypatch.setattr(Server, "query_log", QueryLog())
+    yield
+    Server.search_pool.shutdown()
+
+async def answer_all(session: Server.SearchSession, messages: list, timeout: float = 30):
+    async def run():
+        for message in messages:
+            await session.submit(json.dumps(message), 0.0)
+        while session.in_flight:
+            await asyncio.wait(session.in_flight)
+    await asyncio.wait_for(run(), timeout)
+
+def test_superseded_streams_free_their_slots(served):
+    async def scenario():
+        websocket = FakeWebSocket()
+        session = Server.SearchSession(websocket)
+        # Each query replaces the previous one of the stream, most before they start running
+        await answer_all(session, [{"query": f"python data {i}", "id": i, "stream": "typing", "limit": 3}
+                                   for i in range(30)])
+        answered = [message["id"] for message in websocket.sent]
+        assert answered[-1] == 29
+        # Every superseded query is told so, under its own id
+        assert sorted(answered) == list(range(30))
+        cancelled = {message["id"] for message in websocket.sent if message.get("cancelled")}
+        assert cancelled and 29 not in cancelled
+        assert all("results" in message for message in websocket.sent if message["id"] not in cancelled)
+        # More than MAX_IN_FLIGHT queries on other streams are all still answered
+        await answer_all(session, [{"query": "art music", "id": 100 + i, "stream": f"s{i}", "limit": 3}
+                                   for i in range(2 * Server.MAX_IN_FLIGHT)])
+        others = {message["id"] for message in websocket.sent if message["id"] >= 100}
+        assert others == set(range(100, 100 + 2 * Server.MAX_IN_FLIGHT))
+    asyncio.run(scenario())
+
+def test_queries_without_a_stream_are_never_cancelled(served):
+    async def scenario():
+        websocket = FakeWebSocket()
+        await answer_all(Server.SearchSession(websocket), [{"query": f"python data {i}", "id": i, "limit": 3}
+                                                           for i in range(20)])
+        assert sorted(message["id"] for message in websocket.sent) == list(range(20))
+        assert all("results" in message for message in websocket.sent)
+    asyncio.run(scenario())
+
+def test_rejected_options_are_answered(served):
+    async def scenario():
+        websocket = FakeWebSocket()
+        session = Server.SearchSession(websocket)
+        await answer_all(session, [{"query": "python", "id": 1, "stream": "a", "limit": "ten"},
+                                   {"query": "python", "id": 2, "stream": "b", "offset": 1.5},
+                                   {"query": "python", "id": 3, "stream": "c", "limit": True}])
+        assert sorted(message["id"] for message in websocket.sent) == [1, 2, 3]
+        assert all("error" in message for message in websocket.sent)
+    asyncio.run(scenario())
+
+@pytest.mark.parametrize("queries", [[], "python", ["python", 1], None, {"python": 1}])
+def test_batch_queries_must_be_a_non_empty_list_of_strings(served, queries):
+    async def scenario():
+        websocket = FakeWebSocket()
+        await answer_all(Server.SearchSession(websocket), [{"queries": queries, "id": 1}])
+        assert websocket.sent == [{"error": "Malformed search query"}]
+    asyncio.run(scenario())
+
+def test_maintenance_keeps_running_after_a_failure(served, monkeypatch):
+    passes = []
+    async def failing_apply(*args):
+        passes.append(args)
+        raise RuntimeError("maintenance failed")
+    holder = Cache.holder
+    monkeypatch.setattr(type(holder.model), "pending_maintenance", property(lambda model: True))
+    monkeypatch.setattr(holder, "apply", failing_apply)
+    async def scenario():
+        task = asyncio.create_task(Server.maintain_model(0.01))
+        while len(passes) < 3 and not task.done():
+            await asyncio.sleep(0.01)
+        assert not task.done()
+        task.cancel()
+    asyncio.run(asyncio.wait_for(scenario(), 10))
+
+class FeedbackSocket(FakeWebSocket):
+    """Delivers a list of messages to handle_feedback."""
+    def __init__(self, messages):
+        super().__init__()
+        self.messages = [json.dumps(message) for message in messages]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.messages:
+            raise StopAsyncIteration
+        return self.messages.pop(0)
+
+def test_feedback_clicked_must_be_0_or_1(served):
+    websocket = FeedbackSocket([{"query": "python", "url": "site.com/p1", "clicked": 2},
+                                {"query": "python", "url": "site.com/p1", "clicked": "1"},
+                                {"query": "python", "url": "site.com/p1", "clicked": True, "extra": 1},
+                                [{"query": "python", "url": "site.com/p2", "clicked": 0}]])
+    asyncio.run(Server.handle_feedback(websocket))
+    assert websocket.sent == [{"error": "Malformed feedback"}, {"error": "Malformed feedback"}]
+    assert Cache.CacheHandle.load().pending_feedback == [
+        {"query": "python", "url": "site.com/p1", "clicked": 1},
+        {"query": "python", "url": "site.com/p2", "clicked": 0}]
+
+def test_clicks_are_logged_under_the_trace_of_their_search(served, monkeypatch, log_dir):
+    monkeypatch.setattr(Server, "query_log", QueryLog("queries_clicks"))
+    async def search():
+        websocket = FakeWebSocket()
+        await answer_all(Server.SearchSession(websocket), [{"query": "python", "id": 1, "limit": 3}])
+        return websocket.sent[0]
+    response = asyncio.run(search())
+    url = response["results"][0][0]
+    websocket = FeedbackSocket([{"query": "python", "url": url, "clicked": 1, "trace": response["trace"]},
+                                {"query": "python", "url": url, "clicked": 1, "trace": 7}])
+    asyncio.run(Server.handle_feedback(websocket))
+    assert websocket.sent == [{"error": "Malformed feedback"}]
+    assert Server.query_log.flush()
+    with open(glob.glob(os.path.join(log_dir, "queries_clicks_*.jsonl"))[0], encoding="utf-8") as file:
+        search, click = [json.loads(line) for line in file]
+    assert click["type"] == "click" and click["trace"] == search["trace"] == response["trace"]
+    assert (click["url"], click["clicked"]) == (url, 1)
+
+@pytest.mark.parametrize("overrides", [{"ranker": "tree"}, {"port": "http"}, {"colour": "blue"}])
+def test_invalid_settings_are_rejected_up_front(overrides):
+    with pytest.raises(ValueError):
+        Server.server_config(overrides)
+
+def test_the_result_cache_listener_is_registered_once(served, monkeypatch):
+    cleared = []
+    monkeypatch.setattr(Server.result_cache, "clear", lambda: cleared.append(True))
+    for _ in range(3):
+        Cache.holder.add_listener(Server.clear_result_cache)
+    Cache.holder.publish(Cache.holder.model)
+    assert cleared == [True]
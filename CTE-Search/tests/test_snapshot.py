@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from Snapshot import StringColumn
+
+VALUES = ["python", "", "café", None, "data science"]
+
+@pytest.fixture
+def column():
+    return StringColumn.from_strings(VALUES)
+
+def test_indexing_matches_an_object_array(column):
+    expected = np.array(["" if value is None else value for value in VALUES], dtype=object)
+    assert column[0] == "python" and column[-1] == "data science" and column[np.int64(2)] == "café"
+    for index in (slice(None), slice(1, 4), slice(None, None, -2), [4, 0, 0], np.array([-1, 1]),
+                  np.array([], dtype=np.int64), expected == "", [True, False, True, False, True]):
+        assert column[index].tolist() == expected[index].tolist()
+
+@pytest.mark.parametrize("index", [5, -6, [0, 5], np.array([-6]), [True, False]])
+def test_out_of_bounds_indexes_raise_index_error(column, index):
+    with pytest.raises(IndexError):
+        column[index]
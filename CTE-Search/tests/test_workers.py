@@ -0,0 +1,94 @@
+import os
+import threading
+
+import pytest
+
+import Workers
+from Model import SearchModel
+from Workers import export_snapshot, serve_worker_model
+from conftest import make_pages
+
+def bases() -> set:
+    return {name for name in os.listdir("snapshots") if name.startswith("base-")}
+
+def test_exports_keep_the_current_and_previous_versions(workdir):
+    model = SearchModel(make_pages(50))
+    previous = None
+    for version in range(1, 5):
+        path = export_snapshot(model, "snapshots", version, previous)
+        assert len(bases()) == 1
+        assert sorted(os.listdir("snapshots")) == sorted({f"v{version}", f"v{previous}"} - {"vNone"} | bases())
+        assert SearchModel.load(path).improved_search("python", limit=5) == model.improved_search("python", limit=5)
+        previous = version
+
+def test_exports_only_write_the_changes_since_the_matrix_was_built(workdir):
+    model = SearchModel(make_pages(50))
+    export_snapshot(model, "snapshots", 1, None)
+    base = bases()
+    model.append_page_data({"url": "new.com/1", "title": "New page", "content": "python pizza", "filters": ["food"]})
+    model.remove_pages("Page 4")
+    path = export_snapshot(model, "snapshots", 2, 1)
+    assert bases() == base
+    assert not any(name.startswith("matrix") for name in os.listdir(path))
+    loaded = SearchModel.load(path)
+    for filters in (None, ["food"]):
+        for engine in ("dense", "inverted", "maxscore"):
+            assert loaded.improved_search("python pizza", filters, limit=20, engine=engine) \
+                == model.improved_search("python pizza", filters, limit=20, engine=engine)
+
+def test_a_rebuilt_matrix_gets_a_new_base_and_the_old_one_is_deleted(workdir):
+    model = SearchModel(make_pages(50))
+    export_snapshot(model, "snapshots", 1, None)
+    first = bases()
+    model.remove_pages("Page 4")
+    model.compact()
+    export_snapshot(model, "snapshots", 2, 1)
+    assert len(bases()) == 2 and first < bases()
+    export_snapshot(model, "snapshots", 3, 2)
+    assert len(bases()) == 1 and not first & bases()
+    assert SearchModel.load("snapshots/v3").improved_search("python", limit=5) == model.improved_search("python", limit=5)
+
+@pytest.fixture
+def worker(monkeypatch):
+    # The worker state of this process stands in for that of a worker process
+    for name in ("worker_version", "worker_model", "worker_loading"):
+        monkeypatch.setattr(Workers, name, None)
+
+def finish_warmups():
+    for thread in threading.enumerate():
+        if thread.name == "Warmup":
+            thread.join()
+
+def test_a_worker_serves_its_version_until_it_has_warmed_up_the_next(workdir, worker, monkeypatch):
+    model = SearchModel(make_pages(50))
+    export_snapshot(model, "snapshots", 1, None)
+    first, version = serve_worker_model("snapshots/v1", 1)
+    assert version == 1
+    model.append_page_data({"url": "new.com/1", "title": "New page", "content": "python pizza", "filters": []})
+    export_snapshot(model, "snapshots", 2, 1)
+    warming = threading.Event()
+    warmup = SearchModel.warmup
+
+    def slow_warmup(self):
+        warming.wait()
+        return warmup(self)
+
+    monkeypatch.setattr(SearchModel, "warmup", slow_warmup)
+    assert serve_worker_model("snapshots/v2", 2) == (first, 1)
+    assert serve_worker_model("snapshots/v2", 2) == (first, 1)
+    warming.set()
+    finish_warmups()
+    served, version = serve_worker_model("snapshots/v2", 2)
+    assert version == 2
+    assert served.improved_search("python pizza", limit=5) == model.improved_search("python pizza", limit=5)
+
+def test_a_failed_warmup_is_retried_by_the_next_search(workdir, worker):
+    model = SearchModel(make_pages(50))
+    export_snapshot(model, "snapshots", 1, None)
+    first, _ = serve_worker_model("snapshots/v1", 1)
+    assert serve_worker_model("snapshots/missing", 2) == (first, 1)
+    finish_warmups()
+    export_snapshot(model, "snapshots", 2, 1)
+    assert serve_worker_model("snapshots/v2", 2) == (first, 1)
+    finish_warmups()
+    assert serve_worker_model("snapshots/v2", 2)[1] == 2